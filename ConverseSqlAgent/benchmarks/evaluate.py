@@ -0,0 +1,298 @@
+"""
+Execution accuracy and latency of the agent on a corpus of questions over the
+sample databases (benchmarks/eval_corpus.json).
+
+Each question is answered by the agent, and the last SQL query it ran
+successfully is executed again and its result set compared with the result
+set of the gold SQL. Rows are compared as a multiset, or in order when the
+gold SQL has an ORDER BY; column names are ignored and numbers are rounded.
+
+The model outputs come from one of:
+- --traces DIR  recorded runs named <question id>.jsonl.gz (see recording.TraceRecorder),
+                replayed with live tools, offline
+- --live        Bedrock (BedrockModelId, BEDROCK_GUARDRAIL_ID), with --record DIR to save
+                the runs as traces for later offline evaluations
+- --oracle      a scripted model that runs the gold SQL, to check the harness and
+                measure the framework's own latency
+
+    python benchmarks/evaluate.py --oracle
+    python benchmarks/evaluate.py --live --record traces/ --concurrency 4 --requests-per-minute 60
+    python benchmarks/evaluate.py --traces traces/ --output results.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+from decimal import Decimal
+from collections import Counter
+from statistics import mean
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "ConverseSqlAgent"))
+
+from local_databases import seed_local_databases
+from run_benchmarks import summarize, git_commit, sql_turn
+
+from sqlalchemy import text
+
+from agent import BaseAgent
+from fake_bedrock import FakeBedrockClient, final_turn
+from recording import TraceRecorder, TraceReplayer
+from memory_store import InMemoryMemoryStore
+from tool_groups.sql import SQL_TOOL_GROUP, get_engine, clear_caches
+from tool_groups.memory import MEMORY_TOOL_GROUP
+
+RESULTS_VERSION = 1
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_corpus.json")
+SQL_ERROR_PREFIX = "Invoking SQL query encountered an error"
+
+
+def load_corpus(path=CORPUS_PATH, databases=None, ids=None):
+    with open(path) as f:
+        corpus = json.load(f)
+
+    return [
+        entry for entry in corpus
+        if (not databases or entry["database"] in databases) and (not ids or entry["id"] in ids)
+    ]
+
+
+def execute(database_name, query):
+    with get_engine(database_name).connect() as connection:
+        return [tuple(row) for row in connection.execute(text(query))]
+
+
+def normalize_value(value, digits=2):
+    if isinstance(value, (float, Decimal)):
+        value = round(float(value), digits)
+        return int(value) if value.is_integer() else value
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def normalize_rows(rows):
+    return [tuple(normalize_value(value) for value in row) for row in rows]
+
+
+def result_sets_match(gold_rows, predicted_rows, ordered=False):
+    """Compares two result sets by value, ignoring row order unless ordered is True"""
+
+    gold_rows, predicted_rows = normalize_rows(gold_rows), normalize_rows(predicted_rows)
+
+    if ordered:
+        return gold_rows == predicted_rows
+
+    return Counter(gold_rows) == Counter(predicted_rows)
+
+
+def predicted_sql(records):
+    """Returns the last SQL query of a run that executed without an error"""
+
+    for record in reversed(records):
+        if record["type"] == "tool" and record["name"] == "invoke_sql_query" and not record["output"].startswith(SQL_ERROR_PREFIX):
+            return record["input"]["query"]
+    return None
+
+
+def create_agent(model_id, guardrail_id, guardrail_version, bedrock_client, requests_per_minute_limit=None):
+    agent = BaseAgent(
+        model_id=model_id,
+        memory_table_name="evaluation",
+        guardrail_id=guardrail_id,
+        guardrail_version=guardrail_version,
+        requests_per_minute_limit=requests_per_minute_limit,
+        # A fresh memory per question, so answers do not depend on the order of the corpus
+        memory_store=InMemoryMemoryStore(),
+        bedrock_client=bedrock_client
+    )
+    agent.add_tool_group(SQL_TOOL_GROUP)
+    agent.add_tool_group(MEMORY_TOOL_GROUP)
+    return agent
+
+
+def oracle_script(entry):
+    return [sql_turn(entry["database"], entry["gold_sql"]), final_turn("The answer is {result}.")]
+
+
+def run_question(entry, args, bedrock_client=None, requests_per_minute_limit=None):
+    """Answers one question and scores it"""
+
+    question = f"{entry['question']} Use the {entry['database']} database."
+    recorder = TraceRecorder()
+    replayer = None
+
+    if args.traces:
+        trace_path = os.path.join(args.traces, f"{entry['id']}.jsonl.gz")
+        if not os.path.exists(trace_path):
+            return {"id": entry["id"], "database": entry["database"], "difficulty": entry.get("difficulty"), "skipped": True}
+        replayer = TraceReplayer(trace_path)
+        agent = create_agent(replayer.header["model_id"], "evaluation", "1", object())  # Replaced by the replayer
+    elif args.live:
+        agent = create_agent(args.model_id, args.guardrail_id, args.guardrail_version, bedrock_client, requests_per_minute_limit)
+    else:
+        agent = create_agent("oracle", "evaluation", "1", FakeBedrockClient(script=oracle_script(entry)))
+
+    agent.trace_recorder = recorder
+
+    error = None
+    start = time.perf_counter()
+    try:
+        if replayer:
+            replayer.replay(agent, stub_tools=False)
+        else:
+            agent.invoke_agent(question)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    if args.record and args.live and recorder.records:
+        os.makedirs(args.record, exist_ok=True)
+        recorder.save(os.path.join(args.record, f"{entry['id']}.jsonl.gz"))
+
+    converse_records = [record for record in recorder.records if record["type"] == "converse"]
+    usage = [record["response"].get("usage", {}) for record in converse_records]
+
+    query = predicted_sql(recorder.records)
+    correct = False
+    if query and not error:
+        try:
+            gold_rows = execute(entry["database"], entry["gold_sql"])
+            predicted_rows = execute(entry["database"], query)
+            ordered = re.search(r"\bORDER\s+BY\b", entry["gold_sql"], re.IGNORECASE) is not None
+            correct = result_sets_match(gold_rows, predicted_rows, ordered=ordered)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+    return {
+        "id": entry["id"],
+        "database": entry["database"],
+        "difficulty": entry.get("difficulty"),
+        "correct": correct,
+        "latency_ms": round(latency_ms, 1),
+        "turns": len(converse_records),
+        "input_tokens": sum(u.get("inputTokens", 0) for u in usage),
+        "output_tokens": sum(u.get("outputTokens", 0) for u in usage),
+        "tool_calls": sum(1 for record in recorder.records if record["type"] == "tool"),
+        "predicted_sql": query,
+        "error": error
+    }
+
+
+def accuracy(results):
+    return round(sum(result["correct"] for result in results) / len(results), 3) if results else None
+
+
+def summarize_results(results):
+    scored = [result for result in results if not result.get("skipped")]
+    if not scored:
+        return {"questions": 0, "skipped": len(results)}
+
+    return {
+        "questions": len(scored),
+        "skipped": len(results) - len(scored),
+        "errors": sum(1 for result in scored if result["error"]),
+        "accuracy": accuracy(scored),
+        "accuracy_by_database": {
+            database: accuracy([result for result in scored if result["database"] == database])
+            for database in sorted({result["database"] for result in scored})
+        },
+        "accuracy_by_difficulty": {
+            difficulty: accuracy([result for result in scored if result["difficulty"] == difficulty])
+            for difficulty in sorted({result["difficulty"] for result in scored if result["difficulty"]})
+        },
+        "latency_ms": summarize([result["latency_ms"] for result in scored]),
+        "turns": summarize([result["turns"] for result in scored]),
+        "mean_turns": round(mean(result["turns"] for result in scored), 2),
+        "mean_input_tokens": round(mean(result["input_tokens"] for result in scored)),
+        "mean_output_tokens": round(mean(result["output_tokens"] for result in scored)),
+        "mean_tool_calls": round(mean(result["tool_calls"] for result in scored), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the agent's execution accuracy and latency")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--traces", help="Directory of recorded runs named <question id>.jsonl.gz")
+    source.add_argument("--live", action="store_true", help="Call Bedrock")
+    source.add_argument("--oracle", action="store_true", help="Answer with the gold SQL")
+    parser.add_argument("--record", help="Save the live runs as traces in this directory")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--databases", help="Comma separated database names, all by default")
+    parser.add_argument("--ids", help="Comma separated question ids, all by default")
+    parser.add_argument("--concurrency", type=int, default=1, help="Questions answered at the same time")
+    parser.add_argument("--requests-per-minute", type=float, help="Converse calls per minute, shared by the concurrent runs")
+    parser.add_argument("--model-id", default=os.environ.get("BedrockModelId", "us.anthropic.claude-sonnet-4-20250514-v1:0"))
+    parser.add_argument("--guardrail-id", default=os.environ.get("BEDROCK_GUARDRAIL_ID"))
+    parser.add_argument("--guardrail-version", default=os.environ.get("BEDROCK_GUARDRAIL_VERSION", "1"))
+    parser.add_argument("--database-directory", default=os.path.join(tempfile.gettempdir(), "agent_benchmark_databases"))
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.live and not args.guardrail_id:
+        parser.error("--live requires --guardrail-id or BEDROCK_GUARDRAIL_ID")
+
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DATABASE_URL"] = seed_local_databases(args.database_directory)
+        clear_caches()
+
+    corpus = load_corpus(args.corpus, databases=args.databases and args.databases.split(","), ids=args.ids and args.ids.split(","))
+
+    bedrock_client = None
+    if args.live:
+        import boto3
+        bedrock_client = boto3.client("bedrock-runtime")
+
+    # The agent's own rate limiter paces each run, the budget is split between the concurrent runs
+    requests_per_minute_limit = args.requests_per_minute / args.concurrency if args.requests_per_minute else None
+
+    def evaluate(entry):
+        result = run_question(entry, args, bedrock_client, requests_per_minute_limit)
+        status = "skipped" if result.get("skipped") else ("correct" if result["correct"] else "wrong")
+        print(f"{entry['id']:10} {status}", file=sys.stderr)
+        return result
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(evaluate, corpus))
+    wall_seconds = time.perf_counter() - start
+
+    summary = summarize_results(results)
+    summary["wall_seconds"] = round(wall_seconds, 2)
+
+    source_name = "traces" if args.traces else ("live" if args.live else "oracle")
+    output = {
+        "version": RESULTS_VERSION,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "source": source_name,
+        "model_id": args.model_id if args.live else None,
+        "concurrency": args.concurrency,
+        "summary": summary,
+        "results": results
+    }
+
+    print(f"{'id':10} {'correct':8} {'latency ms':>11} {'turns':>6} {'tokens in':>10} {'tokens out':>11} {'tools':>6}")
+    for result in results:
+        if result.get("skipped"):
+            print(f"{result['id']:10} skipped")
+            continue
+        print(f"{result['id']:10} {str(result['correct']):8} {result['latency_ms']:11.1f} {result['turns']:6} "
+              f"{result['input_tokens']:10} {result['output_tokens']:11} {result['tool_calls']:6}"
+              + (f"  {result['error']}" if result["error"] else ""))
+
+    print(json.dumps(summary, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+"""
+Load test with simulated WebSocket clients, to find where throughput stops
+scaling: Bedrock throttling, database connection pool exhaustion or admission
+queueing.
+
+Targets:
+- local-server  starts server.AgentServer in this process with a scripted Bedrock
+                (latency and throttle rate set here) and connects over WebSockets
+- server        an already running server, e.g. "python server.py --fake-bedrock"
+- lambda        calls lambda_function.lambda_handler from threads, each call is one
+                WebSocket message; CONNECTIONS_TABLE must be set (it is not used)
+
+Load is either closed loop (--connections clients that each ask, wait for the
+answer and think for --think-time seconds) or open loop (--rate new connections
+per second, each asking one question). Every question is sent with its own
+session_id so repeated questions run the agent instead of being answered by the
+duplicate request guard; replies that were coalesced anyway are counted as the
+"coalesced" outcome, not as "ok". Questions are drawn from a mix file
+(JSON list of {"question", "database", "weight"}) or the evaluation corpus; with
+the scripted Bedrock each question runs its gold SQL.
+
+    python benchmarks/load_test.py --connections 50 --duration 30 --bedrock-latency 0.5
+    python benchmarks/load_test.py --rate 20 --duration 60 --throttle-rate 0.05 --workers 16
+    python benchmarks/load_test.py --target server --url ws://localhost:8080/ws --connections 20
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+from urllib.parse import urlparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "ConverseSqlAgent"))
+
+from local_databases import seed_local_databases
+from evaluate import load_corpus, oracle_script
+from run_benchmarks import git_commit
+
+from admission import percentile
+from fake_bedrock import FakeBedrockClient, DEFAULT_SCRIPT
+from framing import FrameAssembler
+from sessions import is_exchange_start
+
+RESULTS_VERSION = 1
+
+
+def load_mix(path=None):
+    """Returns the question mix as a list of {"question", "database", "weight", "script"}"""
+
+    if path:
+        with open(path) as f:
+            mix = json.load(f)
+    else:
+        mix = [
+            {"question": entry["question"], "database": entry["database"], "script": oracle_script(entry)}
+            for entry in load_corpus()
+        ]
+
+    for item in mix:
+        item.setdefault("weight", 1)
+        item.setdefault("script", DEFAULT_SCRIPT)
+
+    return mix
+
+
+def mix_script(mix):
+    """A FakeBedrockClient script that plays the script of the question being asked"""
+
+    scripts = {item["question"]: item["script"] for item in mix}
+
+    def script(messages):
+        exchange_start = max(i for i, message in enumerate(messages) if is_exchange_start(message))
+        question = messages[exchange_start]["content"][0]["text"]
+        turns = scripts.get(question, DEFAULT_SCRIPT)
+        turn = sum(1 for message in messages[exchange_start:] if message["role"] == "assistant")
+        return turns[min(turn, len(turns) - 1)]
+
+    return script
+
+
+def summarize_admission(snapshot):
+    """Totals the per tenant admission snapshot, the clients of a load test are all separate tenants"""
+
+    tenants = list(snapshot.values())
+    waits = lambda key: [tenant[key] for tenant in tenants if tenant[key] is not None]
+
+    return {
+        "tenants": len(tenants),
+        "admitted": sum(tenant["admitted"] for tenant in tenants),
+        "rejected": sum(tenant["rejected"] for tenant in tenants),
+        "queue_wait_p95_ms_worst_tenant": max(waits("queue_wait_p95_ms"), default=None),
+        "queue_wait_max_ms": max(waits("queue_wait_max_ms"), default=None)
+    }
+
+
+def classify(response):
+    """Returns "ok", "coalesced" or the error type of a reply"""
+
+    if "result" in response:
+        return "coalesced" if response.get("coalesced") else "ok"
+    if response.get("status") in ("rejected", "cancelled", "suspended"):
+        return response["status"]
+    error = str(response.get("error", "unknown"))
+    return "error: " + error.split(":")[0][:60]
+
+
+class WebSocketClient():
+    """Minimal client side of RFC 6455 for text messages"""
+
+    def __init__(self, url):
+        self.url = urlparse(url)
+        self.reader = None
+        self.writer = None
+        self.assembler = FrameAssembler()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.url.hostname, self.url.port or 80)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        self.writer.write(
+            f"GET {self.url.path or '/'} HTTP/1.1\r\n"
+            f"Host: {self.url.hostname}:{self.url.port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n".encode("latin-1")
+        )
+        await self.writer.drain()
+
+        status = await self.reader.readline()
+        if b" 101 " not in status:
+            raise ConnectionError(f"Handshake failed: {status.decode('latin-1').strip()}")
+        while (await self.reader.readline()).strip():
+            pass
+
+    async def send(self, message):
+        payload = json.dumps(message).encode("utf-8")
+        mask = os.urandom(4)
+        length = len(payload)
+
+        if length < 126:
+            header = bytes([0x81, 0x80 | length])
+        elif length < 1 << 16:
+            header = bytes([0x81, 0x80 | 126]) + length.to_bytes(2, "big")
+        else:
+            header = bytes([0x81, 0x80 | 127]) + length.to_bytes(8, "big")
+
+        self.writer.write(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+        await self.writer.drain()
+
+    async def receive(self):
+        """Returns the next complete message, skipping progress events"""
+
+        while True:
+            header = await self.reader.readexactly(2)
+            length = header[1] & 0x7F
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), "big")
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), "big")
+            payload = await self.reader.readexactly(length)
+
+            if header[0] & 0x0F == 0x8:
+                raise ConnectionError("Closed by the server")
+
+            message = self.assembler.add(payload.decode("utf-8"))
+            if message is not None and "event" not in message:
+                return message
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.write(bytes([0x88, 0x80]) + os.urandom(4))
+            with contextlib.suppress(Exception):
+                await self.writer.drain()
+            self.writer.close()
+
+
+class LoadStats():
+
+    def __init__(self):
+        self.latencies = []
+        self.outcomes = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, outcome, latency_seconds):
+        with self.lock:
+            self.in_flight -= 1
+            self.outcomes[outcome] += 1
+            if outcome == "ok":
+                self.latencies.append(latency_seconds)
+
+
+class ResourceSampler():
+    """Samples the database pools of this process while the test runs"""
+
+    def __init__(self, interval_seconds=0.05):
+        self.interval_seconds = interval_seconds
+        self.max_checked_out = 0
+        self.max_overflow = 0
+        self.pool_size = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        from tool_groups import sql
+
+        while not self.stopped.wait(self.interval_seconds):
+            for engine in list(sql._engines.values()):
+                pool = engine.pool
+                if hasattr(pool, "checkedout"):
+                    self.max_checked_out = max(self.max_checked_out, pool.checkedout())
+                    self.max_overflow = max(self.max_overflow, pool.overflow())
+                    self.pool_size = pool.size()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return {"db_pool_size": self.pool_size, "db_max_checked_out": self.max_checked_out, "db_max_overflow": self.max_overflow}
+
+
+def pick(mix, rng):
+    return rng.choices(mix, weights=[item["weight"] for item in mix])[0]
+
+
+def new_request(item):
+    """A request for a question in a new session, so it is neither coalesced with nor follows up on earlier ones"""
+
+    return {"prompt": item["question"], "database": item["database"], "session_id": f"load-{uuid.uuid4()}"}
+
+
+async def websocket_question(url, item, stats, timeout, client=None):
+    """Asks one question over a connection, opening one if client is None"""
+
+    own_client = client is None
+    stats.start()
+    start = time.perf_counter()
+    try:
+        if own_client:
+            client = WebSocketClient(url)
+            await client.connect()
+        await client.send(new_request(item))
+        response = await asyncio.wait_for(client.receive(), timeout)
+        outcome = classify(response)
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+    except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+        outcome = f"connection: {type(e).__name__}"
+    finally:
+        if own_client and client is not None:
+            await client.close()
+
+    stats.finish(outcome, time.perf_counter() - start)
+
+
+async def run_websocket_load(url, mix, args, stats):
+    rng = random.Random(args.seed)
+    deadline = time.perf_counter() + args.duration
+    tasks = []
+
+    if args.rate:
+        # Open loop: Poisson arrivals, one connection per question
+        while time.perf_counter() < deadline:
+            tasks.append(asyncio.ensure_future(websocket_question(url, pick(mix, rng), stats, args.timeout)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+    else:
+        # Closed loop: each connection asks, waits for the answer and thinks
+        async def connection_loop():
+            client = WebSocketClient(url)
+            try:
+                await client.connect()
+            except (ConnectionError, OSError) as e:
+                stats.start()
+                stats.finish(f"connection: {type(e).__name__}", 0)
+                return
+            try:
+                while time.perf_counter() < deadline:
+                    await websocket_question(url, pick(mix, rng), stats, args.timeout, client=client)
+                    if args.think_time:
+                        await asyncio.sleep(rng.expovariate(1 / args.think_time))
+            finally:
+                await client.close()
+
+        tasks = [asyncio.ensure_future(connection_loop()) for _ in range(args.connections)]
+
+    await asyncio.gather(*tasks)
+
+
+async def fetch_health(url):
+    parsed = urlparse(url)
+    reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+    writer.write(f"GET /health HTTP/1.1\r\nHost: {parsed.hostname}\r\nConnection: close\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    return json.loads(data.split(b"\r\n\r\n", 1)[1])
+
+
+def start_local_server(bedrock_client, args):
+    """Starts an AgentServer on a free port in a background thread and returns it with its URL"""
+
+    from server import AgentServer
+
+    server = AgentServer(workers=args.workers, bedrock_client=bedrock_client, tenant_concurrency=args.tenant_concurrency)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    address = {}
+
+    async def serve():
+        from server import LocalConnectionClient
+
+        server.client = LocalConnectionClient(asyncio.get_running_loop())
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        address["port"] = listener.sockets[0].getsockname()[1]
+        ready.set()
+        async with listener:
+            await listener.serve_forever()
+
+    threading.Thread(target=lambda: loop.run_until_complete(serve()), daemon=True).start()
+    ready.wait()
+
+    return server, f"ws://127.0.0.1:{address['port']}/ws"
+
+
+class RecordingConnectionClient():
+    """Stands in for the API Gateway management client in the lambda target"""
+
+    class exceptions():
+        class GoneException(Exception):
+            pass
+
+    def post_to_connection(self, ConnectionId, Data):
+        pass
+
+
+def run_lambda_load(mix, args, stats, bedrock_client):
+    import lambda_function
+    import connections
+
+    lambda_function._bedrock_client = bedrock_client
+    domain_name, stage = "load-test.local", "test"
+    connections._management_clients[f"https://{domain_name}/{stage}"] = RecordingConnectionClient()
+
+    class Context():
+        invoked_function_arn = "arn:aws:lambda:local:000000000000:function:load-test"
+
+        def get_remaining_time_in_millis(self):
+            return 900000
+
+    rng = random.Random(args.seed)
+    deadline = time.perf_counter() + args.duration
+    connection_ids = iter(range(1, 1 << 30))
+
+    def invoke(item):
+        event = {
+            "requestContext": {"connectionId": f"load-{next(connection_ids)}", "domainName": domain_name, "stage": stage},
+            "body": json.dumps(new_request(item))
+        }
+        stats.start()
+        start = time.perf_counter()
+        try:
+            response = lambda_function.lambda_handler(event, Context())
+            outcome = classify(json.loads(response["body"]))
+        except Exception as e:
+            outcome = f"error: {type(e).__name__}"
+        stats.finish(outcome, time.perf_counter() - start)
+
+    # Each thread is one concurrently running function instance
+    concurrency = args.connections if not args.rate else args.workers
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if args.rate:
+            while time.perf_counter() < deadline:
+                executor.submit(invoke, pick(mix, rng))
+                time.sleep(rng.expovariate(args.rate))
+        else:
+            def loop():
+                while time.perf_counter() < deadline:
+                    invoke(pick(mix, rng))
+                    if args.think_time:
+                        time.sleep(rng.expovariate(1 / args.think_time))
+            for _ in range(concurrency):
+                executor.submit(loop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the agent with simulated WebSocket clients")
+    parser.add_argument("--target", choices=["local-server", "server", "lambda"], default="local-server")
+    parser.add_argument("--url", default="ws://localhost:8080/ws", help="The WebSocket URL of the server target")
+    parser.add_argument("--connections", type=int, default=10, help="Concurrent clients in closed loop mode")
+    parser.add_argument("--rate", type=float, help="New connections per second, enables open loop mode")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean seconds between a client's questions")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for an answer")
+    parser.add_argument("--mix", help="JSON file of questions with weights, the evaluation corpus by default")
+    parser.add_argument("--bedrock-latency", type=float, default=0.5, help="Seconds per scripted Converse call")
+    parser.add_argument("--bedrock-jitter", type=float, default=0.2, help="Random extra latency as a fraction of --bedrock-latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of Converse calls that are throttled")
+    parser.add_argument("--workers", type=int, default=8, help="Worker threads of the local server")
+    parser.add_argument("--tenant-concurrency", type=int, default=1000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--database-directory", default=os.path.join(tempfile.gettempdir(), "agent_benchmark_databases"))
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.target != "server" and not os.environ.get("DATABASE_URL"):
+        os.environ["DATABASE_URL"] = seed_local_databases(args.database_directory)
+    os.environ.setdefault("MEMORY_BACKEND", "memory")
+
+    mix = load_mix(args.mix)
+    stats = LoadStats()
+
+    bedrock_client = None
+    sampler = None
+    if args.target != "server":
+        jitter_rng = random.Random(args.seed)
+        bedrock_client = FakeBedrockClient(
+            script=mix_script(mix),
+            latency_seconds=lambda: args.bedrock_latency * (1 + args.bedrock_jitter * jitter_rng.random()),
+            throttle_rate=args.throttle_rate,
+            seed=args.seed
+        )
+        sampler = ResourceSampler()
+        sampler.start()
+
+    server = None
+    url = args.url
+    start = time.perf_counter()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.target == "lambda":
+            run_lambda_load(mix, args, stats, bedrock_client)
+        else:
+            if args.target == "local-server":
+                server, url = start_local_server(bedrock_client, args)
+            asyncio.run(run_websocket_load(url, mix, args, stats))
+
+    elapsed = time.perf_counter() - start
+
+    saturation = {"max_in_flight": stats.max_in_flight}
+    if bedrock_client is not None:
+        saturation.update(bedrock_calls=bedrock_client.calls, bedrock_throttled=bedrock_client.throttled,
+                          bedrock_throttle_rate=round(bedrock_client.throttled / bedrock_client.calls, 3) if bedrock_client.calls else None)
+    if sampler is not None:
+        saturation.update(sampler.stop())
+    if server is not None:
+        saturation["admission"] = summarize_admission(server.admission.metrics.snapshot())
+    elif args.target == "server":
+        with contextlib.suppress(Exception):
+            saturation["admission"] = summarize_admission(asyncio.run(fetch_health(url))["admission"])
+
+    completed = sum(stats.outcomes.values())
+    results = {
+        "version": RESULTS_VERSION,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "target": args.target,
+        "mode": "open" if args.rate else "closed",
+        "connections": None if args.rate else args.connections,
+        "rate": args.rate,
+        "duration_seconds": round(elapsed, 2),
+        "requests": completed,
+        "throughput_per_second": round(stats.outcomes["ok"] / elapsed, 2),
+        "latency_ms": {
+            name: round(percentile(stats.latencies, fraction) * 1000, 1) if stats.latencies else None
+            for name, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)]
+        },
+        "outcomes": dict(stats.outcomes),
+        "saturation": saturation
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Replays a recorded agent run (see recording.TraceRecorder and TRACE_BUCKET)
+with the recorded model responses, so changes to the agent can be checked
+against real runs without calling Bedrock.
+
+By default the tools return their recorded outputs. With --live-tools the SQL
+and memory tools run for real against DATABASE_URL (or the local SQLite copies
+of the sample databases) and differences in their results are reported.
+
+    python benchmarks/replay_trace.py trace.jsonl.gz
+    python benchmarks/replay_trace.py trace.jsonl.gz --live-tools --iterations 10
+"""
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import contextlib
+from statistics import median
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "ConverseSqlAgent"))
+
+from local_databases import seed_local_databases
+
+from agent import BaseAgent
+from recording import TraceReplayer
+from memory_store import InMemoryMemoryStore
+from tool_groups.sql import SQL_TOOL_GROUP, clear_caches
+from tool_groups.memory import MEMORY_TOOL_GROUP
+
+
+def create_agent(model_id):
+    agent = BaseAgent(
+        model_id=model_id,
+        memory_table_name="replay",
+        guardrail_id="replay",
+        guardrail_version="1",
+        memory_store=InMemoryMemoryStore(),
+        bedrock_client=object()  # Replaced by the replayer
+    )
+    agent.add_tool_group(SQL_TOOL_GROUP)
+    agent.add_tool_group(MEMORY_TOOL_GROUP)
+    return agent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded agent run")
+    parser.add_argument("trace", help="A .jsonl.gz trace file")
+    parser.add_argument("--live-tools", action="store_true", help="Run the tools instead of returning the recorded outputs")
+    parser.add_argument("--replay-latency", action="store_true", help="Wait for the recorded model latency on each turn")
+    parser.add_argument("--strict", action="store_true", help="Fail on the first divergence")
+    parser.add_argument("--stream", action="store_true", help="Replay through the ConverseStream code path")
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--database-directory", default=os.path.join(tempfile.gettempdir(), "agent_benchmark_databases"))
+    args = parser.parse_args()
+
+    if args.live_tools and not os.environ.get("DATABASE_URL"):
+        os.environ["DATABASE_URL"] = seed_local_databases(args.database_directory)
+        clear_caches()
+
+    replayer = TraceReplayer(args.trace)
+    print(f"Question: {replayer.header['input_text']}")
+    print(f"Recorded with {replayer.header['model_id']} at {replayer.header['recorded_at']}")
+
+    reports = []
+    for _ in range(args.iterations):
+        agent = create_agent(replayer.header["model_id"])
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            reports.append(replayer.replay(agent, stub_tools=not args.live_tools, replay_latency=args.replay_latency,
+                                           strict=args.strict, stream=args.stream))
+
+    report = reports[-1]
+    durations = [run["duration_ms"] for run in reports]
+
+    print(f"Turns: {report['turns']} of {report['recorded_turns']} recorded")
+    print(f"Duration p50: {median(durations):.1f} ms (recorded {report['recorded_duration_ms']} ms)")
+    print(f"Final response matches: {report['matches']}")
+    if not report["matches"]:
+        print(f"  recorded: {report['recorded_final_response']}")
+        print(f"  replayed: {report['final_response']}")
+
+    print(f"Divergences: {len(report['divergences'])}")
+    for divergence in report["divergences"]:
+        print(json.dumps(divergence, default=str))
+
+    sys.exit(0 if report["matches"] and not report["divergences"] else 1)
+
+
+if __name__ == "__main__":
+    main()
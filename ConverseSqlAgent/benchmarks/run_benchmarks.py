@@ -0,0 +1,275 @@
+"""
+Offline benchmarks of the agent's own overhead.
+
+Runs BaseAgent.invoke_agent against a scripted Bedrock client, the in-memory
+memory store (the DynamoDB stand-in, with the same conditional write
+semantics) and SQLite copies of the sample databases, and measures per turn
+framework overhead, tool latency, request serialization cost and peak memory
+for scenarios of increasing size.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+from time import perf_counter
+from statistics import median
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "ConverseSqlAgent"))
+
+from local_databases import seed_local_databases
+
+from agent import BaseAgent
+from fake_bedrock import FakeBedrockClient, tool_turn, final_turn
+from memory_store import InMemoryMemoryStore
+from events import InMemoryEventSink, TOOL_FINISHED
+from tool_groups.sql import SQL_TOOL_GROUP, clear_caches
+from tool_groups.memory import MEMORY_TOOL_GROUP
+
+RESULTS_VERSION = 1
+
+
+def sql_turn(database_name, query):
+    return tool_turn("invoke_sql_query", {"database_name": database_name, "query": query})
+
+
+def build_scenarios():
+    """Scenario name -> (question, script)"""
+
+    return {
+        "single_query": (
+            "How many employees are there?",
+            [
+                sql_turn("hr", "SELECT COUNT(*) AS employees FROM employees"),
+                final_turn("There are {result} employees.")
+            ]
+        ),
+        "schema_discovery": (
+            "What is the average salary per department?",
+            [
+                tool_turn("get_database_schemas", {"database_name": "hr"}),
+                tool_turn("get_schema_tables", {"database_name": "hr", "schema": "main"}),
+                tool_turn("get_table_columns", {"database_name": "hr", "schema": "main", "table": "employees"}),
+                tool_turn("get_table_columns", {"database_name": "hr", "schema": "main", "table": "departments"}),
+                tool_turn("get_foreign_keys", {"database_name": "hr"}),
+                sql_turn("hr", "SELECT d.department_name, AVG(e.salary) AS average_salary FROM employees e "
+                               "JOIN departments d ON e.department_id = d.department_id GROUP BY d.department_name"),
+                final_turn("The average salaries are listed above.")
+            ]
+        ),
+        "large_results": (
+            "List every employee with every department.",
+            [
+                sql_turn("hr", "SELECT e.*, d.* FROM employees e CROSS JOIN departments d"),
+                sql_turn("banking_system", "SELECT t.*, a.*, u.* FROM transactions t JOIN accounts a ON t.account_id = a.account_id "
+                                           "JOIN users u ON a.user_id = u.user_id"),
+                final_turn("The full listing was returned.")
+            ]
+        ),
+        "long_run": (
+            "Summarize the banking system.",
+            [
+                sql_turn("banking_system", f"SELECT * FROM {table}")
+                for table in ["banks", "branches", "users", "account_types", "accounts", "transaction_types",
+                              "transactions", "loans", "loan_payments", "cards"] * 2
+            ] + [final_turn("The banking system summary is above.")]
+        )
+    }
+
+
+class TimedBedrockClient():
+    """Wraps the fake client and times the request serialization boto3 would do and the model call"""
+
+    def __init__(self, client):
+        self.client = client
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.model_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.max_request_bytes = 0
+
+    def converse(self, **request):
+        start = perf_counter()
+        request_bytes = len(json.dumps(request, default=str).encode("utf-8"))
+        serialized = perf_counter()
+
+        response = self.client.converse(**request)
+
+        self.calls += 1
+        self.serialization_seconds += serialized - start
+        self.model_seconds += perf_counter() - serialized
+        self.max_request_bytes = max(self.max_request_bytes, request_bytes)
+
+        return response
+
+
+def create_agent(bedrock_client, event_sink):
+    agent = BaseAgent(
+        model_id="benchmark",
+        memory_table_name="benchmark",
+        guardrail_id="benchmark",
+        guardrail_version="1",
+        memory_store=InMemoryMemoryStore(),
+        event_sink=event_sink,
+        bedrock_client=bedrock_client
+    )
+    agent.add_tool_group(SQL_TOOL_GROUP)
+    agent.add_tool_group(MEMORY_TOOL_GROUP)
+    return agent
+
+
+def tool_result_bytes(messages):
+    return sum(
+        len(result.get("text", "").encode("utf-8"))
+        for message in messages
+        for chunk in message["content"] if "toolResult" in chunk
+        for result in chunk["toolResult"]["content"]
+    )
+
+
+def run_once(question, script, measure_memory=False):
+    client = TimedBedrockClient(FakeBedrockClient(script=script))
+    event_sink = InMemoryEventSink(event_types=[TOOL_FINISHED])
+    agent = create_agent(client, event_sink)
+
+    if measure_memory:
+        tracemalloc.start()
+
+    # Printing is part of the framework cost, but not the terminal's
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = perf_counter()
+        agent.invoke_agent(question)
+        total_seconds = perf_counter() - start
+
+    peak_bytes = None
+    if measure_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    tool_seconds = sum(event["duration_ms"] for event in event_sink.events) / 1000
+
+    return {
+        "turns": client.calls,
+        "tool_calls": len(event_sink.events),
+        "total_ms": total_seconds * 1000,
+        "model_ms": client.model_seconds * 1000,
+        "tool_ms": tool_seconds * 1000,
+        "serialization_ms": client.serialization_seconds * 1000,
+        "overhead_per_turn_ms": (total_seconds - client.model_seconds - tool_seconds - client.serialization_seconds) * 1000 / max(client.calls, 1),
+        "max_request_bytes": client.max_request_bytes,
+        "tool_result_bytes": tool_result_bytes(agent.last_run_messages or []),
+        "peak_memory_bytes": peak_bytes
+    }
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "p50": round(median(values), 3),
+        "p95": round(values[min(len(values) - 1, int(0.95 * len(values)))], 3),
+        "min": round(values[0], 3)
+    }
+
+
+def run_scenario(question, script, iterations):
+    # The first run warms the engine registry and schema cache and is not counted
+    run_once(question, script)
+
+    runs = [run_once(question, script) for _ in range(iterations)]
+    memory_run = run_once(question, script, measure_memory=True)
+
+    return {
+        "turns": runs[0]["turns"],
+        "tool_calls": runs[0]["tool_calls"],
+        "total_ms": summarize([run["total_ms"] for run in runs]),
+        "overhead_per_turn_ms": summarize([run["overhead_per_turn_ms"] for run in runs]),
+        "tool_ms": summarize([run["tool_ms"] for run in runs]),
+        "serialization_ms": summarize([run["serialization_ms"] for run in runs]),
+        "max_request_bytes": runs[0]["max_request_bytes"],
+        "tool_result_bytes": runs[0]["tool_result_bytes"],
+        "peak_memory_kb": round(memory_run["peak_memory_bytes"] / 1024, 1)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    """Prints the change of the p50 metrics against a baseline results file"""
+
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('timestamp')})")
+
+    for name, scenario in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            continue
+
+        for metric in ["total_ms", "overhead_per_turn_ms", "tool_ms", "serialization_ms"]:
+            old, new = base[metric]["p50"], scenario[metric]["p50"]
+            change = (new - old) / old * 100 if old else 0
+            print(f"  {name:18} {metric:22} {old:10.3f} -> {new:10.3f}  ({change:+.1f}%)")
+
+        old, new = base["peak_memory_kb"], scenario["peak_memory_kb"]
+        print(f"  {name:18} {'peak_memory_kb':22} {old:10.1f} -> {new:10.1f}  ({(new - old) / old * 100 if old else 0:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agent's overhead offline")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--scenarios", help="Comma separated scenario names, all by default")
+    parser.add_argument("--database-directory", default=os.path.join(tempfile.gettempdir(), "agent_benchmark_databases"))
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="A previous results file to compare with")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = seed_local_databases(args.database_directory)
+    clear_caches()
+
+    scenarios = build_scenarios()
+    names = args.scenarios.split(",") if args.scenarios else list(scenarios)
+
+    results = {
+        "version": RESULTS_VERSION,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "scenarios": {}
+    }
+
+    for name in names:
+        question, script = scenarios[name]
+        results["scenarios"][name] = run_scenario(question, script, args.iterations)
+        scenario = results["scenarios"][name]
+        print(f"{name:18} turns={scenario['turns']:3} total p50={scenario['total_ms']['p50']:9.2f} ms  "
+              f"overhead/turn p50={scenario['overhead_per_turn_ms']['p50']:7.3f} ms  "
+              f"tools p50={scenario['tool_ms']['p50']:8.2f} ms  serialization p50={scenario['serialization_ms']['p50']:7.3f} ms  "
+              f"peak={scenario['peak_memory_kb']:9.1f} KB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
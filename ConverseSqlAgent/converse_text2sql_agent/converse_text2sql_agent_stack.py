@@ -10,6 +10,8 @@ from aws_cdk import (
     aws_s3_deployment as s3deploy,
     aws_apigatewayv2 as apigwv2,
     aws_bedrock as bedrock,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
     RemovalPolicy,
     Duration,
     Size,
@@ -170,6 +172,15 @@ class ConverseText2SqlAgentStack(Stack):
             security_groups=[security_group]
         )
 
+        # Create DynamoDB table for SQL statement statistics per query shape
+        query_log_table = dynamodb.Table(
+            self, "QueryLogTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
         # Create Lambda function
         lambda_role = iam.Role(
             self, "LambdaRole",
@@ -211,6 +222,50 @@ class ConverseText2SqlAgentStack(Stack):
             removal_policy=RemovalPolicy.DESTROY
         )
 
+        # Create DynamoDB table for request idempotency leases and cached results
+        idempotency_table = dynamodb.Table(
+            self, "IdempotencyTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Create DynamoDB table for multi-turn session history
+        session_table = dynamodb.Table(
+            self, "SessionTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Create DynamoDB table for run checkpoints, used to resume long runs in a new invocation
+        checkpoint_table = dynamodb.Table(
+            self, "CheckpointTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Create DynamoDB table for cancel requests, shared by all invocations
+        cancellation_table = dynamodb.Table(
+            self, "CancellationTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Create DynamoDB table for the admission control state shared by all invocations
+        admission_table = dynamodb.Table(
+            self, "AdmissionTable",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
         # Create Lambda function
         lambda_function = lambda_.Function(
             self, "SQLAgentFunction",
@@ -232,12 +287,24 @@ class ConverseText2SqlAgentStack(Stack):
                 "CONNECTIONS_TABLE": connections_table.table_name,
                 "BEDROCK_GUARDRAIL_ID": "l2m1ls0o9cth",
                 "BEDROCK_GUARDRAIL_VERSION": "24",
-                "SECRET_MANAGER_ID": db_secret.secret_name
+                "SECRET_MANAGER_ID": db_secret.secret_name,
+                "IDEMPOTENCY_TABLE": idempotency_table.table_name,
+                "SESSION_TABLE": session_table.table_name,
+                "CHECKPOINT_TABLE": checkpoint_table.table_name,
+                "CANCELLATION_TABLE": cancellation_table.table_name,
+                "ADMISSION_TABLE": admission_table.table_name,
+                "QUERY_LOG_TABLE": query_log_table.table_name
             }
         )
 
         # Grant permissions
         dynamodb_table.grant_read_write_data(lambda_function)
+        idempotency_table.grant_read_write_data(lambda_role)
+        session_table.grant_read_write_data(lambda_role)
+        checkpoint_table.grant_read_write_data(lambda_role)
+        cancellation_table.grant_read_write_data(lambda_role)
+        admission_table.grant_read_write_data(lambda_role)
+        query_log_table.grant_read_write_data(lambda_role)
         db_secret.grant_read(lambda_function)
 
         # Lambda function for $connect route
@@ -345,4 +412,90 @@ class ConverseText2SqlAgentStack(Stack):
         
         lambda_function.add_to_role_policy(api_gateway_management_policy)
 
+        # Job mode: the $default route only enqueues jobs and a worker function runs the agent.
+        # Enable with `cdk deploy -c job_mode=true`, tune with -c job_worker_concurrency=<n>
+        if self.node.try_get_context("job_mode") == "true":
+            job_queue = sqs.Queue(
+                self, "AgentJobQueue",
+                visibility_timeout=Duration.minutes(16),
+                retention_period=Duration.hours(1),
+                enforce_ssl=True
+            )
+
+            worker_function = lambda_.Function(
+                self, "SQLAgentWorkerFunction",
+                function_name="sqlagent-worker",
+                runtime=lambda_.Runtime.PYTHON_3_11,
+                handler="worker.handler",
+                code=lambda_.Code.from_asset("./src/ConverseSqlAgent"),
+                vpc=vpc,
+                vpc_subnets=ec2.SubnetSelection(subnets=private_subnets),
+                security_groups=[security_group],
+                layers=[layer1],
+                role=lambda_role,
+                memory_size=1024,
+                ephemeral_storage_size=Size.gibibytes(2),
+                timeout=Duration.minutes(15),
+                environment={
+                    "DynamoDbMemoryTable": dynamodb_table.table_name,
+                    "BedrockModelId": "us.anthropic.claude-sonnet-4-20250514-v1:0",
+                    "CONNECTIONS_TABLE": connections_table.table_name,
+                    "BEDROCK_GUARDRAIL_ID": "l2m1ls0o9cth",
+                    "BEDROCK_GUARDRAIL_VERSION": "24",
+                    "SECRET_MANAGER_ID": db_secret.secret_name,
+                    "IDEMPOTENCY_TABLE": idempotency_table.table_name,
+                    "SESSION_TABLE": session_table.table_name,
+                    "CHECKPOINT_TABLE": checkpoint_table.table_name,
+                    "CANCELLATION_TABLE": cancellation_table.table_name,
+                    "ADMISSION_TABLE": admission_table.table_name,
+                    "QUERY_LOG_TABLE": query_log_table.table_name
+                }
+            )
+
+            worker_function.add_event_source(lambda_event_sources.SqsEventSource(
+                job_queue,
+                batch_size=1,
+                max_concurrency=int(self.node.try_get_context("job_worker_concurrency") or 5),
+                report_batch_item_failures=True
+            ))
+
+            job_queue.grant_send_messages(lambda_function)
+            lambda_function.add_environment("JOB_QUEUE_URL", job_queue.queue_url)
+            worker_function.add_to_role_policy(api_gateway_management_policy)
+
+        # Allow the agent to invoke itself asynchronously for deferred reflection (REFLECTION_MODE=async) and run continuations
+        lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["lambda:InvokeFunction"],
+            resources=[
+                f"arn:aws:lambda:{self.region}:{self.account}:function:sqlagent",
+                f"arn:aws:lambda:{self.region}:{self.account}:function:sqlagent-worker"
+            ]
+        ))
+
+
+
+        # Sampled run traces for offline replay (see "Record and replay" in the README).
+        # Enable with `cdk deploy -c trace_bucket=true`, tune with -c trace_sample_rate=<fraction>
+        if self.node.try_get_context("trace_bucket") == "true":
+            trace_bucket = s3.Bucket(
+                self, "TraceBucket",
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                enforce_ssl=True,
+                # Traces hold questions and query results, keep them only as long as they are useful
+                lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(30))],
+                removal_policy=RemovalPolicy.DESTROY,
+                auto_delete_objects=True
+            )
+
+            # The worker function shares the role
+            trace_bucket.grant_put(lambda_role)
+
+            agent_functions = [lambda_function]
+            if self.node.try_get_context("job_mode") == "true":
+                agent_functions.append(worker_function)
 
+            for agent_function in agent_functions:
+                agent_function.add_environment("TRACE_BUCKET", trace_bucket.bucket_name)
+                agent_function.add_environment("TRACE_SAMPLE_RATE", str(self.node.try_get_context("trace_sample_rate") or "0.01"))
@@ -0,0 +1,323 @@
+import json
+import time
+import random
+import uuid
+import threading
+from contextlib import contextmanager
+
+from memory_store import ConditionalWriteError, create_memory_store
+from metrics import put_metric, MILLISECONDS, COUNT
+
+ADMISSION_STATE_ID = "admission#state"
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be queued or waited too long for a slot"""
+    pass
+
+
+def new_admission_state():
+    return {
+        "virtual_time": 0.0,
+        "finish_tags": {},
+        "running": {},
+        "waiting": []
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class AdmissionMetrics():
+    """Queue wait times and outcomes per tenant, aggregated in process"""
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.tenants = {}
+        self.lock = threading.Lock()
+
+    def record(self, tenant, outcome, wait_seconds):
+        with self.lock:
+            stats = self.tenants.setdefault(tenant, {"admitted": 0, "rejected": 0, "waits": []})
+            stats[outcome] += 1
+            if outcome == "admitted":
+                stats["waits"].append(wait_seconds)
+                # Keep a bounded window of recent samples
+                del stats["waits"][:-self.max_samples]
+
+        if outcome == "admitted":
+            put_metric("AdmissionQueueWait", wait_seconds * 1000, MILLISECONDS)
+        else:
+            put_metric("AdmissionRejections", 1, COUNT)
+
+    def snapshot(self):
+        """
+        Returns:
+        - (dict) Per tenant admitted and rejected counts and p50, p95 and max queue wait in milliseconds
+        """
+
+        with self.lock:
+            return {
+                tenant: {
+                    "admitted": stats["admitted"],
+                    "rejected": stats["rejected"],
+                    "queue_wait_p50_ms": round(percentile(stats["waits"], 0.5) * 1000, 1) if stats["waits"] else None,
+                    "queue_wait_p95_ms": round(percentile(stats["waits"], 0.95) * 1000, 1) if stats["waits"] else None,
+                    "queue_wait_max_ms": round(max(stats["waits"]) * 1000, 1) if stats["waits"] else None
+                }
+                for tenant, stats in self.tenants.items()
+            }
+
+
+class AdmissionController():
+    """
+    Admits agent runs with per-tenant concurrency limits and weighted fair
+    queuing between tenants. Waiting requests are ordered by virtual finish
+    tags (self-clocked fair queuing): every request of a tenant advances the
+    tenant's tag by 1/weight, so a tenant that queues a batch of questions
+    only delays other tenants by its fair share.
+
+    Subclasses keep the scheduler state and apply updates to it atomically.
+
+    Parameters:
+    - max_concurrency (int) The maximum number of runs across all tenants
+    - tenant_concurrency (int) The default maximum number of runs per tenant
+    - tenant_limits (dict) Per tenant overrides of tenant_concurrency
+    - tenant_weights (dict) Per tenant weights, default 1
+    - max_queue_depth (int) Requests beyond this many waiting are rejected right away
+    - max_tenant_queue_depth (int) The maximum number of waiting requests per tenant
+    - max_wait_seconds (float) Waiting requests are rejected after this long
+    - lease_seconds (float) Slots of runs that never released them are reclaimed after this long
+    """
+
+    def __init__(self, max_concurrency=10,
+                 tenant_concurrency=2,
+                 tenant_limits=None,
+                 tenant_weights=None,
+                 max_queue_depth=50,
+                 max_tenant_queue_depth=None,
+                 max_wait_seconds=300,
+                 lease_seconds=900,
+                 metrics=None):
+
+        self.max_concurrency = max_concurrency
+        self.tenant_concurrency = tenant_concurrency
+        self.tenant_limits = tenant_limits or {}
+        self.tenant_weights = tenant_weights or {}
+        self.max_queue_depth = max_queue_depth
+        self.max_tenant_queue_depth = max_tenant_queue_depth or max_queue_depth
+        self.max_wait_seconds = max_wait_seconds
+        self.lease_seconds = lease_seconds
+        self.metrics = metrics or AdmissionMetrics()
+
+    def update(self, function):
+        """Applies function to the state atomically and returns its result"""
+        raise NotImplementedError
+
+    def wait(self, seconds):
+        """Waits for the state to change, at most seconds"""
+        raise NotImplementedError
+
+    def tenant_limit(self, tenant):
+        return self.tenant_limits.get(tenant, self.tenant_concurrency)
+
+    def expire(self, state, now):
+        state["running"] = {ticket: slot for ticket, slot in state["running"].items() if slot["expires_at"] >= now}
+        state["waiting"] = [entry for entry in state["waiting"] if entry["expires_at"] >= now]
+
+    def grant(self, state, now):
+        """Moves waiting requests to running in finish tag order while there are free slots"""
+
+        running_by_tenant = {}
+        for slot in state["running"].values():
+            running_by_tenant[slot["tenant"]] = running_by_tenant.get(slot["tenant"], 0) + 1
+
+        while len(state["running"]) < self.max_concurrency:
+            eligible = [
+                entry for entry in state["waiting"]
+                if running_by_tenant.get(entry["tenant"], 0) < self.tenant_limit(entry["tenant"])
+            ]
+
+            if not eligible:
+                break
+
+            entry = min(eligible, key=lambda entry: (entry["tag"], entry["enqueued_at"]))
+            state["waiting"].remove(entry)
+            state["running"][entry["ticket"]] = {"tenant": entry["tenant"], "expires_at": now + self.lease_seconds}
+            state["virtual_time"] = max(state["virtual_time"], entry["tag"])
+            running_by_tenant[entry["tenant"]] = running_by_tenant.get(entry["tenant"], 0) + 1
+
+    def enqueue(self, state, ticket, tenant, now):
+        self.expire(state, now)
+
+        tenant_waiting = sum(1 for entry in state["waiting"] if entry["tenant"] == tenant)
+
+        if len(state["waiting"]) >= self.max_queue_depth or tenant_waiting >= self.max_tenant_queue_depth:
+            raise AdmissionRejected("The service is busy. Please try again later.")
+
+        weight = self.tenant_weights.get(tenant, 1)
+        tag = max(state["virtual_time"], state["finish_tags"].get(tenant, 0)) + 1 / weight
+        state["finish_tags"][tenant] = tag
+
+        state["waiting"].append({
+            "ticket": ticket,
+            "tenant": tenant,
+            "tag": tag,
+            "enqueued_at": now,
+            "expires_at": now + self.max_wait_seconds
+        })
+
+        self.grant(state, now)
+
+        return ticket in state["running"]
+
+    def poll(self, state, ticket, now):
+        self.expire(state, now)
+        self.grant(state, now)
+
+        # Tags of idle tenants are dropped to keep the state small
+        active_tenants = {entry["tenant"] for entry in state["waiting"]}
+        active_tenants.update(slot["tenant"] for slot in state["running"].values())
+        state["finish_tags"] = {
+            tenant: tag for tenant, tag in state["finish_tags"].items()
+            if tenant in active_tenants or tag > state["virtual_time"]
+        }
+
+        return ticket in state["running"]
+
+    def cancel(self, state, ticket, now):
+        state["waiting"] = [entry for entry in state["waiting"] if entry["ticket"] != ticket]
+        state["running"].pop(ticket, None)
+        self.grant(state, now)
+
+    @contextmanager
+    def admit(self, tenant, label=None):
+        """
+        Waits for a slot for the tenant and holds it for the duration of the block.
+        Metrics are recorded under label, default the tenant.
+
+        Raises:
+        - AdmissionRejected if the queue is full or the wait times out
+        """
+
+        ticket = str(uuid.uuid4())
+        label = label or tenant
+        start = time.time()
+
+        try:
+            admitted = self.update(lambda state: self.enqueue(state, ticket, tenant, time.time()))
+        except AdmissionRejected:
+            self.metrics.record(label, "rejected", 0)
+            raise
+
+        while not admitted:
+            if time.time() - start >= self.max_wait_seconds:
+                self.update(lambda state: self.cancel(state, ticket, time.time()))
+                self.metrics.record(label, "rejected", time.time() - start)
+                raise AdmissionRejected("Timed out waiting for capacity. Please try again later.")
+
+            self.wait(min(1.0, self.max_wait_seconds))
+            admitted = self.update(lambda state: self.poll(state, ticket, time.time()))
+
+        wait_seconds = time.time() - start
+        self.metrics.record(label, "admitted", wait_seconds)
+        print(f"Admitted tenant {label} after {wait_seconds * 1000:.0f} ms in queue")
+
+        try:
+            yield wait_seconds
+        finally:
+            self.release(ticket)
+
+    def release(self, ticket):
+        """Frees the slot of a finished run. Never raises, a slot that cannot be freed is reclaimed when its lease expires"""
+
+        try:
+            self.update(lambda state: self.cancel(state, ticket, time.time()))
+        except Exception as e:
+            print(f"Could not release admission slot {ticket}, it is reclaimed after {self.lease_seconds} s: {e}")
+
+    def run(self, tenant, function, label=None):
+        """Runs function once the tenant is admitted"""
+
+        with self.admit(tenant, label=label):
+            return function()
+
+
+class InMemoryAdmissionController(AdmissionController):
+    """Admission control for runs that share one process, e.g. the container server"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.state = new_admission_state()
+        self.condition = threading.Condition()
+
+    def update(self, function):
+        with self.condition:
+            result = function(self.state)
+            self.condition.notify_all()
+            return result
+
+    def wait(self, seconds):
+        with self.condition:
+            self.condition.wait(seconds)
+
+
+class StoreAdmissionController(AdmissionController):
+    """
+    Keeps the scheduler state in one item of a memory store, e.g. DynamoDB
+    shared by all Lambda invocations. Updates use optimistic concurrency on
+    the item version and waiting requests poll for their slot.
+    """
+
+    def __init__(self, store, poll_seconds=0.5, max_attempts=20, backoff_seconds=0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+    def update(self, function):
+        for attempt in range(self.max_attempts):
+            item = self.store.get_item(ADMISSION_STATE_ID)
+            state = json.loads(item["state"]) if item else new_admission_state()
+            version = int(item["version"]) if item else None
+
+            result = function(state)
+
+            # Most polls find nothing to change, skip the write on the shared item
+            encoded = json.dumps(state)
+            if item and encoded == item["state"]:
+                return result
+
+            try:
+                self.store.put_item(
+                    {
+                        "id": ADMISSION_STATE_ID,
+                        "state": encoded,
+                        "version": (version or 0) + 1
+                    },
+                    expected={"version": version}
+                )
+                return result
+            except ConditionalWriteError:
+                # Another invocation updated the state, back off with full jitter and apply the update again
+                time.sleep(random.uniform(0, self.backoff_seconds * 2 ** min(attempt, 6)))
+
+        raise AdmissionRejected("The admission state is too contended. Please try again later.")
+
+    def wait(self, seconds):
+        # Jitter keeps waiting invocations from polling the item in lockstep
+        time.sleep(min(seconds, self.poll_seconds) * random.uniform(0.5, 1.5))
+
+
+def create_admission_controller(backend=None, table_name=None, **kwargs):
+    """Creates an admission controller. backend is process, dynamodb, memory or sqlite"""
+
+    if backend == "process":
+        return InMemoryAdmissionController(**kwargs)
+
+    return StoreAdmissionController(create_memory_store(backend=backend, table_name=table_name), **kwargs)
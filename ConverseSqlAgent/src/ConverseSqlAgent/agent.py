@@ -3,20 +3,38 @@ import os
 import io
 import csv
 import json
-from time import sleep
+from time import sleep, perf_counter, time
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 from sqlalchemy import create_engine, text
 from datetime import datetime
 
 from prompts import ( DEFAULT_SYSTEM_PROMPT,
                      CURRENT_PLAN_PROMPT_TEMPLATE,
                      END_TURN_PROMPT,
-                     TOOL_GROUP_PROMPT_TEMPLATE
+                     TOOL_GROUP_PROMPT_TEMPLATE,
+                     DEFERRED_REFLECTION_PROMPT
                     )
 
+import tracing
+from metrics import put_metric, MILLISECONDS, COUNT
 from utils import extract_xml_content
+from memory_store import create_memory_store
+from memory_prefetch import prefetch_memory_context, STRUCTURED_MEMORY_TOOL_GROUP_NAME, MEMORY_TOOL_GROUP_NAME
+from reflection import build_run_transcript, build_reflection_prompt
+from checkpoints import RunSuspended
+from recording import TraceRecorder
+from cancellation import RunCancelled
+from events import ( NullEventSink,
+                     AnswerDeltaBuffer,
+                     RUN_STARTED,
+                     PLAN_EXTRACTED,
+                     TOOL_STARTED,
+                     TOOL_FINISHED,
+                     FINAL_ANSWER,
+                     RUN_CANCELLED
+                    )
 
 
 class BaseAgent():
@@ -26,7 +44,14 @@ class BaseAgent():
                  guardrail_id,
                  guardrail_version,
                  system_prompt_template=DEFAULT_SYSTEM_PROMPT,
-                 requests_per_minute_limit=None):
+                 requests_per_minute_limit=None,
+                 memory_backend=None,
+                 memory_store=None,
+                 event_sink=None,
+                 checkpoint_store=None,
+                 bedrock_client=None,
+                 trace_recorder=None,
+                 query_log=None):
         
         self.model_id = model_id
         self.guardrail_id = guardrail_id
@@ -36,15 +61,43 @@ class BaseAgent():
     
         # Tooling
         self.tool_spec_list = []
+        self.tool_group_names = []
         
         # System Prompt
         self.system_prompt_template = system_prompt_template
         self.system_current_plan = None
         
-        # Initialize clients and resources
-        self.bedrock = boto3.client("bedrock-runtime")
-        self.dynamodb = boto3.resource('dynamodb')
-        self.table = self.dynamodb.Table(memory_table_name)
+        # Initialize clients and resources. A long-running server shares one client across runs
+        self.bedrock = bedrock_client or boto3.client("bedrock-runtime")
+        
+        # Memory storage, selected by memory_backend or the MEMORY_BACKEND env var
+        if memory_store is None:
+            memory_store = create_memory_store(backend=memory_backend, table_name=memory_table_name)
+        self.memory_store = memory_store
+        
+        # Progress events for the caller, e.g. over the WebSocket connection
+        self.event_sink = event_sink or NullEventSink()
+        
+        # Messages of the last run, used for deferred reflection
+        self.last_run_messages = None
+        
+        # Run state is saved here after each turn when a run_id is given
+        self.checkpoint_store = checkpoint_store
+        
+        # Cancellation token of the current run, also checked by long-running tools
+        self.cancellation_token = None
+        
+        # Records the model and tool calls of each run for replay, see recording.TraceRecorder
+        self.trace_recorder = trace_recorder
+        
+        # Logs the SQL statements of every run with their statistics, see query_log.QueryLog
+        self.query_log = query_log
+        
+        # Query log statistics read by the current run, each query shape is read once per run
+        self.query_stats = {}
+        
+        # The question of the current run, logged with its SQL statements
+        self.current_question = None
         
         # Used for timing
         self.start_time = None
@@ -52,37 +105,146 @@ class BaseAgent():
         
 
             
+    @tracing.traced("agent.invoke")
     def invoke_agent(self, input_text, 
                      temperature=0.5, 
-                     max_tokens=4096, max_retries=3):
-    
-        # Initialize message list
-        # TODO implement session history retrieval
-        messages = []
-        
-        # Get the timestamp chunk to append to the message 
-        # Making the agent run time aware
-        self.start_time = datetime.now()
-        timestamp_chunk = self.create_timestamp_content_block(start_time=self.start_time)        
-                
-        initial_user_message = {
-            "role": "user",
-            "content": [
-                {
-                    "text": input_text
-                },
-                timestamp_chunk
-            ]
+                     max_tokens=4096, max_retries=3,
+                     prefetch_memory=False,
+                     prefetch_token_budget=2000,
+                     pinned_memory_titles=None,
+                     pinned_memory_ids=None,
+                     defer_reflection=False,
+                     stream=False,
+                     history=None,
+                     run_id=None,
+                     deadline=None,
+                     resume_state=None,
+                     cancellation_token=None):
+        """
+        Runs the agent loop until it produces a final response
+        
+        Parameters:
+        - input_text (str) The user's question
+        - history (List[dict]) Messages of earlier questions in the session
+        - run_id (str) Checkpoints the run after each turn when a checkpoint store is set
+        - deadline (float) Epoch seconds after which the run is checkpointed and RunSuspended is raised
+        - resume_state (dict) A checkpoint to continue from, see resume_agent
+        - cancellation_token (CancellationToken) RunCancelled is raised between turns once it is cancelled
+        
+        Returns:
+        - (str) The final response
+        """
+        
+        self.cancellation_token = cancellation_token
+        self.current_question = input_text
+        self.query_stats = {}
+        
+        # Parameters restored when a suspended run is resumed
+        run_parameters = {
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "max_retries": max_retries,
+            "defer_reflection": defer_reflection,
+            "stream": stream
         }
         
-        messages.append(initial_user_message)
+        if resume_state:
+            # Continue a checkpointed run where it stopped
+            messages = resume_state["messages"]
+            turn = resume_state["turn"]
+            self.system_current_plan = resume_state["current_plan"]
+            self.requests_per_minute_limit = resume_state["requests_per_minute_limit"]
+            self.start_time = datetime.fromisoformat(resume_state["start_time"])
+            
+            # Continue the trace of a recorded run that was suspended
+            if resume_state.get("trace") is not None:
+                self.trace_recorder = TraceRecorder.from_dict(resume_state["trace"])
+            
+            print(f"Resuming run {run_id} at turn {turn}")
+            
+            # The run stopped before the tools of the last turn returned
+            if messages[-1]["role"] == "assistant" and any("toolUse" in chunk for chunk in messages[-1]["content"]):
+                messages.append(self.handle_tool_use(message=messages[-1]))
+        else:
+            # Initialize message list with the session history, if any
+            messages = list(history) if history else []
+            turn = 0
+            
+            # Get the timestamp chunk to append to the message 
+            # Making the agent run time aware
+            self.start_time = datetime.now()
+            timestamp_chunk = self.create_timestamp_content_block(start_time=self.start_time)        
+                    
+            initial_user_message = {
+                "role": "user",
+                "content": [
+                    {
+                        "text": input_text
+                    },
+                    timestamp_chunk
+                ]
+            }
+            
+            # Read the memories the model reads first, from the memory tool group it was given
+            memory_tool_group_name = self.get_memory_tool_group_name()
+            if prefetch_memory and memory_tool_group_name:
+                try:
+                    memory_context = prefetch_memory_context(
+                        self.memory_store,
+                        tool_group_name=memory_tool_group_name,
+                        pinned_memory_titles=pinned_memory_titles,
+                        pinned_memory_ids=pinned_memory_ids,
+                        token_budget=prefetch_token_budget
+                    )
+                    if memory_context:
+                        initial_user_message["content"].append({"text": memory_context})
+                except Exception as e:
+                    print(f"Memory prefetch failed: {e}")
+            
+            messages.append(initial_user_message)
+            
+            print(f"User: {input_text}")
+            self.event_sink.emit(RUN_STARTED, input_text=input_text)
+            
+            if self.trace_recorder is not None:
+                self.trace_recorder.start_run(self.model_id, input_text)
         
-        print(f"User: {input_text}")
         print("Beginning execution loop")
         
-        # Begin main loop
+        # Begin main loop. The span of the last turn is ended with the run's span
+        turn_span = tracing.NOOP_SPAN
         runMainLoop = True
         while runMainLoop:
+            turn_span.end()
+            
+            # Stop spending tokens and database time on a run the user has abandoned
+            if self.is_cancelled():
+                print(f"Run cancelled at turn {turn}")
+                self.system_current_plan = None
+                self.delete_checkpoint(run_id)
+                self.event_sink.emit(RUN_CANCELLED, turn=turn)
+                raise RunCancelled(self.cancellation_token.key)
+            
+            # One checkpoint per turn, with the tool results of the previous turn
+            checkpointed = self.save_checkpoint(run_id, input_text, messages, turn, run_parameters)
+            
+            # Stop before the next turn if the invocation is running out of time
+            if deadline is not None and time() >= deadline:
+                if self.checkpoint_store is None or run_id is None:
+                    raise ValueError("A deadline requires a checkpoint store and a run_id")
+                if checkpointed:
+                    # The recording continues in the resumed run. It is only saved on suspension,
+                    # the trace holds all tool outputs and is too large to rewrite every turn
+                    if self.trace_recorder is not None and self.save_checkpoint(run_id, input_text, messages, turn, run_parameters,
+                                                                                trace=self.trace_recorder.to_dict()):
+                        self.trace_recorder = None
+                    print(f"Suspending run {run_id} at turn {turn}")
+                    raise RunSuspended(run_id)
+                # Resuming from an older checkpoint would repeat the turns that could not be saved
+                print(f"Run {run_id} is not resumable, continuing past its deadline")
+            
+            turn += 1
+            turn_span = tracing.span("agent.turn", turn=turn)
             
             # Limit how fast the agent executes
             if self.requests_per_minute_limit:
@@ -94,6 +256,10 @@ class BaseAgent():
                 current_plan_prompt=CURRENT_PLAN_PROMPT_TEMPLATE.format(current_plan=self.system_current_plan)
             )
             
+            # Keep memory housekeeping off the critical path
+            if defer_reflection:
+                system_prompt += DEFERRED_REFLECTION_PROMPT
+            
             #Invoke the Converse API
             
             current_retry_count = 0
@@ -103,21 +269,50 @@ class BaseAgent():
                     print("Invoking converse API")
                     print("Guardrail id = " + self.guardrail_id)
                     print("Guardrail version = " + self.guardrail_version)
-                    response = self.bedrock.converse(
-                        modelId=self.model_id,
-                        messages=messages,
-                        toolConfig=self.get_tool_config(),
-                        system=[{"text": system_prompt}],
-                        inferenceConfig={
+                    converse_request = {
+                        "modelId": self.model_id,
+                        "messages": messages,
+                        "toolConfig": self.get_tool_config(),
+                        "system": [{"text": system_prompt}],
+                        "inferenceConfig": {
                             "maxTokens": max_tokens,
                             "temperature": temperature
                         },
-                        guardrailConfig={
+                        "guardrailConfig": {
                             "guardrailIdentifier": self.guardrail_id,
                             "guardrailVersion": self.guardrail_version,
                             "trace": "enabled"
                         },
-                    )
+                    }
+                    
+                    converse_start_time = perf_counter()
+                    
+                    with tracing.span("bedrock.converse", model_id=self.model_id, stream=stream, attempt=current_retry_count + 1) as converse_span:
+                        if stream:
+                            response = self.converse_streaming(converse_request)
+                        else:
+                            response = self.bedrock.converse(**converse_request)
+                        
+                        if converse_span.recording:
+                            usage = response.get("usage", {})
+                            converse_span.set_attributes(
+                                stop_reason=response.get("stopReason"),
+                                input_tokens=usage.get("inputTokens"),
+                                output_tokens=usage.get("outputTokens"),
+                                cache_read_tokens=usage.get("cacheReadInputTokens"),
+                                messages=len(messages)
+                            )
+                    
+                    converse_seconds = perf_counter() - converse_start_time
+                    usage = response.get("usage", {})
+                    put_metric("ConverseLatency", converse_seconds * 1000, MILLISECONDS)
+                    put_metric("InputTokens", usage.get("inputTokens"), COUNT)
+                    put_metric("OutputTokens", usage.get("outputTokens"), COUNT)
+                    put_metric("CacheReadTokens", usage.get("cacheReadInputTokens"), COUNT)
+                    put_metric("CacheWriteTokens", usage.get("cacheWriteInputTokens"), COUNT)
+                    
+                    if self.trace_recorder is not None:
+                        self.trace_recorder.record_converse(converse_request, response, converse_seconds)
                     
                     break
                 except ClientError as e:
@@ -126,23 +321,34 @@ class BaseAgent():
                     
                     print(f"Encountered error: {e}")
 
-                    if current_retry_count >= max_retries:
+                    if current_retry_count + 1 >= max_retries:
                         print(f"Exceeded max retry. Encountered error: {e}")
                         raise(e)
                     else:
                         print(f"Retrying. Encountered error: {e}")
                         
                         if error_code == "ThrottlingException":
-                            # Reduce RPM limit by 10%
-                            self.requests_per_minute_limit = self.requests_per_minute_limit * 0.9
-                            print(f"ThrottlingException. Reducing RPM limit. New Value: {self.requests_per_minute_limit}")
-                            sleep(60/self.requests_per_minute_limit)
+                            put_metric("ConverseThrottles", 1, COUNT)
+                            if self.requests_per_minute_limit:
+                                # Reduce RPM limit by 10%
+                                self.requests_per_minute_limit = self.requests_per_minute_limit * 0.9
+                                print(f"ThrottlingException. Reducing RPM limit. New Value: {self.requests_per_minute_limit}")
+                                sleep(60/self.requests_per_minute_limit)
+                            else:
+                                # No limit to lower, back off exponentially
+                                sleep(min(2 ** current_retry_count, 30))
                         
                         current_retry_count +=1 
                 except BotoCoreError as e:
                     print("❌ Low-level BotoCore error:", str(e))
+                    current_retry_count += 1
+                    if current_retry_count >= max_retries:
+                        raise
                 except Exception as e:
                     print("❌ Unexpected error:", str(e))
+                    current_retry_count += 1
+                    if current_retry_count >= max_retries:
+                        raise
 
             # Check if guardrail denied the response
             if "output" in response:
@@ -152,12 +358,15 @@ class BaseAgent():
                         print("Text from converse is: " + content["text"])
                         output_text = content["text"]
                         if content["text"] == self.blocked_input_messaging or content["text"] == self.blocked_outputs_messaging:
-                            return content["text"]
+                            put_metric("GuardrailBlocks", 1, COUNT)
+                            return self.finish_run(run_id, messages, turn, content["text"])
                  # If guardrail blocked the output, Bedrock may return empty or filtered text
                 if not output_text.strip():
-                    return "Your request was blocked by safety filters."
+                    put_metric("GuardrailBlocks", 1, COUNT)
+                    return self.finish_run(run_id, messages, turn, "Your request was blocked by safety filters.")
             else:
-                return "Your request was blocked by safety filters."
+                put_metric("GuardrailBlocks", 1, COUNT)
+                return self.finish_run(run_id, messages, turn, "Your request was blocked by safety filters.")
 
             #Append the AI message to the memory list
             messages.append(response["output"]["message"])
@@ -168,6 +377,7 @@ class BaseAgent():
                     current_plan = extract_xml_content(chunk["text"], "current_plan")
                     if current_plan:
                         self.system_current_plan = current_plan
+                        self.event_sink.emit(PLAN_EXTRACTED, plan=current_plan)
             
             # Handle stopReasons
             if response["stopReason"] == "tool_use":
@@ -186,12 +396,7 @@ class BaseAgent():
                 else:
                     final_response = extract_xml_content(messages[-1]['content'][0]['text'], "final_response")
                     if final_response:
-                        
-                        # Reset the system prompt
-                        self.system_prompt_template = DEFAULT_SYSTEM_PROMPT
-                        self.system_current_plan = None
-                        
-                        return final_response
+                        return self.finish_run(run_id, messages, turn, final_response)
                     else:
                         messages.append({
                             "role": "user",
@@ -203,6 +408,192 @@ class BaseAgent():
                         })
                 
                 
+    def finish_run(self, run_id, messages, turn, result):
+        """Ends a run that delivers result, the final response or a guardrail message, and returns result"""
+        
+        # Reset the current plan. The template keeps the tool group
+        # instructions so the agent can be invoked again
+        self.system_current_plan = None
+        self.last_run_messages = messages
+        
+        self.delete_checkpoint(run_id)
+        
+        self.event_sink.emit(FINAL_ANSWER, result=result)
+        put_metric("Turns", turn, COUNT)
+        
+        if self.trace_recorder is not None:
+            self.trace_recorder.finish_run(result)
+        
+        return result
+    
+    def is_cancelled(self):
+        """Returns True if the current run was cancelled"""
+        
+        return self.cancellation_token is not None and self.cancellation_token.is_cancelled()
+    
+    def save_checkpoint(self, run_id, input_text, messages, turn, run_parameters, trace=None):
+        """
+        Saves the state of the run, if checkpointing is enabled. A failed save
+        is logged and leaves the run going, only its last turns are not resumable.
+        trace is the state of the trace recorder, restored when the run is resumed.
+        
+        Returns:
+        - (bool) True if the state was saved
+        """
+        
+        if self.checkpoint_store is None or run_id is None:
+            return False
+        
+        state = {
+            "run_id": run_id,
+            "input_text": input_text,
+            "messages": messages,
+            "turn": turn,
+            "current_plan": self.system_current_plan,
+            "requests_per_minute_limit": self.requests_per_minute_limit,
+            "start_time": self.start_time.isoformat(),
+            "parameters": run_parameters
+        }
+        if trace is not None:
+            state["trace"] = trace
+        
+        try:
+            self.checkpoint_store.save(run_id, state)
+            return True
+        except Exception as e:
+            print(f"Failed to checkpoint run {run_id} at turn {turn}: {e}")
+            return False
+    
+    def delete_checkpoint(self, run_id):
+        """Deletes the checkpoint of a finished or cancelled run, it expires anyway if this fails"""
+        
+        if self.checkpoint_store is None or run_id is None:
+            return
+        
+        try:
+            self.checkpoint_store.delete(run_id)
+        except Exception as e:
+            print(f"Failed to delete the checkpoint of run {run_id}: {e}")
+    
+    def resume_agent(self, run_id, **kwargs):
+        """
+        Continues a checkpointed run, e.g. after RunSuspended or a failed invocation
+        
+        Parameters:
+        - run_id (str) The id of the run
+        - kwargs Passed to invoke_agent, e.g. a new deadline
+        
+        Returns:
+        - (str) The final response
+        """
+        
+        state = self.checkpoint_store.load(run_id)
+        
+        if state is None:
+            raise ValueError(f"No checkpoint found for run {run_id}")
+        
+        parameters = {**state["parameters"], **kwargs}
+        
+        return self.invoke_agent(state["input_text"], run_id=run_id, resume_state=state, **parameters)
+    
+    def converse_streaming(self, converse_request):
+        """
+        Calls the ConverseStream API, emitting text deltas as they arrive, and
+        assembles the stream into the same shape as a Converse API response
+        
+        Parameters:
+        - converse_request (dict) The Converse API request
+        
+        Returns:
+        - response (dict) The assembled response with output, stopReason and usage
+        """
+        
+        request = dict(converse_request)
+        request["guardrailConfig"] = {**request["guardrailConfig"], "streamProcessingMode": "sync"}
+        
+        stream_response = self.bedrock.converse_stream(**request)
+        
+        role = "assistant"
+        blocks = {}
+        stop_reason = None
+        usage = {}
+        
+        # Send the text in batches rather than one event per token
+        deltas = AnswerDeltaBuffer(self.event_sink)
+        
+        for event in stream_response["stream"]:
+            if "messageStart" in event:
+                role = event["messageStart"]["role"]
+            
+            elif "contentBlockStart" in event:
+                start = event["contentBlockStart"]["start"]
+                index = event["contentBlockStart"]["contentBlockIndex"]
+                if "toolUse" in start:
+                    blocks[index] = {"toolUse": {**start["toolUse"], "input": ""}}
+            
+            elif "contentBlockDelta" in event:
+                delta = event["contentBlockDelta"]["delta"]
+                index = event["contentBlockDelta"]["contentBlockIndex"]
+                
+                if "text" in delta:
+                    blocks.setdefault(index, {"text": ""})["text"] += delta["text"]
+                    deltas.add(delta["text"])
+                elif "toolUse" in delta:
+                    blocks[index]["toolUse"]["input"] += delta["toolUse"]["input"]
+            
+            elif "contentBlockStop" in event:
+                deltas.flush()
+            
+            elif "messageStop" in event:
+                stop_reason = event["messageStop"]["stopReason"]
+            
+            elif "metadata" in event:
+                usage = event["metadata"].get("usage", {})
+        
+        deltas.flush()
+        
+        content = []
+        for index in sorted(blocks):
+            block = blocks[index]
+            if "toolUse" in block:
+                block["toolUse"]["input"] = json.loads(block["toolUse"]["input"] or "{}")
+            content.append(block)
+        
+        return {
+            "output": {
+                "message": {
+                    "role": role,
+                    "content": content
+                }
+            },
+            "stopReason": stop_reason,
+            "usage": usage
+        }
+    
+    def reflect_on_run(self, messages=None, final_response=None, transcript=None, **kwargs):
+        """
+        Runs the agent over the transcript of a finished run so it can update
+        its memory with learnings after the answer has been delivered
+        
+        Parameters:
+        - messages (List[dict]) The messages of the run. Defaults to the last run
+        - final_response (str) The final response that was delivered
+        - transcript (str) A prebuilt transcript, used instead of messages
+        
+        Returns:
+        - (str) The agent's summary of the memory updates
+        """
+        
+        if transcript is None:
+            messages = messages if messages is not None else self.last_run_messages
+            if not messages:
+                return None
+            transcript = build_run_transcript(messages)
+        
+        print("Beginning deferred reflection")
+        
+        return self.invoke_agent(build_reflection_prompt(transcript, final_response), **kwargs)
+    
     def create_timestamp_content_block(self, start_time, current_time=None):
         "Returns a timestamp content block"
         
@@ -259,10 +650,19 @@ class BaseAgent():
         )
         
         self.system_prompt_template += (tool_group_prompt)
+        self.tool_group_names.append(tool_group["tool_group_name"])
     
     def get_tools(self):
         return self.tool_spec_list
     
+    def get_memory_tool_group_name(self):
+        """Returns the name of the registered memory tool group that can be prefetched, or None"""
+        
+        for name in (STRUCTURED_MEMORY_TOOL_GROUP_NAME, MEMORY_TOOL_GROUP_NAME):
+            if name in self.tool_group_names:
+                return name
+        return None
+    
     def get_tool_config(self):
         return {
                 "tools": self.tool_spec_list
@@ -335,20 +735,47 @@ class BaseAgent():
                 print(f"Tool Use: {tool_name}")
                 print(f"Parameters: {parameters}")
                 
+                self.event_sink.emit(TOOL_STARTED, tool_use_id=tool_use_id, tool_name=tool_name, input=parameters)
+                tool_start_time = perf_counter()
+                tool_error = False
+                
                 # Default message
                 tool_result = f"Tool {tool_name} is not supported."
                 
+                # Skip the remaining tools of a cancelled run
+                if self.is_cancelled():
+                    tool_result = "The run was cancelled."
+                
                 # Call the appropriate tool
                 for tool_spec in self.tool_spec_list:
-                    if tool_name == tool_spec["toolSpec"]["name"]:
+                    if tool_name == tool_spec["toolSpec"]["name"] and not self.is_cancelled():
                         # Retrieve the method
                         tool = getattr(self, tool_name)
                         
                         # Call the method
-                        try:
-                            tool_result = tool(**parameters)
-                        except Exception as e:
-                            tool_result = f"Error occurred when calling {tool_name}: {e}"
+                        with tracing.span("tool", tool_name=tool_name) as tool_span:
+                            try:
+                                tool_result = tool(**parameters)
+                            except Exception as e:
+                                tool_result = f"Error occurred when calling {tool_name}: {e}"
+                                tool_error = True
+                            tool_span.set_attribute("error", tool_error)
+                
+                self.event_sink.emit(
+                    TOOL_FINISHED,
+                    tool_use_id=tool_use_id,
+                    tool_name=tool_name,
+                    duration_ms=round((perf_counter() - tool_start_time) * 1000, 1),
+                    error=tool_error
+                )
+                
+                put_metric("ToolLatency", (perf_counter() - tool_start_time) * 1000, MILLISECONDS, ToolName=tool_name)
+                put_metric("ToolErrors", int(tool_error), COUNT, ToolName=tool_name)
+                
+                if self.trace_recorder is not None:
+                    self.trace_recorder.record_tool(
+                        tool_use_id, tool_name, parameters, str(tool_result), tool_error, perf_counter() - tool_start_time
+                    )
                 
                 #Print the result, limit character output
                 print(f"Tool Result: {str(tool_result)[:100]}")
@@ -0,0 +1,141 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from memory_store import create_memory_store
+
+
+class RunCancelled(Exception):
+    """Raised by invoke_agent when the run was cancelled by the user"""
+
+    def __init__(self, run_key):
+        super().__init__(f"Run {run_key} was cancelled")
+        self.run_key = run_key
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class CancellationFlags():
+    """
+    Records cancel requests. A cancel request cancels every run of the key
+    (the session id or connection id) that started before it, so a new
+    question sent right after the cancel is not affected.
+    """
+
+    def cancel(self, key):
+        raise NotImplementedError
+
+    def cancelled_at(self, key):
+        """Returns the time of the last cancel request in epoch milliseconds, or None"""
+        raise NotImplementedError
+
+
+class MemoryStoreCancellationFlags(CancellationFlags):
+    """Keeps cancel requests in any memory store backend, e.g. DynamoDB shared by all invocations"""
+
+    def __init__(self, store, ttl_seconds=3600):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+
+    def cancel(self, key):
+        self.store.put_item(
+            {
+                "id": f"cancel#{key}",
+                "cancelled_at": now_ms(),
+                "expires_at": int(time.time()) + self.ttl_seconds
+            }
+        )
+
+    def cancelled_at(self, key):
+        item = self.store.get_item(f"cancel#{key}")
+        return int(item["cancelled_at"]) if item else None
+
+
+class InProcessCancellationFlags(CancellationFlags):
+    """Local stand-in for runs that share one process"""
+
+    def __init__(self):
+        self.flags = {}
+        self.lock = threading.Lock()
+
+    def cancel(self, key):
+        with self.lock:
+            self.flags[key] = now_ms()
+
+    def cancelled_at(self, key):
+        with self.lock:
+            return self.flags.get(key)
+
+
+class CancellationToken():
+    """
+    Checked by the agent between turns and by long-running tools
+
+    Parameters:
+    - flags (CancellationFlags) Where cancel requests are recorded
+    - key (str) The session id or connection id of the run
+    - started_at (int) When the run was requested, in epoch milliseconds
+    - poll_seconds (float) The minimum time between reads of the flags
+    """
+
+    def __init__(self, flags, key, started_at=None, poll_seconds=1.0):
+        self.flags = flags
+        self.key = key
+        self.started_at = started_at if started_at is not None else now_ms()
+        self.poll_seconds = poll_seconds
+        self.cancelled = False
+        self.last_checked = 0
+
+    def is_cancelled(self):
+        # Once cancelled a run stays cancelled, and reads are throttled
+        if self.cancelled or time.monotonic() - self.last_checked < self.poll_seconds:
+            return self.cancelled
+
+        self.last_checked = time.monotonic()
+
+        try:
+            cancelled_at = self.flags.cancelled_at(self.key)
+        except Exception as e:
+            print(f"Failed to read the cancellation flag of {self.key}: {e}")
+            return False
+
+        self.cancelled = cancelled_at is not None and cancelled_at >= self.started_at
+
+        return self.cancelled
+
+    @contextmanager
+    def watch(self, on_cancel):
+        """
+        Calls on_cancel from a background thread if the run is cancelled
+        while the block runs, e.g. to cancel an in-flight SQL query
+        """
+
+        finished = threading.Event()
+
+        def poll():
+            while not finished.wait(self.poll_seconds):
+                if self.is_cancelled():
+                    try:
+                        on_cancel()
+                    except Exception as e:
+                        print(f"Cancel callback failed: {e}")
+                    return
+
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            finished.set()
+
+
+def create_cancellation_flags(backend=None, table_name=None, **kwargs):
+    """Creates cancellation flags on the configured store backend (dynamodb, memory, sqlite or process)"""
+
+    if backend == "process":
+        return InProcessCancellationFlags()
+
+    return MemoryStoreCancellationFlags(create_memory_store(backend=backend, table_name=table_name), **kwargs)
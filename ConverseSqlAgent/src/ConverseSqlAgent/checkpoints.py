@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import threading
+
+from sessions import encode_messages, decode_messages
+from memory_store import create_memory_store
+
+
+class RunSuspended(Exception):
+    """
+    Raised by invoke_agent when the run reaches its deadline. The run state
+    was checkpointed and can be resumed with BaseAgent.resume_agent(run_id).
+    """
+
+    def __init__(self, run_id):
+        super().__init__(f"Run {run_id} was suspended and checkpointed")
+        self.run_id = run_id
+
+
+class CheckpointStore():
+    """
+    Stores the state of an agent run after each turn: the messages, current
+    plan, budgets and the original request parameters.
+    """
+
+    def save(self, run_id, state):
+        raise NotImplementedError
+
+    def load(self, run_id):
+        """Returns the state of the run or None"""
+        raise NotImplementedError
+
+    def delete(self, run_id):
+        raise NotImplementedError
+
+
+class CheckpointTooLarge(Exception):
+    """Raised when the messages of a turn or the rest of the state do not fit in one item"""
+    pass
+
+
+class MemoryStoreCheckpointStore(CheckpointStore):
+    """
+    Keeps checkpoints as gzipped items in any memory store backend. The
+    messages only grow during a run, so each save appends the messages added
+    since the previous save as a new part item ("checkpoint#<run_id>#<n>")
+    and rewrites the small head item that holds the rest of the state and the
+    number of parts. The bytes written per turn stay proportional to the turn.
+    The trace of a suspended run can be larger than one item, so it is split
+    over its own part items ("checkpoint#<run_id>#trace#<n>").
+    Items expire after ttl_seconds (DynamoDB TTL attribute "expires_at").
+
+    Parameters:
+    - store (MemoryStore) Any memory store backend
+    - ttl_seconds (int) How long a checkpoint is kept
+    - max_item_bytes (int) The largest part that is written, below the DynamoDB item limit (400 KB)
+    """
+
+    def __init__(self, store, ttl_seconds=24 * 3600, max_item_bytes=350 * 1024):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.max_item_bytes = max_item_bytes
+
+        # run_id -> (number of messages saved, number of parts, number of trace parts)
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def save(self, run_id, state):
+        state = dict(state)
+        messages = state.pop("messages")
+        trace = state.pop("trace", None)
+
+        with self.lock:
+            saved_messages, parts, trace_parts = self.progress.get(run_id, (0, 0, 0))
+
+        # A run that starts over with the same id rewrites its parts
+        if saved_messages > len(messages):
+            saved_messages, parts = 0, 0
+
+        expires_at = int(time.time()) + self.ttl_seconds
+
+        if len(messages) > saved_messages:
+            data = encode_messages(messages[saved_messages:])
+            if len(data) > self.max_item_bytes:
+                raise CheckpointTooLarge(f"The messages of turn {state.get('turn')} take {len(data)} bytes")
+
+            self.store.put_item(
+                {
+                    "id": f"checkpoint#{run_id}#{parts}",
+                    "messages": data,
+                    "expires_at": expires_at
+                }
+            )
+            saved_messages, parts = len(messages), parts + 1
+
+        head = encode_messages(state)
+        if len(head) > self.max_item_bytes:
+            raise CheckpointTooLarge(f"The state of turn {state.get('turn')} takes {len(head)} bytes")
+
+        previous_trace_parts = trace_parts
+        if trace is not None:
+            data = encode_messages(trace)
+            chunks = [data[start:start + self.max_item_bytes] for start in range(0, len(data), self.max_item_bytes)]
+            for n, chunk in enumerate(chunks):
+                self.store.put_item(
+                    {
+                        "id": f"checkpoint#{run_id}#trace#{n}",
+                        "trace": chunk,
+                        "expires_at": expires_at
+                    }
+                )
+            trace_parts = len(chunks)
+        else:
+            trace_parts = 0
+
+        self.store.put_item(
+            {
+                "id": f"checkpoint#{run_id}",
+                "state": head,
+                "parts": parts,
+                "trace_parts": trace_parts,
+                "expires_at": expires_at
+            }
+        )
+
+        # The trace only belongs to the head it was saved with, e.g. a resumed run continues it in memory
+        for n in range(trace_parts, previous_trace_parts):
+            self.store.delete_item(f"checkpoint#{run_id}#trace#{n}")
+
+        with self.lock:
+            self.progress[run_id] = (saved_messages, parts, trace_parts)
+
+    def load(self, run_id):
+        item = self.store.get_item(f"checkpoint#{run_id}")
+        if not item:
+            return None
+
+        state = decode_messages(item["state"])
+
+        messages = []
+        for n in range(int(item["parts"])):
+            part = self.store.get_item(f"checkpoint#{run_id}#{n}")
+            if part is None:
+                print(f"Checkpoint of run {run_id} is missing part {n}")
+                return None
+            messages.extend(decode_messages(part["messages"]))
+
+        trace_parts = int(item.get("trace_parts") or 0)
+        if trace_parts:
+            chunks = [self.store.get_item(f"checkpoint#{run_id}#trace#{n}") for n in range(trace_parts)]
+            if all(chunks):
+                state["trace"] = decode_messages("".join(chunk["trace"] for chunk in chunks))
+            else:
+                print(f"Checkpoint of run {run_id} is missing part of its trace, the recording is not continued")
+
+        with self.lock:
+            self.progress[run_id] = (len(messages), int(item["parts"]), trace_parts)
+
+        return {**state, "messages": messages}
+
+    def delete(self, run_id):
+        item = self.store.get_item(f"checkpoint#{run_id}")
+
+        if item:
+            for n in range(int(item["parts"])):
+                self.store.delete_item(f"checkpoint#{run_id}#{n}")
+            for n in range(int(item.get("trace_parts") or 0)):
+                self.store.delete_item(f"checkpoint#{run_id}#trace#{n}")
+            self.store.delete_item(f"checkpoint#{run_id}")
+
+        with self.lock:
+            self.progress.pop(run_id, None)
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Local stand-in that keeps one JSON file per run"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, run_id):
+        return os.path.join(self.directory, f"{run_id}.json")
+
+    def save(self, run_id, state):
+        # Write then rename so a crash never leaves a partial checkpoint
+        temporary_path = self.path(run_id) + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(state, f, default=str)
+        os.replace(temporary_path, self.path(run_id))
+
+    def load(self, run_id):
+        try:
+            with open(self.path(run_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, run_id):
+        try:
+            os.remove(self.path(run_id))
+        except FileNotFoundError:
+            pass
+
+
+def create_checkpoint_store(backend=None, table_name=None, directory=None):
+    """
+    Creates a checkpoint store. backend is dynamodb, memory, sqlite or file
+    """
+
+    if backend == "file":
+        return FileCheckpointStore(directory or os.environ.get("CHECKPOINT_DIRECTORY", "/tmp/agent_checkpoints"))
+
+    return MemoryStoreCheckpointStore(create_memory_store(backend=backend, table_name=table_name))
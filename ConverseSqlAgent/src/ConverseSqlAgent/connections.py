@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import tracing
+
+# API Gateway management clients, one per WebSocket endpoint
+_management_clients = {}
+
+
+def get_management_client(domain_name, stage):
+    """Returns a cached API Gateway management client for the WebSocket endpoint"""
+
+    endpoint_url = f'https://{domain_name}/{stage}'
+
+    if endpoint_url not in _management_clients:
+        _management_clients[endpoint_url] = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+
+    return _management_clients[endpoint_url]
+
+
+def post_to_connection(client, connection_id, data):
+    """
+    Sends data to a single connection
+
+    Returns:
+    - (bool) False if the connection is gone, True if the message was sent
+    """
+
+    try:
+        client.post_to_connection(ConnectionId=connection_id, Data=data)
+        return True
+    except client.exceptions.GoneException:
+        return False
+
+
+def iter_connection_ids(table, page_size=500):
+    """Yields every connection id in the connections table, following scan pagination"""
+
+    scan_kwargs = {
+        'ProjectionExpression': 'connectionId',
+        'Limit': page_size
+    }
+
+    while True:
+        with tracing.span("dynamodb.scan", table=table.name) as span:
+            response = table.scan(**scan_kwargs)
+            span.set_attribute("items", len(response.get('Items', [])))
+
+        for item in response.get('Items', []):
+            yield item['connectionId']
+
+        if 'LastEvaluatedKey' not in response:
+            break
+
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_connections(table, connection_ids):
+    """Deletes stale connections in batches"""
+
+    if not connection_ids:
+        return
+
+    with table.batch_writer() as batch:
+        for connection_id in connection_ids:
+            batch.delete_item(Key={'connectionId': connection_id})
+
+
+def broadcast(client, table, data, max_workers=16):
+    """
+    Sends data to every connection concurrently and removes the stale ones
+
+    Parameters:
+    - client The API Gateway management client
+    - table The connections DynamoDB table
+    - data (str or List[str]) The message to send, or its frames
+    - max_workers (int) The maximum number of concurrent sends
+
+    Returns:
+    - (dict) Counts of sent, stale and failed connections
+    """
+
+    frames = [data] if isinstance(data, str) else data
+
+    def send(connection_id):
+        try:
+            for frame in frames:
+                if not post_to_connection(client, connection_id, frame):
+                    return connection_id, False
+            return connection_id, True
+        except Exception as e:
+            print(f"Failed to send to connection {connection_id}: {e}")
+            return connection_id, None
+
+    stale_connection_ids = []
+    sent = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for connection_id, delivered in executor.map(send, iter_connection_ids(table)):
+            if delivered:
+                sent += 1
+            elif delivered is False:
+                stale_connection_ids.append(connection_id)
+            else:
+                failed += 1
+
+    delete_connections(table, stale_connection_ids)
+
+    return {
+        "sent": sent,
+        "stale": len(stale_connection_ids),
+        "failed": failed
+    }
@@ -0,0 +1,117 @@
+import threading
+from time import monotonic
+from datetime import datetime
+
+from framing import send_framed
+
+# Progress event types emitted by BaseAgent.invoke_agent
+RUN_STARTED = "run_started"
+PLAN_EXTRACTED = "plan_extracted"
+TOOL_STARTED = "tool_started"
+TOOL_FINISHED = "tool_finished"
+ANSWER_DELTA = "answer_delta"
+FINAL_ANSWER = "final_answer"
+RUN_CANCELLED = "run_cancelled"
+
+
+class EventSink():
+    """
+    Receives progress events from the agent. Sinks must never raise into the
+    agent loop, so emit() swallows and logs errors from send().
+    """
+
+    def __init__(self, event_types=None):
+        # Only these event types are sent when set
+        self.event_types = set(event_types) if event_types else None
+
+    def emit(self, event_type, **data):
+        if self.event_types is not None and event_type not in self.event_types:
+            return
+
+        event = {
+            "event": event_type,
+            "timestamp": datetime.now().isoformat(),
+            **data
+        }
+
+        try:
+            self.send(event)
+        except Exception as e:
+            print(f"Failed to emit {event_type} event: {e}")
+
+    def send(self, event):
+        raise NotImplementedError
+
+
+class NullEventSink(EventSink):
+    """Discards all events"""
+
+    def emit(self, event_type, **data):
+        pass
+
+
+class InMemoryEventSink(EventSink):
+    """Keeps events in a list. Used in tests and local runs"""
+
+    def __init__(self, event_types=None):
+        super().__init__(event_types)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def send(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def of_type(self, event_type):
+        return [event for event in self.events if event["event"] == event_type]
+
+
+class ApiGatewayEventSink(EventSink):
+    """Posts events to a WebSocket connection through the API Gateway management API"""
+
+    def __init__(self, client, connection_id, event_types=None):
+        super().__init__(event_types)
+        self.client = client
+        self.connection_id = connection_id
+        self.connection_gone = False
+
+    def send(self, event):
+        # Stop sending once the client has disconnected
+        if self.connection_gone:
+            return
+
+        if not send_framed(self.client, self.connection_id, event):
+            self.connection_gone = True
+
+
+class AnswerDeltaBuffer():
+    """
+    Coalesces the text deltas of a streamed answer into fewer answer_delta
+    events, sent once max_chars are buffered or max_seconds after the first
+    buffered delta, so a sink that posts each event (one API Gateway round
+    trip) is not called for every token.
+    """
+
+    def __init__(self, event_sink, max_chars=1024, max_seconds=0.1):
+        self.event_sink = event_sink
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+        self.parts = []
+        self.size = 0
+        self.started = None
+
+    def add(self, text):
+        if not self.parts:
+            self.started = monotonic()
+
+        self.parts.append(text)
+        self.size += len(text)
+
+        if self.size >= self.max_chars or monotonic() - self.started >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.event_sink.emit(ANSWER_DELTA, text="".join(self.parts))
+            self.parts = []
+            self.size = 0
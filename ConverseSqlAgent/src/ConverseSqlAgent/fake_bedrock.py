@@ -0,0 +1,154 @@
+import json
+import time
+import uuid
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+from sessions import is_exchange_start
+
+CHARACTERS_PER_TOKEN = 4
+
+DEFAULT_SCRIPT = [
+    {"tool": "invoke_sql_query", "input": {"database_name": "hr", "query": "SELECT COUNT(*) AS employees FROM employees"}},
+    {"final": "There are {result} employees."}
+]
+
+
+def response_to_stream(response):
+    """Returns a Converse API response as a ConverseStream API response"""
+
+    message = response["output"]["message"]
+
+    def events():
+        yield {"messageStart": {"role": message["role"]}}
+
+        for index, block in enumerate(message["content"]):
+            if "text" in block:
+                yield {"contentBlockDelta": {"contentBlockIndex": index, "delta": {"text": block["text"]}}}
+            else:
+                tool_use = block["toolUse"]
+                yield {"contentBlockStart": {"contentBlockIndex": index, "start": {"toolUse": {"toolUseId": tool_use["toolUseId"], "name": tool_use["name"]}}}}
+                yield {"contentBlockDelta": {"contentBlockIndex": index, "delta": {"toolUse": {"input": json.dumps(tool_use["input"])}}}}
+            yield {"contentBlockStop": {"contentBlockIndex": index}}
+
+        yield {"messageStop": {"stopReason": response["stopReason"]}}
+        yield {"metadata": {"usage": response.get("usage", {}), "metrics": response.get("metrics", {})}}
+
+    return {"stream": events()}
+
+
+def tool_turn(name, tool_input, plan=None):
+    """A scripted turn that calls a tool"""
+
+    return {"tool": name, "input": tool_input, "plan": plan}
+
+
+def final_turn(text):
+    """A scripted turn that answers"""
+
+    return {"final": text}
+
+
+class FakeBedrockClient():
+    """
+    Stand-in for the bedrock-runtime client used by BaseAgent, for local runs,
+    load tests and benchmarks.
+
+    Each Converse call returns the next turn of the script for the current
+    question, counted from the last user question in the request. A turn is a
+    dict with either "tool" and "input" (a tool call) or "final" (the answer).
+    "{result}" in a final answer is replaced by the first data row of the last
+    tool result. The script can also be a callable that takes the messages
+    and returns a turn.
+
+    Parameters:
+    - script (List[dict] or Callable) The turns to play
+    - latency_seconds (float or Callable) Added to every call, a callable is called for each
+    - throttle_rate (float) The fraction of calls that raise a ThrottlingException
+    - seed (int) Seeds the throttling decisions
+    """
+
+    def __init__(self, script=None, latency_seconds=0.0, throttle_rate=0.0, seed=None):
+        self.script = script or DEFAULT_SCRIPT
+        self.latency_seconds = latency_seconds
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+
+    def next_turn(self, messages):
+        if callable(self.script):
+            return self.script(messages)
+
+        exchange_start = max(i for i, message in enumerate(messages) if is_exchange_start(message))
+        turn = sum(1 for message in messages[exchange_start:] if message["role"] == "assistant")
+
+        return self.script[min(turn, len(self.script) - 1)]
+
+    def wait_and_maybe_throttle(self, operation_name):
+        latency = self.latency_seconds() if callable(self.latency_seconds) else self.latency_seconds
+        if latency:
+            time.sleep(latency)
+
+        with self.lock:
+            self.calls += 1
+            throttle = self.throttle_rate and self.random.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+
+        if throttle:
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, operation_name)
+
+    def build_message(self, messages, turn):
+        if "final" in turn:
+            return {"role": "assistant", "content": [{"text": f"<final_response>{self.fill_result(messages, turn['final'])}</final_response>"}]}, "end_turn"
+
+        plan = turn.get("plan") or f"1. Call {turn['tool']}\n2. Answer the question"
+
+        return {
+            "role": "assistant",
+            "content": [
+                {"text": f"<current_plan>{plan}</current_plan>"},
+                {"toolUse": {"toolUseId": f"tooluse_{uuid.uuid4().hex[:12]}", "name": turn["tool"], "input": turn["input"]}}
+            ]
+        }, "tool_use"
+
+    @staticmethod
+    def fill_result(messages, text):
+        if "{result}" not in text:
+            return text
+
+        for message in reversed(messages):
+            for chunk in message["content"]:
+                if "toolResult" in chunk:
+                    rows = chunk["toolResult"]["content"][0].get("text", "").strip().splitlines()
+                    return text.replace("{result}", rows[1] if len(rows) > 1 else (rows[0] if rows else ""))
+
+        return text.replace("{result}", "")
+
+    @staticmethod
+    def usage(request, message):
+        input_tokens = len(json.dumps(request.get("messages", []), default=str)) // CHARACTERS_PER_TOKEN
+        input_tokens += sum(len(block.get("text", "")) for block in request.get("system", [])) // CHARACTERS_PER_TOKEN
+        output_tokens = len(json.dumps(message["content"])) // CHARACTERS_PER_TOKEN
+
+        return {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": input_tokens + output_tokens}
+
+    def converse(self, **request):
+        start = time.perf_counter()
+        self.wait_and_maybe_throttle("Converse")
+
+        message, stop_reason = self.build_message(request["messages"], self.next_turn(request["messages"]))
+
+        return {
+            "output": {"message": message},
+            "stopReason": stop_reason,
+            "usage": self.usage(request, message),
+            "metrics": {"latencyMs": int((time.perf_counter() - start) * 1000)}
+        }
+
+    def converse_stream(self, **request):
+        return response_to_stream(self.converse(**request))
@@ -0,0 +1,111 @@
+import json
+import gzip
+import uuid
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from connections import post_to_connection
+
+# API Gateway WebSocket messages are limited to 128 KB, keep a margin for the frame header
+MAX_FRAME_BYTES = 96 * 1024
+
+# Messages smaller than this are sent as plain JSON, unchanged for existing clients
+COMPRESSION_THRESHOLD_BYTES = 32 * 1024
+
+ENCODING = "gzip+base64"
+
+
+def frame_message(message, max_frame_bytes=MAX_FRAME_BYTES, compression_threshold=COMPRESSION_THRESHOLD_BYTES):
+    """
+    Serializes a message into one or more WebSocket frames.
+
+    Small messages are returned as a single plain JSON frame. Larger messages
+    are gzipped, base64 encoded and split into chunk frames:
+    {"type": "chunk", "message_id", "seq", "total", "encoding", "checksum", "data"}
+    where checksum is the sha256 of the encoded payload. Chunks can be sent in
+    any order and are reassembled by seq.
+
+    Parameters:
+    - message (dict) The message to send
+    - max_frame_bytes (int) The maximum size of a chunk's data
+    - compression_threshold (int) The size above which the message is compressed
+
+    Returns:
+    - (List[str]) The frames
+    """
+
+    serialized = json.dumps(message, default=str)
+
+    if len(serialized.encode("utf-8")) <= compression_threshold:
+        return [serialized]
+
+    payload = base64.b64encode(gzip.compress(serialized.encode("utf-8"))).decode("ascii")
+    checksum = hashlib.sha256(payload.encode("ascii")).hexdigest()
+    message_id = str(uuid.uuid4())
+
+    parts = [payload[i:i + max_frame_bytes] for i in range(0, len(payload), max_frame_bytes)]
+
+    return [
+        json.dumps({
+            "type": "chunk",
+            "message_id": message_id,
+            "seq": seq,
+            "total": len(parts),
+            "encoding": ENCODING,
+            "checksum": checksum,
+            "data": part
+        })
+        for seq, part in enumerate(parts)
+    ]
+
+
+def send_framed(client, connection_id, message, max_workers=4):
+    """
+    Sends a message to a connection, chunking and compressing it if large.
+    Chunks are sent concurrently.
+
+    Returns:
+    - (bool) False if the connection is gone, True otherwise
+    """
+
+    frames = frame_message(message)
+
+    if len(frames) == 1:
+        return post_to_connection(client, connection_id, frames[0])
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(frames))) as executor:
+        results = list(executor.map(lambda frame: post_to_connection(client, connection_id, frame), frames))
+
+    return all(results)
+
+
+class FrameAssembler():
+    """
+    Client-side reassembly reference. Feed every received frame to add() and
+    it returns the decoded message once complete, or None while chunks of it
+    are still missing.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, frame):
+        data = json.loads(frame) if isinstance(frame, str) else frame
+
+        if data.get("type") != "chunk":
+            return data
+
+        chunks = self.pending.setdefault(data["message_id"], {})
+        chunks[data["seq"]] = data["data"]
+
+        if len(chunks) < data["total"]:
+            return None
+
+        del self.pending[data["message_id"]]
+        payload = "".join(chunks[seq] for seq in range(data["total"]))
+
+        if hashlib.sha256(payload.encode("ascii")).hexdigest() != data["checksum"]:
+            raise ValueError(f"Checksum mismatch for message {data['message_id']}")
+
+        return json.loads(gzip.decompress(base64.b64decode(payload)).decode("utf-8"))
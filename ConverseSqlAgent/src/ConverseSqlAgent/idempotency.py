@@ -0,0 +1,207 @@
+import re
+import time
+import uuid
+import hashlib
+
+from memory_store import ConditionalWriteError, create_memory_store
+from checkpoints import RunSuspended
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+def normalize_prompt(prompt):
+    """Lowercases the prompt, collapses whitespace and drops trailing punctuation"""
+
+    prompt = re.sub(r"\s+", " ", prompt or "").strip().lower()
+    return prompt.rstrip(" ?!.")
+
+
+def idempotency_key(prompt, database=None, session_id=None):
+    """Returns the key shared by duplicate requests of the same user"""
+
+    raw = "\n".join([normalize_prompt(prompt), (database or "").lower(), session_id or ""])
+    return "request#" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DuplicateRequestTimeout(Exception):
+    """Raised when the run a duplicate attached to did not finish in time"""
+    pass
+
+
+class IdempotencyGuard():
+    """
+    Coalesces duplicate requests. The first request takes a lease on its key
+    with a conditional put and runs. Duplicates that arrive while the lease is
+    held wait for its result, and duplicates that arrive after it completed get
+    the cached result. A run that fails releases the lease, and a lease that
+    expires (e.g. the Lambda was killed) can be taken over. A run that is
+    suspended keeps the lease, and its continuation completes the key with resume.
+
+    Parameters:
+    - store (MemoryStore) Any memory store backend, used for its conditional writes
+    - lease_seconds (int) How long a run holds the lease
+    - result_ttl_seconds (int) How long a completed result is served to duplicates
+    - poll_seconds (float) How often duplicates check for the result
+    - wait_seconds (float) How long a duplicate waits for the in-flight run before
+      DuplicateRequestTimeout is raised. Each waiting duplicate holds an invocation
+      or a worker thread, so keep it well below the function timeout.
+    """
+
+    def __init__(self, store, lease_seconds=900, result_ttl_seconds=300, poll_seconds=1.0, wait_seconds=60):
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.poll_seconds = poll_seconds
+        self.wait_seconds = wait_seconds
+
+    def run(self, key, function, wait_timeout=None, owner=None):
+        """
+        Runs function() once per key and returns (result, is_duplicate)
+
+        Parameters:
+        - wait_timeout (float) Overrides wait_seconds, e.g. to stay within the remaining invocation time
+        - owner (str) Identifies the run holding the lease, e.g. its run_id so its continuation can resume it
+        """
+
+        if wait_timeout is None:
+            wait_timeout = self.wait_seconds
+
+        owner = owner or str(uuid.uuid4())
+        deadline = time.time() + wait_timeout
+
+        while True:
+            existing = self._acquire(key, owner)
+
+            if existing is None:
+                return self._run_as_owner(key, owner, function), False
+
+            if existing["status"] == COMPLETED:
+                print(f"Returning cached result for duplicate request {key}")
+                return existing.get("result"), True
+
+            if time.time() >= deadline:
+                raise DuplicateRequestTimeout(f"Timed out waiting for the in-flight run of {key}")
+
+            time.sleep(self.poll_seconds)
+
+    def resume(self, key, owner, function):
+        """
+        Runs the continuation of a suspended run under the lease the run kept,
+        and completes the key with its result like run. Duplicates keep waiting
+        for it in the meantime.
+
+        Returns:
+        - The result of function()
+        """
+
+        self._extend(key, owner)
+        return self._run_as_owner(key, owner, function)
+
+    def _acquire(self, key, owner):
+        """Takes the lease and returns None, or returns the item that holds the key"""
+
+        now = int(time.time())
+        lease = {
+            "id": key,
+            "status": IN_PROGRESS,
+            "owner": owner,
+            "lease_expires_at": now + self.lease_seconds,
+            "expires_at": now + self.lease_seconds + self.result_ttl_seconds
+        }
+
+        try:
+            self.store.put_item(lease, if_not_exists=True)
+            return None
+        except ConditionalWriteError:
+            pass
+
+        existing = self.store.get_item(key)
+
+        # The item expired or was released between the put and the get
+        if existing is None:
+            return self._acquire(key, owner)
+
+        expired = existing["status"] == IN_PROGRESS and int(existing["lease_expires_at"]) < now
+        stale = existing["status"] == COMPLETED and int(existing["expires_at"]) < now
+
+        if expired or stale:
+            try:
+                self.store.put_item(lease, expected={"owner": existing["owner"]})
+                return None
+            except ConditionalWriteError:
+                return self.store.get_item(key) or existing
+
+        return existing
+
+    def _run_as_owner(self, key, owner, function):
+        try:
+            result = function()
+        except RunSuspended as e:
+            # The run continues in another invocation, which completes the key
+            self._extend(key, owner, run_id=e.run_id)
+            raise
+        except BaseException:
+            # Release the lease so a retry can run
+            self._release(key, owner)
+            raise
+
+        now = int(time.time())
+
+        # The answer is returned even if it cannot be stored, e.g. the store is
+        # throttled or the result is larger than an item
+        try:
+            self.store.put_item(
+                {
+                    "id": key,
+                    "status": COMPLETED,
+                    "owner": owner,
+                    "result": result,
+                    "expires_at": now + self.result_ttl_seconds
+                },
+                expected={"owner": owner}
+            )
+        except ConditionalWriteError:
+            print(f"Lease on {key} was taken over before the run completed")
+        except Exception as e:
+            print(f"Failed to store the result of {key}: {e}")
+            self._release(key, owner)
+
+        return result
+
+    def _extend(self, key, owner, run_id=None):
+        """Renews the lease of this run, recording the run_id of a suspended run"""
+
+        now = int(time.time())
+        lease = {
+            "id": key,
+            "status": IN_PROGRESS,
+            "owner": owner,
+            "lease_expires_at": now + self.lease_seconds,
+            "expires_at": now + self.lease_seconds + self.result_ttl_seconds
+        }
+        if run_id is not None:
+            lease["run_id"] = run_id
+
+        try:
+            self.store.put_item(lease, expected={"owner": owner})
+        except ConditionalWriteError:
+            print(f"Lease on {key} was taken over while the run was suspended")
+        except Exception as e:
+            print(f"Failed to renew the lease on {key}: {e}")
+
+    def _release(self, key, owner):
+        """Deletes the lease if this run still holds it, so waiting duplicates can run"""
+
+        try:
+            self.store.delete_item(key, expected={"owner": owner})
+        except ConditionalWriteError:
+            pass
+        except Exception as e:
+            print(f"Failed to release the lease on {key}: {e}")
+
+
+def create_idempotency_guard(backend=None, table_name=None, **kwargs):
+    """Creates a guard on the configured store backend (dynamodb, memory or sqlite)"""
+
+    return IdempotencyGuard(create_memory_store(backend=backend, table_name=table_name), **kwargs)
@@ -0,0 +1,213 @@
+import json
+import queue
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Prompts above this size are rejected at ingress
+MAX_PROMPT_CHARS = 20000
+
+
+class JobValidationError(ValueError):
+    """Raised when a request cannot be turned into a job"""
+    pass
+
+
+def create_job(body, connection_id, domain_name, stage, tenant_id=None, principal=None):
+    """
+    Validates a WebSocket request body and returns the job to enqueue
+
+    Parameters:
+    - body (dict) The parsed request body
+    - connection_id (str) The originating connection
+    - domain_name (str) The WebSocket API domain name
+    - stage (str) The WebSocket API stage
+    - tenant_id (str) The tenant used for admission control
+    - principal (str) The authenticated caller, sessions are scoped to it
+
+    Returns:
+    - job (dict) The job
+    """
+
+    if not isinstance(body, dict):
+        raise JobValidationError("The request body must be a JSON object with a prompt.")
+
+    prompt = body.get("prompt")
+
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise JobValidationError("The request must include a non-empty prompt.")
+
+    if len(prompt) > MAX_PROMPT_CHARS:
+        raise JobValidationError(f"The prompt must be at most {MAX_PROMPT_CHARS} characters.")
+
+    return {
+        "job_id": str(uuid.uuid4()),
+        "prompt": prompt,
+        "connection_id": connection_id,
+        "domain_name": domain_name,
+        "stage": stage,
+        "database": body.get("database"),
+        "session_id": body.get("session_id"),
+        "tenant_id": tenant_id,
+        "principal": principal,
+        "profile": body.get("profile") is True,
+        "enqueued_at": datetime.now().isoformat()
+    }
+
+
+class JobQueue():
+    """
+    Queue of agent jobs. receive() returns (job, receipt) pairs and every
+    received job must be acknowledged with ack(receipt) once processed,
+    otherwise it becomes visible again.
+    """
+
+    def enqueue(self, job):
+        raise NotImplementedError
+
+    def receive(self, max_jobs=1, wait_seconds=0):
+        raise NotImplementedError
+
+    def ack(self, receipt):
+        raise NotImplementedError
+
+
+class SqsJobQueue(JobQueue):
+
+    def __init__(self, queue_url, sqs_client=None):
+        import boto3
+
+        self.queue_url = queue_url
+        self.sqs = sqs_client or boto3.client("sqs")
+
+    def enqueue(self, job):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+
+    def receive(self, max_jobs=1, wait_seconds=0):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_jobs, 10),
+            WaitTimeSeconds=wait_seconds
+        )
+
+        return [(json.loads(message["Body"]), message["ReceiptHandle"]) for message in response.get("Messages", [])]
+
+    def ack(self, receipt):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+class LocalJobQueue(JobQueue):
+    """In process stand-in for SQS. Unacknowledged jobs are not redelivered"""
+
+    def __init__(self, max_size=0):
+        self.jobs = queue.Queue(maxsize=max_size)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, job):
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            raise JobValidationError("The job queue is full. Please try again later.")
+
+    def receive(self, max_jobs=1, wait_seconds=0):
+        received = []
+
+        while len(received) < max_jobs:
+            try:
+                # Only wait for the first job, like a long poll
+                job = self.jobs.get(timeout=wait_seconds) if not received and wait_seconds else self.jobs.get_nowait()
+            except queue.Empty:
+                break
+
+            receipt = str(uuid.uuid4())
+            with self.lock:
+                self.in_flight[receipt] = job
+            received.append((job, receipt))
+
+        return received
+
+    def ack(self, receipt):
+        with self.lock:
+            self.in_flight.pop(receipt, None)
+
+    def __len__(self):
+        return self.jobs.qsize()
+
+
+class JobWorker():
+    """
+    Pulls jobs from a queue and runs them with bounded concurrency
+
+    Parameters:
+    - job_queue (JobQueue) The queue to pull jobs from
+    - run_job (Callable) Called with each job. Jobs that raise are not acknowledged
+    - concurrency (int) The maximum number of jobs running at once
+    """
+
+    def __init__(self, job_queue, run_job, concurrency=4, wait_seconds=1):
+        self.job_queue = job_queue
+        self.run_job = run_job
+        self.concurrency = concurrency
+        self.wait_seconds = wait_seconds
+
+        self.slots = threading.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _run(self, job, receipt):
+        try:
+            self.run_job(job)
+            self.job_queue.ack(receipt)
+        except Exception as e:
+            print(f"Job {job.get('job_id')} failed: {e}")
+        finally:
+            self.slots.release()
+
+    def poll_once(self):
+        """Receives and starts as many jobs as there are free slots. Returns the number started"""
+
+        started = 0
+
+        # Wait for a free slot before polling so jobs are not held without capacity
+        self.slots.acquire()
+        free_slots = 1
+        while free_slots < self.concurrency and self.slots.acquire(blocking=False):
+            free_slots += 1
+
+        try:
+            jobs = self.job_queue.receive(max_jobs=free_slots, wait_seconds=self.wait_seconds)
+        except Exception:
+            for _ in range(free_slots):
+                self.slots.release()
+            raise
+
+        for job, receipt in jobs:
+            self.executor.submit(self._run, job, receipt)
+            started += 1
+
+        # Release the slots that were not used
+        for _ in range(free_slots - started):
+            self.slots.release()
+
+        return started
+
+    def run_forever(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Failed to poll the job queue: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.executor.shutdown(wait=wait)
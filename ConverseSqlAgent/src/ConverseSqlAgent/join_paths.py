@@ -0,0 +1,132 @@
+from collections import deque
+
+
+def join_condition(edge, reverse=False):
+    """Returns the ON condition of a foreign key, e.g. employees.department_id = departments.department_id"""
+
+    pairs = zip(edge["from_columns"], edge["to_columns"])
+    left, right = edge["from_name"], edge["to_name"]
+    conditions = [f"{left}.{a} = {right}.{b}" if not reverse else f"{right}.{b} = {left}.{a}" for a, b in pairs]
+    return " AND ".join(conditions)
+
+
+def build_graph(foreign_keys):
+    """
+    Builds an undirected graph of the tables joined by foreign keys
+
+    Parameters:
+    - foreign_keys (List[dict]) Edges with from and to (schema, table) nodes, their display names
+      from_name and to_name, and the from_columns and to_columns of the key
+
+    Returns:
+    - (dict) node -> list of (neighbor node, edge), sorted so paths are deterministic
+    """
+
+    graph = {}
+    for edge in foreign_keys:
+        graph.setdefault(edge["from"], [])
+        graph.setdefault(edge["to"], [])
+        if edge["from"] == edge["to"]:
+            continue
+        graph[edge["from"]].append((edge["to"], edge))
+        graph[edge["to"]].append((edge["from"], edge))
+
+    for neighbors in graph.values():
+        neighbors.sort(key=lambda neighbor: (neighbor[0], neighbor[1]["from_columns"]))
+    return graph
+
+
+def breadth_first(graph, sources):
+    """Returns the distance and the (parent, edge) of every node reachable from any of the sources"""
+
+    distances = {source: 0 for source in sources}
+    parents = {}
+    queue = deque(sorted(sources))
+
+    while queue:
+        node = queue.popleft()
+        for neighbor, edge in graph.get(node, []):
+            if neighbor not in distances:
+                distances[neighbor] = distances[node] + 1
+                parents[neighbor] = (node, edge)
+                queue.append(neighbor)
+
+    return distances, parents
+
+
+def grow_tree(graph, root, terminals):
+    """
+    Connects the terminals to a tree started at root, each time adding the
+    shortest path from the tree to the nearest terminal not yet in it
+
+    Returns:
+    - (set, List) The nodes and the edges of the tree, and the terminals that could not be reached
+    """
+
+    nodes = {root}
+    edges = []
+    remaining = set(terminals) - nodes
+
+    while remaining:
+        distances, parents = breadth_first(graph, nodes)
+        reachable = [terminal for terminal in remaining if terminal in distances]
+        if not reachable:
+            break
+
+        target = min(reachable, key=lambda terminal: (distances[terminal], terminal))
+        node = target
+        while node not in nodes:
+            parent, edge = parents[node]
+            nodes.add(node)
+            edges.append(edge)
+            node = parent
+        remaining -= nodes
+
+    return nodes, edges, remaining
+
+
+def steiner_tree(graph, terminals):
+    """
+    Returns a small tree of foreign key joins that connects all terminals
+    (the shortest path heuristic for Steiner trees, tried from every terminal,
+    which is exact for two tables)
+
+    Returns:
+    - (dict) The root, nodes, edges and the terminals that could not be connected
+    """
+
+    best = None
+    for root in sorted(terminals):
+        nodes, edges, unreachable = grow_tree(graph, root, terminals)
+        key = (len(unreachable), len(edges))
+        if best is None or key < best[0]:
+            best = (key, {"root": root, "nodes": nodes, "edges": edges, "unreachable": unreachable})
+
+    return best[1]
+
+
+def order_joins(tree):
+    """Orders the edges of a tree so each join refers to a table joined before it"""
+
+    joined = {tree["root"]}
+    pending = list(tree["edges"])
+    ordered = []
+
+    while pending:
+        for edge in pending:
+            if edge["from"] in joined or edge["to"] in joined:
+                new_node = edge["to"] if edge["from"] in joined else edge["from"]
+                ordered.append((new_node, edge))
+                joined.add(new_node)
+                pending.remove(edge)
+                break
+        else:
+            break
+
+    return ordered
+
+
+def parallel_edges(graph, edge):
+    """Returns the other foreign keys between the two tables of an edge"""
+
+    return [other for neighbor, other in graph.get(edge["from"], []) if neighbor == edge["to"] and other is not edge]
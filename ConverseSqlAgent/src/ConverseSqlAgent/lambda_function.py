@@ -1,23 +1,463 @@
 import os
 import json
+import time
+import uuid
+import random
 import boto3
 
+import tracing
+import metrics
+import profiling
 from agent import BaseAgent
 
 from tool_groups.sql import SQL_TOOL_GROUP
 from tool_groups.memory import MEMORY_TOOL_GROUP
+from reflection import InlineReflectionDispatcher, LambdaReflectionDispatcher
+from connections import get_management_client, broadcast
+from framing import frame_message, send_framed
+from jobs import SqsJobQueue, JobValidationError, create_job
+from idempotency import DuplicateRequestTimeout, create_idempotency_guard, idempotency_key
+from sessions import create_session_store, scoped_session_key
+from checkpoints import RunSuspended, create_checkpoint_store
+from cancellation import RunCancelled, CancellationToken, create_cancellation_flags, now_ms
+from admission import AdmissionRejected, create_admission_controller
+from recording import TraceRecorder
+from query_log import create_query_log
+from tool_groups.query_log import QUERY_LOG_TOOL_GROUP
+from events import ( ApiGatewayEventSink,
+                     RUN_STARTED,
+                     PLAN_EXTRACTED,
+                     TOOL_STARTED,
+                     TOOL_FINISHED,
+                     ANSWER_DELTA
+                    )
 
 memory_table_name = os.environ.get('DynamoDbMemoryTable', 'advtext2sql_memory_tb')
+memory_backend = os.environ.get('MEMORY_BACKEND', 'dynamodb')  # dynamodb, memory or sqlite
+prefetch_memory = os.environ.get('PREFETCH_MEMORY', 'false').lower() == 'true'
+pinned_memory_ids = [memory_id.strip() for memory_id in os.environ.get('PINNED_MEMORY_IDS', '').split(',') if memory_id.strip()]
+reflection_mode = os.environ.get('REFLECTION_MODE', 'none').lower()  # none, inline or async
+broadcast_responses = os.environ.get('BROADCAST_RESPONSES', 'false').lower() == 'true'
+broadcast_max_workers = int(os.environ.get('BROADCAST_MAX_WORKERS', '16'))
+progress_events = os.environ.get('PROGRESS_EVENTS', 'false').lower() == 'true'
+job_queue_url = os.environ.get('JOB_QUEUE_URL')  # Enables job mode when set
+reflection_function_name = os.environ.get('REFLECTION_FUNCTION_NAME')
+idempotency_table_name = os.environ.get('IDEMPOTENCY_TABLE')  # Coalesces duplicate prompts when set
+idempotency_wait_seconds = int(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '60'))
+session_table_name = os.environ.get('SESSION_TABLE')  # Keeps multi-turn history when set
+session_ttl_seconds = int(os.environ.get('SESSION_TTL_SECONDS', '3600'))
+session_max_bytes = int(os.environ.get('SESSION_MAX_BYTES', str(200 * 1024)))
+checkpoint_table_name = os.environ.get('CHECKPOINT_TABLE')  # Checkpoints runs and resumes them in a new invocation when set
+checkpoint_safety_seconds = int(os.environ.get('CHECKPOINT_SAFETY_SECONDS', '60'))
+cancellation_table_name = os.environ.get('CANCELLATION_TABLE')  # Enables {"action": "cancel"} messages when set
+admission_table_name = os.environ.get('ADMISSION_TABLE')  # Enables per-tenant admission control when set
+admission_max_concurrency = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '10'))
+admission_tenant_concurrency = int(os.environ.get('ADMISSION_TENANT_CONCURRENCY', '2'))
+admission_max_queue_depth = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', '50'))
+admission_max_wait_seconds = int(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', '300'))
+admission_tenant_weights = json.loads(os.environ.get('ADMISSION_TENANT_WEIGHTS', '{}'))  # e.g. {"batch-user": 0.5}
+trace_bucket = os.environ.get('TRACE_BUCKET')  # Records runs for replay when set
+trace_sample_rate = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+query_log_table_name = os.environ.get('QUERY_LOG_TABLE')  # Logs SQL statements with per-shape statistics when set
 model_id = os.environ.get('BedrockModelId', 'us.anthropic.claude-sonnet-4-20250514-v1:0')
 GUARDRAIL_ID = os.environ.get("BEDROCK_GUARDRAIL_ID")      # e.g., "gr-123456"
 GUARDRAIL_VERSION = os.environ.get("BEDROCK_GUARDRAIL_VERSION", "1")  # default version
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ['CONNECTIONS_TABLE'])
 
+_job_queue = None
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = SqsJobQueue(job_queue_url)
+    return _job_queue
+
+_idempotency_guard = None
+
+def get_idempotency_guard():
+    global _idempotency_guard
+    if _idempotency_guard is None:
+        _idempotency_guard = create_idempotency_guard(backend='dynamodb', table_name=idempotency_table_name,
+                                                      wait_seconds=idempotency_wait_seconds)
+    return _idempotency_guard
+
+_session_store = None
+
+def get_session_store():
+    global _session_store
+    if _session_store is None:
+        _session_store = create_session_store(backend='dynamodb', table_name=session_table_name,
+                                              ttl_seconds=session_ttl_seconds, max_bytes=session_max_bytes)
+    return _session_store
+
+_checkpoint_store = None
+
+def get_checkpoint_store():
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = create_checkpoint_store(backend='dynamodb', table_name=checkpoint_table_name)
+    return _checkpoint_store
+
+_cancellation_flags = None
+
+def get_cancellation_flags():
+    global _cancellation_flags
+    if _cancellation_flags is None:
+        _cancellation_flags = create_cancellation_flags(backend='dynamodb', table_name=cancellation_table_name)
+    return _cancellation_flags
+
+_admission_controller = None
+
+def get_admission_controller():
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = create_admission_controller(
+            backend='dynamodb',
+            table_name=admission_table_name,
+            max_concurrency=admission_max_concurrency,
+            tenant_concurrency=admission_tenant_concurrency,
+            tenant_weights=admission_tenant_weights,
+            max_queue_depth=admission_max_queue_depth,
+            max_wait_seconds=admission_max_wait_seconds
+        )
+    return _admission_controller
+
+_query_log = None
+
+def get_query_log():
+    global _query_log
+    if _query_log is None:
+        _query_log = create_query_log(backend='dynamodb', table_name=query_log_table_name)
+    return _query_log
+
+_lambda_client = None
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client('lambda')
+    return _lambda_client
+
+_bedrock_client = None
+
+def get_bedrock_client():
+    """The bedrock-runtime client, shared by the runs of a warm container"""
+    global _bedrock_client
+    if _bedrock_client is None:
+        _bedrock_client = boto3.client('bedrock-runtime')
+    return _bedrock_client
+
+_s3_client = None
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+def flush_query_log():
+    """Waits for the query log statistics written in the background, before the container is frozen"""
+    
+    if _query_log is not None:
+        _query_log.flush()
+
+def save_trace(trace_recorder, run_id):
+    """Uploads the trace of a run to TRACE_BUCKET, see recording.TraceReplayer to replay it"""
+    
+    key = f"traces/{time.strftime('%Y/%m/%d', time.gmtime())}/{run_id}.jsonl.gz"
+    try:
+        get_s3_client().put_object(Bucket=trace_bucket, Key=key, Body=trace_recorder.dumps(), ContentEncoding="gzip")
+        print(f"Saved trace s3://{trace_bucket}/{key}")
+    except Exception as e:
+        print(f"Failed to save trace: {e}")
+
+def create_agent(event_sink=None):
+    checkpoint_store = get_checkpoint_store() if checkpoint_table_name else None
+    agent = BaseAgent(model_id=model_id, memory_table_name=memory_table_name, guardrail_id=GUARDRAIL_ID, guardrail_version=GUARDRAIL_VERSION, memory_backend=memory_backend, event_sink=event_sink, checkpoint_store=checkpoint_store, bedrock_client=get_bedrock_client())
+    agent.add_tool_group(SQL_TOOL_GROUP)
+    agent.add_tool_group(MEMORY_TOOL_GROUP)
+    if query_log_table_name:
+        agent.query_log = get_query_log()
+        agent.add_tool_group(QUERY_LOG_TOOL_GROUP)
+    return agent
+
+def handle_reflection(event):
+    """Runs a deferred reflection dispatched by LambdaReflectionDispatcher"""
+    
+    agent = create_agent()
+    summary = agent.reflect_on_run(transcript=event["transcript"], final_response=event.get("final_response"))
+    print(f"Completed deferred reflection: {summary}")
+    flush_query_log()
+    
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"result": summary})
+    }
+
+def handle_continuation(event, context):
+    """Resumes a run that was suspended by a previous invocation"""
+    
+    print(f"Resuming run {event['run_id']}")
+    
+    response_json = run_agent_request(None, event["connection_id"], event["domain_name"], event["stage"], context,
+                                      database=event.get("database"), session_id=event.get("session_id"),
+                                      run_id=event["run_id"], resume=True, started_at=event.get("started_at"),
+                                      tenant_id=event.get("tenant_id"), principal=event.get("principal"),
+                                      request_key=event.get("request_key"))
+    
+    return {
+        "statusCode": 200,
+        "body": json.dumps(response_json)
+    }
+
+def dispatch_continuation(run_id, connection_id, domain_name, stage, context, database=None, session_id=None, started_at=None, tenant_id=None, principal=None, request_key=None):
+    """Invokes this function asynchronously to continue a suspended run"""
+    
+    payload = {
+        "type": "continuation",
+        "run_id": run_id,
+        "connection_id": connection_id,
+        "domain_name": domain_name,
+        "stage": stage,
+        "database": database,
+        "session_id": session_id,
+        "started_at": started_at,
+        "tenant_id": tenant_id,
+        "principal": principal,
+        "request_key": request_key
+    }
+    
+    get_lambda_client().invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(payload)
+    )
+
+def run_agent_request(input_text, connection_id, domain_name, stage, context, database=None, session_id=None, run_id=None, resume=False, started_at=None, tenant_id=None, profile=False, principal=None, request_key=None):
+    """
+    Runs the agent for a prompt and sends the answer to the originating connection.
+    Duplicates of a prompt from the same session attach to the first run instead
+    of starting another one when IDEMPOTENCY_TABLE is set. A suspended run keeps
+    its lease and its continuation (request_key) completes it.
+    
+    When CHECKPOINT_TABLE is set the run is checkpointed after each turn. If the
+    invocation is about to time out the run is suspended and continued by a new
+    invocation, and a run_id with an existing checkpoint (e.g. a retried job)
+    resumes from its last turn instead of starting over.
+    
+    When CANCELLATION_TABLE is set a cancel message for the session stops the
+    run between turns and cancels its in-flight SQL query. started_at is when
+    the run was requested in epoch milliseconds; earlier cancel messages are ignored.
+    
+    Session history and duplicate detection are keyed on session_id scoped to
+    the principal (the authorizer principal, else the connection), see
+    sessions.scoped_session_key.
+    
+    When ADMISSION_TABLE is set the run waits for a slot of its tenant (tenant_id,
+    falling back to the connection) and is rejected right away if the queue is full.
+    
+    A sample of the runs (PROFILE_SAMPLE_RATE), or the run when profile is True
+    and PROFILE_REQUEST_FLAG allows it, is profiled to PROFILE_DESTINATION.
+    
+    A sample of the runs (TRACE_SAMPLE_RATE) is recorded and uploaded to
+    TRACE_BUCKET after the reply has been sent, whether the run succeeded or
+    not. Suspended runs keep recording in the invocation that resumes them.
+
+    Returns:
+    - response_json (dict) The result message that was sent, or the suspended status
+    """
+    
+    api_gateway_management = get_management_client(domain_name, stage)
+    
+    # Stream progress to the caller. The final answer is sent below as the result message
+    event_sink = None
+    if progress_events:
+        event_sink = ApiGatewayEventSink(
+            api_gateway_management,
+            connection_id,
+            event_types=[RUN_STARTED, PLAN_EXTRACTED, TOOL_STARTED, TOOL_FINISHED, ANSWER_DELTA]
+        )
+    
+    # Initialize SQL agent
+    print("Initializing agent")
+    agent = create_agent(event_sink=event_sink)
+    
+    # Record a sample of the runs so slow or wrong answers can be replayed offline
+    if trace_bucket and not resume and random.random() < trace_sample_rate:
+        agent.trace_recorder = TraceRecorder()
+    
+    # Leave enough time to checkpoint and hand the run over before the timeout
+    deadline = None
+    if checkpoint_table_name:
+        if run_id is None:
+            run_id = str(uuid.uuid4())
+        elif not resume:
+            resume = get_checkpoint_store().load(run_id) is not None
+        
+        if context is not None:
+            deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - checkpoint_safety_seconds
+    
+    session_key = scoped_session_key(session_id, principal or connection_id)
+    started_at = started_at or now_ms()
+    
+    cancellation_token = None
+    if cancellation_table_name:
+        cancellation_token = CancellationToken(get_cancellation_flags(), session_key, started_at=started_at)
+    
+    # Load the history of follow-up questions in one read
+    history = []
+    if session_table_name and not resume:
+        try:
+            history = get_session_store().load(session_key)
+            print(f"Loaded {len(history)} messages of session history")
+        except Exception as e:
+            print(f"Failed to load session history: {e}")
+    
+    print("Invoking agent")
+    if resume:
+        invoke = lambda: agent.resume_agent(run_id, deadline=deadline, cancellation_token=cancellation_token)
+    else:
+        invoke = lambda: agent.invoke_agent(input_text, prefetch_memory=prefetch_memory, pinned_memory_ids=pinned_memory_ids, defer_reflection=reflection_mode != 'none', stream=progress_events, history=history,
+                                            run_id=run_id if checkpoint_table_name else None, deadline=deadline,
+                                            cancellation_token=cancellation_token)
+    
+    # Profile the agent run itself, not the time spent waiting for admission
+    if profiling.should_profile(requested=profile):
+        run_without_profile = invoke
+        invoke = lambda: profiling.profile(run_without_profile, name=f"run-{run_id or uuid.uuid4()}")
+    
+    # Only the run that executes takes an admission slot, duplicates wait on the idempotency lease
+    if admission_table_name:
+        run = invoke
+        invoke = lambda: get_admission_controller().run(tenant_id or connection_id, run)
+    
+    # A continuation gets the key of the request it continues, its prompt is in the checkpoint
+    key = None
+    if idempotency_table_name:
+        key = request_key or (idempotency_key(input_text, database=database, session_id=session_key) if input_text is not None else None)
+    
+    is_duplicate = False
+    try:
+        if key and resume:
+            # The suspended run kept its lease, complete the key so waiting duplicates get this answer
+            response = get_idempotency_guard().resume(key, run_id, invoke)
+        elif key:
+            # A duplicate gives up before the invocation would time out while waiting
+            wait_timeout = None
+            if context is not None:
+                wait_timeout = min(idempotency_wait_seconds, context.get_remaining_time_in_millis() / 1000 - 10)
+            
+            # The lease is held under the run_id so that a continuation of the run can complete it
+            response, is_duplicate = get_idempotency_guard().run(key, invoke, wait_timeout=wait_timeout, owner=run_id)
+            if is_duplicate:
+                print(f"Attached to the run of a duplicate request {key}")
+        else:
+            response = invoke()
+    except RunSuspended:
+        dispatch_continuation(run_id, connection_id, domain_name, stage, context, database=database, session_id=session_id,
+                              started_at=started_at, tenant_id=tenant_id, principal=principal, request_key=key)
+        print(f"Run {run_id} continues in a new invocation")
+        return {"status": "suspended", "run_id": run_id}
+    except AdmissionRejected as e:
+        print(f"Rejected request of tenant {tenant_id or connection_id}: {e}")
+        response_json = {"status": "rejected", "error": str(e)}
+        send_to_connection(api_gateway_management, connection_id, response_json)
+        return response_json
+    except DuplicateRequestTimeout as e:
+        print(str(e))
+        response_json = {"status": "duplicate", "error": "The same question is still being answered for this session. Try again later."}
+        send_to_connection(api_gateway_management, connection_id, response_json)
+        return response_json
+    except RunCancelled:
+        print(f"Run of {session_key} was cancelled")
+        response_json = {"status": "cancelled"}
+        send_to_connection(api_gateway_management, connection_id, response_json)
+        return response_json
+    else:
+        print("Completed agent execution")
+        print(response)
+        
+        if admission_table_name:
+            print(f"Admission metrics: {json.dumps(get_admission_controller().metrics.snapshot())}")
+        
+        response_json = {
+            "result": response
+        }
+        
+        # The answer of another run with the same prompt, in flight or recently completed
+        if is_duplicate:
+            response_json["coalesced"] = True
+        
+        if broadcast_responses:
+            # Opt-in: send the answer to every connected client
+            broadcast_result = broadcast(api_gateway_management, table, frame_message(response_json), max_workers=broadcast_max_workers)
+            print(f"Broadcast result: {broadcast_result}")
+        else:
+            send_to_connection(api_gateway_management, connection_id, response_json)
+        
+        if session_table_name and agent.last_run_messages:
+            try:
+                get_session_store().save(session_key, agent.last_run_messages)
+            except Exception as e:
+                print(f"Failed to save session history: {e}")
+    finally:
+        # Upload the trace and finish the query log writes once the reply has been sent, also for failed and
+        # cancelled runs. A suspended run carries its trace in the checkpoint instead. The reflection below is not recorded
+        trace_recorder, agent.trace_recorder = agent.trace_recorder, None
+        if trace_recorder is not None and trace_recorder.records:
+            save_trace(trace_recorder, run_id or str(uuid.uuid4()))
+        flush_query_log()
+    
+    # The answer has been delivered, update the memory with learnings from the run
+    if reflection_mode != 'none' and agent.last_run_messages:
+        try:
+            if reflection_mode == 'async':
+                LambdaReflectionDispatcher(reflection_function_name or context.invoked_function_arn).dispatch(agent, agent.last_run_messages, response)
+            else:
+                InlineReflectionDispatcher().dispatch(agent, agent.last_run_messages, response)
+        except Exception as e:
+            print(f"Deferred reflection failed: {e}")
+        flush_query_log()
+    
+    return response_json
+
+def get_principal(event):
+    """Returns the principal of the connection's authorizer, or None without an authorizer"""
+    
+    authorizer = event['requestContext'].get('authorizer') or {}
+    return authorizer.get('principalId') or None
+
+def get_tenant_id(event):
+    """
+    Returns the tenant of a request: the authorizer principal, else the connection.
+    A tenant_id in the body is ignored, a client could name another tenant to take its slots.
+    """
+    
+    return get_principal(event) or event['requestContext'].get('connectionId')
+
+def send_to_connection(api_gateway_management, connection_id, message):
+    """Sends a message to a connection, removing it if it is stale. Large messages are chunked"""
+    
+    try:
+        if not send_framed(api_gateway_management, connection_id, message):
+            # Connection is stale, remove it
+            table.delete_item(Key={'connectionId': connection_id})
+    except Exception as e:
+        print(f"Failed to send message to connection {connection_id}: {e}")
+
+@metrics.flushed
+@tracing.traced("lambda_handler")
 def lambda_handler(event, context):
     print(event)
+    
+    if event.get("type") == "reflection":
+        return handle_reflection(event)
+    
+    if event.get("type") == "continuation":
+        return handle_continuation(event, context)
 
-    # Handle incoming messages and broadcast to other connections
+    # Handle incoming messages and reply to the originating connection
     connection_id = event['requestContext']['connectionId']
     domain_name = event['requestContext']['domainName']
     stage = event['requestContext']['stage']
@@ -36,54 +476,70 @@ def lambda_handler(event, context):
         except json.JSONDecodeError:
             body = event['body']  # Keep as string if not valid JSON
     
-    input_text = body["prompt"]
-    
-    # Initialize SQL agent
-    print("Initializing agent")
-    agent = BaseAgent(model_id=model_id, memory_table_name=memory_table_name, guardrail_id=GUARDRAIL_ID, guardrail_version=GUARDRAIL_VERSION)
-    agent.add_tool_group(SQL_TOOL_GROUP)
-    agent.add_tool_group(MEMORY_TOOL_GROUP)
-    
-    print("Invoking agent")
-    response = agent.invoke_agent(input_text)
-    
-    print("Completed agent execution")
-    print(response)
-
     cors_headers = {
         "Access-Control-Allow-Origin": "*",  # Allow all origins; change to specific domain for security
         "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
         "Access-Control-Allow-Headers": "Content-Type, Authorization"
     }
-
-    response_json = {
-        "result": response
-    }
-  
-    # Get all connections from DynamoDB
-    response = table.scan()
-    connections = response['Items']
-    
-    # Send message to all connected clients
-    api_gateway_management = boto3.client(
-        'apigatewaymanagementapi',
-        endpoint_url=f'https://{domain_name}/{stage}'
-    )
     
-    for connection in connections:
+    # Cancel the runs of the session that were requested before this message
+    if isinstance(body, dict) and body.get("action") == "cancel":
+        api_gateway_management = get_management_client(domain_name, stage)
+        
+        if not cancellation_table_name:
+            response_json = {"error": "Cancellation is not enabled."}
+            send_to_connection(api_gateway_management, connection_id, response_json)
+            return {
+                "statusCode": 400,
+                "body": json.dumps(response_json),
+                "headers": cors_headers
+            }
+        
+        # Only the caller's own sessions can be cancelled, under the key its runs use
+        get_cancellation_flags().cancel(scoped_session_key(body.get("session_id"), get_principal(event) or connection_id))
+        response_json = {"status": "cancelling"}
+        send_to_connection(api_gateway_management, connection_id, response_json)
+        
+        return {
+            "statusCode": 202,
+            "body": json.dumps(response_json),
+            "headers": cors_headers
+        }
+    
+    # Job mode: acknowledge right away and let the workers run the agent
+    if job_queue_url:
+        api_gateway_management = get_management_client(domain_name, stage)
+        
         try:
-            api_gateway_management.post_to_connection(
-                ConnectionId=connection['connectionId'],
-                Data=json.dumps(response_json)
-            )
-        except Exception as e:
-            # Connection might be stale, remove it
-            table.delete_item(Key={'connectionId': connection['connectionId']})
+            job = create_job(body, connection_id, domain_name, stage, tenant_id=get_tenant_id(event), principal=get_principal(event))
+            get_job_queue().enqueue(job)
+        except JobValidationError as e:
+            response_json = {"error": str(e)}
+            send_to_connection(api_gateway_management, connection_id, response_json)
+            return {
+                "statusCode": 400,
+                "body": json.dumps(response_json),
+                "headers": cors_headers
+            }
+        
+        response_json = {"status": "queued", "job_id": job["job_id"]}
+        send_to_connection(api_gateway_management, connection_id, response_json)
+        
+        return {
+            "statusCode": 202,
+            "body": json.dumps(response_json),
+            "headers": cors_headers
+        }
+    
+    input_text = body["prompt"]
+    
+    response_json = run_agent_request(input_text, connection_id, domain_name, stage, context,
+                                      database=body.get("database"), session_id=body.get("session_id"),
+                                      tenant_id=get_tenant_id(event), profile=body.get("profile") is True,
+                                      principal=get_principal(event))
     
     return {
-        "statusCode": 200,
+        "statusCode": {"rejected": 429, "duplicate": 409}.get(response_json.get("status"), 200),
         "body": json.dumps(response_json),
         "headers": cors_headers
     }
-
-
@@ -0,0 +1,146 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from prompts import MEMORY_PREFETCH_PROMPT_TEMPLATE, MAIN_MEMORY_PREFETCH_PROMPT_TEMPLATE
+
+# Memories that are always loaded with the memory index
+DEFAULT_PINNED_MEMORY_TITLES = ["Best Practices and Error Avoidance"]
+
+# The memory read first with MEMORY_TOOL_GROUP, which has no memory index
+MAIN_MEMORY_ID = "1"
+
+# Tool groups whose memories can be prefetched, each stores its items differently
+STRUCTURED_MEMORY_TOOL_GROUP_NAME = "STRUCTURED_MEMORY_TOOL_GROUP"
+MEMORY_TOOL_GROUP_NAME = "MEMORY_TOOL_GROUP"
+
+# Rough estimate used for the prefetch token budget
+CHARACTERS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+def truncate_to_budget(text, token_budget):
+    """Truncates text to fit in token_budget, noting that it was cut"""
+
+    max_characters = token_budget * CHARACTERS_PER_TOKEN
+    if len(text) <= max_characters:
+        return text
+
+    note = "\n[truncated, read the full memory with read_memory]"
+    return text[:max(0, max_characters - len(note))] + note
+
+
+def load_structured_memory(memory_store, memory_id):
+    """Returns the parsed contents of a STRUCTURED_MEMORY_TOOL_GROUP item or None"""
+
+    try:
+        item = memory_store.get_item(memory_id)
+        if item and item.get("contents"):
+            return json.loads(item["contents"])
+    except Exception as e:
+        print(f"Could not prefetch memory id {memory_id}: {e}")
+
+    return None
+
+
+def load_memory(memory_store, memory_id):
+    """Returns the text of a MEMORY_TOOL_GROUP item or None"""
+
+    try:
+        item = memory_store.get_item(memory_id)
+        if item and item.get("memory"):
+            return item["memory"]
+    except Exception as e:
+        print(f"Could not prefetch memory id {memory_id}: {e}")
+
+    return None
+
+
+def prefetch_memory_context(memory_store, tool_group_name=STRUCTURED_MEMORY_TOOL_GROUP_NAME,
+                            pinned_memory_titles=None, pinned_memory_ids=None, token_budget=2000):
+    """
+    Loads the memories the model reads first so they can be injected into the
+    first user message, saving the turn spent reading them.
+
+    With STRUCTURED_MEMORY_TOOL_GROUP this is the memory index and the memories
+    titled pinned_memory_titles. With MEMORY_TOOL_GROUP, which has no index,
+    it is the main memory (memory id 1) and the pinned_memory_ids, read concurrently.
+
+    Parameters:
+    - memory_store (MemoryStore) The memory store
+    - tool_group_name (str) The memory tool group registered with the agent
+    - pinned_memory_titles (List[str]) Titles of the memories to load with the index
+    - pinned_memory_ids (List[str]) Memory ids to load with the main memory
+    - token_budget (int) The approximate number of tokens the context may use
+
+    Returns:
+    - (str) The memory context text, or None if there is nothing to inject
+    """
+
+    if tool_group_name == MEMORY_TOOL_GROUP_NAME:
+        return prefetch_main_memory(memory_store, pinned_memory_ids or [], token_budget)
+
+    if pinned_memory_titles is None:
+        pinned_memory_titles = DEFAULT_PINNED_MEMORY_TITLES
+
+    memory_index = load_structured_memory(memory_store, "1")
+    if not memory_index or "memories" not in memory_index:
+        return None
+
+    index_text = truncate_to_budget(json.dumps(memory_index), token_budget)
+    remaining_budget = token_budget - estimate_tokens(index_text)
+
+    pinned_entries = [entry for entry in memory_index["memories"] if entry.get("title") in pinned_memory_titles]
+
+    # Fetch the pinned memories concurrently
+    pinned_memories = []
+    if pinned_entries and remaining_budget > 0:
+        with ThreadPoolExecutor(max_workers=len(pinned_entries)) as executor:
+            memories = executor.map(lambda entry: load_structured_memory(memory_store, entry["memory_id"]), pinned_entries)
+
+            for entry, memory in zip(pinned_entries, memories):
+                if memory is None or remaining_budget <= 0:
+                    continue
+
+                memory_text = truncate_to_budget(
+                    f"Memory id {entry['memory_id']} - {entry['title']}:\n{memory.get('contents', '')}",
+                    remaining_budget
+                )
+                remaining_budget -= estimate_tokens(memory_text)
+                pinned_memories.append(memory_text)
+
+    return MEMORY_PREFETCH_PROMPT_TEMPLATE.format(
+        memory_index=index_text,
+        pinned_memories="\n\n".join(pinned_memories) or "None"
+    )
+
+
+def prefetch_main_memory(memory_store, pinned_memory_ids, token_budget):
+    """Loads the main memory and the pinned memories of MEMORY_TOOL_GROUP"""
+
+    memory_ids = [MAIN_MEMORY_ID] + [str(memory_id) for memory_id in pinned_memory_ids if str(memory_id) != MAIN_MEMORY_ID]
+
+    with ThreadPoolExecutor(max_workers=len(memory_ids)) as executor:
+        main_memory, *pinned = executor.map(lambda memory_id: load_memory(memory_store, memory_id), memory_ids)
+
+    if main_memory is None and not any(pinned):
+        return None
+
+    main_text = truncate_to_budget(main_memory or "Empty", token_budget)
+    remaining_budget = token_budget - estimate_tokens(main_text)
+
+    pinned_memories = []
+    for memory_id, memory in zip(memory_ids[1:], pinned):
+        if memory is None or remaining_budget <= 0:
+            continue
+
+        memory_text = truncate_to_budget(f"Memory id {memory_id}:\n{memory}", remaining_budget)
+        remaining_budget -= estimate_tokens(memory_text)
+        pinned_memories.append(memory_text)
+
+    return MAIN_MEMORY_PREFETCH_PROMPT_TEMPLATE.format(
+        main_memory=main_text,
+        pinned_memories="\n\n".join(pinned_memories) or "None"
+    )
@@ -0,0 +1,302 @@
+import re
+import math
+import zlib
+from collections import Counter
+
+# The search index is persisted as regular items in the memory table, one per
+# shard ("search_index#<n>"). Memories are spread over the shards by a hash of
+# their memory_id, so an update only rewrites one shard and the index can grow
+# to SEARCH_INDEX_SHARDS times the DynamoDB item size limit (400 KB per shard).
+SEARCH_INDEX_MEMORY_ID = "search_index"
+SEARCH_INDEX_SHARDS = 8
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+")
+HEADER_PATTERN = re.compile(r"^(#{1,6})\s+(.*)$", re.MULTILINE)
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "is", "it", "of", "on", "or", "that", "the", "this", "to", "with"
+}
+
+
+def normalize_term(term):
+    """Strips a trailing plural 's' so that 'employees' matches 'employee'"""
+
+    if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        return term[:-1]
+    return term
+
+
+def tokenize(text):
+    """
+    Lowercases and splits text into search terms. Identifiers such as
+    department_id are kept whole and also split into their parts.
+
+    Parameters:
+    - text (str) The text to tokenize
+
+    Returns:
+    - (List[str]) The search terms
+    """
+
+    if not text:
+        return []
+
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+
+        terms.append(normalize_term(token))
+
+        if "_" in token:
+            terms.extend(normalize_term(part) for part in token.split("_") if part and part not in STOP_WORDS)
+
+    return terms
+
+
+def search_index_shard(memory_id):
+    """Returns the shard of the search index that holds a memory"""
+
+    return zlib.crc32(str(memory_id).encode("utf-8")) % SEARCH_INDEX_SHARDS
+
+
+def search_index_shard_id(shard):
+    return f"{SEARCH_INDEX_MEMORY_ID}#{shard}"
+
+
+def chunk_memory(contents):
+    """
+    Splits memory contents into sections on markdown headers
+
+    Parameters:
+    - contents (str) The memory contents
+
+    Returns:
+    - (List[dict]) Sections with heading, level, start and end character offsets
+    """
+
+    contents = contents or ""
+    headers = list(HEADER_PATTERN.finditer(contents))
+
+    if not headers:
+        return [{"heading": "", "level": 0, "start": 0, "end": len(contents)}]
+
+    chunks = []
+
+    # Text before the first header
+    if contents[:headers[0].start()].strip():
+        chunks.append({"heading": "", "level": 0, "start": 0, "end": headers[0].start()})
+
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(contents)
+        chunks.append({
+            "heading": header.group(2).strip(),
+            "level": len(header.group(1)),
+            "start": header.start(),
+            "end": end
+        })
+
+    return chunks
+
+
+class MemorySearchIndex():
+    """
+    BM25 inverted index over memory sections. Each section of a memory is
+    indexed as its own document along with the memory title and description,
+    so results point at the section to read instead of the whole memory.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+        # term -> {chunk_id: term frequency}
+        self.postings = {}
+
+        # chunk_id -> {memory_id, title, heading, start, end, length, terms}
+        self.chunks = {}
+
+        self.total_length = 0
+
+        # Version of the persisted copy this index was loaded from
+        self.version = None
+
+    def add_memory(self, memory_id, title, description, contents):
+        """Indexes a memory, replacing any previous version of it"""
+
+        memory_id = str(memory_id)
+        self.remove_memory(memory_id)
+
+        for n, chunk in enumerate(chunk_memory(contents)):
+            self.add_chunk(memory_id, n, title, description, chunk, contents[chunk["start"]:chunk["end"]])
+
+    def update_section(self, memory_id, section_id, title, description, chunk, section_contents):
+        """
+        Re-indexes one section of a memory that was edited in place, and moves
+        the offsets of the sections after it by the change in length
+
+        Returns:
+        - (bool) False if the section is not in the index, the caller then indexes the whole memory
+        """
+
+        memory_id = str(memory_id)
+        previous = self.chunks.get(f"{memory_id}#{section_id}")
+        if previous is None:
+            return False
+
+        self.remove_chunk(f"{memory_id}#{section_id}")
+        self.add_chunk(memory_id, section_id, title, description, chunk, section_contents)
+
+        shift = (chunk["end"] - chunk["start"]) - (previous["end"] - previous["start"])
+        for other in self.chunks.values():
+            if other["memory_id"] == memory_id and other["start"] >= previous["end"]:
+                other["start"] += shift
+                other["end"] += shift
+
+        return True
+
+    def add_chunk(self, memory_id, n, title, description, chunk, chunk_contents):
+        chunk_id = f"{memory_id}#{n}"
+        term_counts = Counter(tokenize(title) + tokenize(description) + tokenize(chunk_contents))
+
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[chunk_id] = count
+
+        length = sum(term_counts.values())
+        self.total_length += length
+
+        self.chunks[chunk_id] = {
+            "memory_id": memory_id,
+            "title": title,
+            "heading": chunk["heading"],
+            "start": chunk["start"],
+            "end": chunk["end"],
+            "length": length,
+            "terms": list(term_counts.keys())
+        }
+
+    def remove_memory(self, memory_id):
+        """Removes all sections of a memory from the index"""
+
+        memory_id = str(memory_id)
+        chunk_ids = [chunk_id for chunk_id, chunk in self.chunks.items() if chunk["memory_id"] == memory_id]
+
+        for chunk_id in chunk_ids:
+            self.remove_chunk(chunk_id)
+
+    def remove_chunk(self, chunk_id):
+        chunk = self.chunks.pop(chunk_id)
+        self.total_length -= chunk["length"]
+
+        for term in chunk["terms"]:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query, top_k=5):
+        """
+        Ranks memory sections against the query
+
+        Parameters:
+        - query (str) The search query
+        - top_k (int) The maximum number of results
+
+        Returns:
+        - (List[dict]) The matching sections with their score, best first
+        """
+
+        n_chunks = len(self.chunks)
+        if n_chunks == 0:
+            return []
+
+        avg_length = (self.total_length / n_chunks) or 1
+        scores = {}
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (n_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            for chunk_id, tf in postings.items():
+                length = self.chunks[chunk_id]["length"]
+                norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0) + idf * tf * (self.k1 + 1) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+        results = []
+        for chunk_id, score in ranked:
+            chunk = self.chunks[chunk_id]
+            results.append({
+                "memory_id": chunk["memory_id"],
+                "section_id": chunk_id.split("#", 1)[1],
+                "title": chunk["title"],
+                "heading": chunk["heading"],
+                "start": chunk["start"],
+                "end": chunk["end"],
+                "score": round(score, 4)
+            })
+
+        return results
+
+    def to_dict(self):
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "postings": self.postings,
+            "chunks": self.chunks,
+            "total_length": self.total_length
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        index.postings = data.get("postings", {})
+        index.chunks = data.get("chunks", {})
+        index.total_length = data.get("total_length", 0)
+        return index
+
+    @classmethod
+    def merge(cls, indexes):
+        """Combines the shards of an index into one index to search"""
+
+        merged = cls()
+        for index in indexes:
+            merged.k1, merged.b = index.k1, index.b
+            merged.chunks.update(index.chunks)
+            merged.total_length += index.total_length
+
+            for term, postings in index.postings.items():
+                merged.postings.setdefault(term, {}).update(postings)
+
+        return merged
+
+
+def make_snippet(contents, start, end, query, max_chars=600):
+    """
+    Returns the section text, trimmed around the first query term if too long
+    """
+
+    section = (contents or "")[start:end].strip()
+
+    if len(section) <= max_chars:
+        return section
+
+    lowered = section.lower()
+    positions = [lowered.find(term) for term in tokenize(query)]
+    positions = [position for position in positions if position >= 0]
+    focus = min(positions) if positions else 0
+
+    begin = max(0, focus - max_chars // 3)
+    snippet = section[begin:begin + max_chars]
+
+    prefix = "..." if begin > 0 else ""
+    suffix = "..." if begin + max_chars < len(section) else ""
+
+    return f"{prefix}{snippet}{suffix}"
@@ -0,0 +1,194 @@
+import os
+import json
+import copy
+import sqlite3
+import threading
+
+import tracing
+
+
+class ConditionalWriteError(Exception):
+    """Raised when the condition of a conditional write or delete is not met"""
+    pass
+
+
+class MemoryStore():
+    """
+    Storage interface used by the memory tool groups. Items are dictionaries
+    keyed by their "id" attribute.
+
+    Conditional writes follow DynamoDB semantics:
+    - if_not_exists=True only writes when no item with the same id exists
+    - expected={attribute: value} only writes when the stored item has those
+      attribute values (a value of None means the attribute must be absent)
+    A failed condition raises ConditionalWriteError and leaves the item untouched.
+    """
+
+    def get_item(self, memory_id):
+        """Returns the item for memory_id or None"""
+        raise NotImplementedError
+
+    def put_item(self, item, if_not_exists=False, expected=None):
+        """Creates or replaces an item"""
+        raise NotImplementedError
+
+    def delete_item(self, memory_id, expected=None):
+        """Deletes an item. Deleting a missing item is not an error"""
+        raise NotImplementedError
+
+    @staticmethod
+    def check_condition(current, if_not_exists=False, expected=None):
+        if if_not_exists and current is not None:
+            raise ConditionalWriteError("Item already exists")
+
+        for attribute, value in (expected or {}).items():
+            current_value = current.get(attribute) if current is not None else None
+            if current_value != value:
+                raise ConditionalWriteError(f"Expected {attribute}={value!r} but found {current_value!r}")
+
+
+class DynamoDBMemoryStore(MemoryStore):
+
+    def __init__(self, table_name, dynamodb=None):
+        import boto3
+
+        self.dynamodb = dynamodb or boto3.resource('dynamodb')
+        self.table_name = table_name
+        self.table = self.dynamodb.Table(table_name)
+
+    def get_item(self, memory_id):
+        with tracing.span("dynamodb.get_item", table=self.table_name) as span:
+            response = self.table.get_item(Key={'id': str(memory_id)})
+            span.set_attribute("found", 'Item' in response)
+        return response.get('Item')
+
+    def put_item(self, item, if_not_exists=False, expected=None):
+        kwargs = self.build_condition(if_not_exists, expected)
+
+        with tracing.span("dynamodb.put_item", table=self.table_name, conditional=bool(kwargs)):
+            try:
+                self.table.put_item(Item=item, **kwargs)
+            except self.table.meta.client.exceptions.ConditionalCheckFailedException as e:
+                raise ConditionalWriteError(str(e)) from e
+
+    def delete_item(self, memory_id, expected=None):
+        kwargs = self.build_condition(False, expected)
+
+        with tracing.span("dynamodb.delete_item", table=self.table_name, conditional=bool(kwargs)):
+            try:
+                self.table.delete_item(Key={'id': str(memory_id)}, **kwargs)
+            except self.table.meta.client.exceptions.ConditionalCheckFailedException as e:
+                raise ConditionalWriteError(str(e)) from e
+
+    @staticmethod
+    def build_condition(if_not_exists, expected):
+        from boto3.dynamodb.conditions import Attr
+
+        condition = None
+
+        if if_not_exists:
+            condition = Attr('id').not_exists()
+
+        for attribute, value in (expected or {}).items():
+            clause = Attr(attribute).not_exists() if value is None else Attr(attribute).eq(value)
+            condition = clause if condition is None else condition & clause
+
+        return {'ConditionExpression': condition} if condition is not None else {}
+
+
+class InMemoryMemoryStore(MemoryStore):
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_item(self, memory_id):
+        with self.lock:
+            item = self.items.get(str(memory_id))
+            return copy.deepcopy(item)
+
+    def put_item(self, item, if_not_exists=False, expected=None):
+        with self.lock:
+            self.check_condition(self.items.get(str(item['id'])), if_not_exists, expected)
+            self.items[str(item['id'])] = copy.deepcopy(item)
+
+    def delete_item(self, memory_id, expected=None):
+        with self.lock:
+            self.check_condition(self.items.get(str(memory_id)), False, expected)
+            self.items.pop(str(memory_id), None)
+
+
+class SQLiteMemoryStore(MemoryStore):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS memories (id TEXT PRIMARY KEY, item TEXT NOT NULL)"
+        )
+
+    def get_item(self, memory_id):
+        with self.lock:
+            return self._get(str(memory_id))
+
+    def put_item(self, item, if_not_exists=False, expected=None):
+        with self.lock, self._transaction():
+            self.check_condition(self._get(str(item['id'])), if_not_exists, expected)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO memories (id, item) VALUES (?, ?)",
+                (str(item['id']), json.dumps(item))
+            )
+
+    def delete_item(self, memory_id, expected=None):
+        with self.lock, self._transaction():
+            self.check_condition(self._get(str(memory_id)), False, expected)
+            self.connection.execute("DELETE FROM memories WHERE id = ?", (str(memory_id),))
+
+    def _get(self, memory_id):
+        row = self.connection.execute("SELECT item FROM memories WHERE id = ?", (memory_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _transaction(self):
+        return _SQLiteTransaction(self.connection)
+
+
+class _SQLiteTransaction():
+    """Holds a write lock on the database so the condition check and write are atomic"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def create_memory_store(backend=None, table_name=None, sqlite_path=None):
+    """
+    Creates the memory store selected by configuration
+
+    Parameters:
+    - backend (str) One of dynamodb, memory or sqlite. Defaults to the MEMORY_BACKEND
+      environment variable, then dynamodb
+    - table_name (str) The DynamoDB table name
+    - sqlite_path (str) The SQLite database file. Defaults to the MEMORY_SQLITE_PATH
+      environment variable, then /tmp/agent_memory.db
+
+    Returns:
+    - (MemoryStore) The memory store
+    """
+
+    backend = (backend or os.environ.get('MEMORY_BACKEND', 'dynamodb')).lower()
+
+    if backend == 'dynamodb':
+        return DynamoDBMemoryStore(table_name)
+    elif backend == 'memory':
+        return InMemoryMemoryStore()
+    elif backend == 'sqlite':
+        return SQLiteMemoryStore(sqlite_path or os.environ.get('MEMORY_SQLITE_PATH', '/tmp/agent_memory.db'))
+    else:
+        raise ValueError(f"Unsupported memory backend: {backend}")
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import threading
+import functools
+
+# Metrics are aggregated in process and written as CloudWatch Embedded Metric Format log lines
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ConverseSqlAgent')
+
+# EMF accepts at most 100 values per metric and 100 metrics per log line
+MAX_VALUES = 100
+MAX_METRICS = 100
+
+# Units
+MILLISECONDS = "Milliseconds"
+BYTES = "Bytes"
+COUNT = "Count"
+NONE = "None"
+
+
+class Metrics():
+    """
+    Collects metric values in process and writes them as EMF log lines on
+    flush(), one line per set of dimensions. Recording a value only appends
+    to a list, so flush once per invocation rather than per event.
+
+    Ratios such as cache hit rates are recorded as 1 or 0 per lookup, so their
+    CloudWatch average is the rate.
+
+    Parameters:
+    - namespace (str) The CloudWatch namespace
+    - dimensions (dict) Dimensions added to every metric, e.g. the function name
+    - output (Callable) Called with each log line, print by default
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE, dimensions=None, output=print):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.output = output
+        self.values = {}  # (sorted dimension items) -> {metric name: (unit, [values])}
+        self.lock = threading.Lock()
+
+    def put(self, name, value, unit=NONE, **dimensions):
+        if value is None:
+            return
+
+        key = tuple(sorted({**self.dimensions, **dimensions}.items()))
+        with self.lock:
+            metrics = self.values.setdefault(key, {})
+            metrics.setdefault(name, (unit, []))[1].append(value)
+
+    def increment(self, name, **dimensions):
+        self.put(name, 1, COUNT, **dimensions)
+
+    def flush(self):
+        """
+        Writes the collected values and clears them
+
+        Returns:
+        - (List[dict]) The EMF documents that were written
+        """
+
+        with self.lock:
+            values, self.values = self.values, {}
+
+        documents = []
+        timestamp = int(time.time() * 1000)
+
+        for key, metrics in values.items():
+            # Split values and metrics over several lines to stay within the EMF limits
+            chunks = [
+                (name, unit, metric_values[i:i + MAX_VALUES])
+                for name, (unit, metric_values) in metrics.items()
+                for i in range(0, len(metric_values), MAX_VALUES)
+            ]
+
+            while chunks:
+                document = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [[name for name, _ in key]],
+                            "Metrics": []
+                        }]
+                    },
+                    **dict(key)
+                }
+
+                remaining = []
+                for name, unit, metric_values in chunks:
+                    if name in document or len(document["_aws"]["CloudWatchMetrics"][0]["Metrics"]) >= MAX_METRICS:
+                        remaining.append((name, unit, metric_values))
+                        continue
+                    document["_aws"]["CloudWatchMetrics"][0]["Metrics"].append({"Name": name, "Unit": unit})
+                    document[name] = metric_values if len(metric_values) > 1 else metric_values[0]
+
+                chunks = remaining
+                documents.append(document)
+
+        for document in documents:
+            try:
+                self.output(json.dumps(document, default=str))
+            except Exception as e:
+                print(f"Failed to write metrics: {e}")
+
+        return documents
+
+
+class NullMetrics(Metrics):
+    """Discards all values"""
+
+    def put(self, name, value, unit=NONE, **dimensions):
+        pass
+
+    def flush(self):
+        return []
+
+
+def create_metrics(enabled=None, namespace=None):
+    """Returns Metrics when METRICS_ENABLED (or enabled) is true, else NullMetrics"""
+
+    enabled = METRICS_ENABLED if enabled is None else enabled
+    if not enabled:
+        return NullMetrics()
+
+    dimensions = {}
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        dimensions["FunctionName"] = os.environ['AWS_LAMBDA_FUNCTION_NAME']
+
+    return Metrics(namespace=namespace or METRICS_NAMESPACE, dimensions=dimensions)
+
+
+# The process wide metrics, shared by all runs of a warm Lambda or the server
+_metrics = create_metrics()
+
+
+def configure_metrics(metrics):
+    global _metrics
+    _metrics = metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def put_metric(name, value, unit=NONE, **dimensions):
+    _metrics.put(name, value, unit, **dimensions)
+
+
+def flushed(function):
+    """
+    Decorator that flushes the metrics when the function returns, e.g. once per
+    Lambda invocation. The server runs requests concurrently and flushes on an
+    interval instead.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _metrics.flush()
+
+    return wrapper
@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+import time
+import pstats
+import random
+import cProfile
+import tempfile
+import threading
+
+# Profile 1 in PROFILE_SAMPLE_RATE runs, never when 0
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+
+# Also profile runs whose request has "profile": true
+PROFILE_REQUEST_FLAG = os.environ.get('PROFILE_REQUEST_FLAG', 'false').lower() == 'true'
+
+# A local directory, or s3://bucket/prefix
+PROFILE_DESTINATION = os.environ.get('PROFILE_DESTINATION', os.path.join(tempfile.gettempdir(), 'profiles'))
+
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '20'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler():
+    """
+    Samples the stack of one thread from a background thread and counts the
+    collapsed stacks ("outer;inner count" lines, the input of flamegraph.pl
+    and speedscope). Sampling sees time spent in C code and waiting on I/O,
+    which cProfile attributes to the calling function only.
+
+    Parameters:
+    - thread_id (int) The thread to sample, the current thread by default
+    - interval_seconds (float) Time between samples
+    """
+
+    def __init__(self, thread_id=None, interval_seconds=PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval_seconds = interval_seconds
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+
+        stack = ";".join(reversed(labels))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+
+def top_functions(stats, top_n=PROFILE_TOP_N):
+    """
+    Returns:
+    - (List[dict]) The functions with the most own time, with their call count and own and cumulative time in milliseconds
+    """
+
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, own_time, cumulative_time, _) in stats.stats.items():
+        rows.append({
+            "function": f"{function} ({os.path.basename(filename)}:{line})",
+            "calls": calls,
+            "own_ms": round(own_time * 1000, 2),
+            "cumulative_ms": round(cumulative_time * 1000, 2)
+        })
+
+    return sorted(rows, key=lambda row: -row["own_ms"])[:top_n]
+
+
+def write_profile(name, collapsed, stats, destination=None):
+    """
+    Writes the collapsed stacks (<name>.collapsed) and the pstats file (<name>.pstats)
+
+    Parameters:
+    - destination (str) A local directory or s3://bucket/prefix, PROFILE_DESTINATION by default
+
+    Returns:
+    - (List[str]) Where the files were written
+    """
+
+    destination = destination or PROFILE_DESTINATION
+
+    with tempfile.NamedTemporaryFile(suffix=".pstats", delete=False) as f:
+        pstats_path = f.name
+    try:
+        stats.dump_stats(pstats_path)
+        with open(pstats_path, "rb") as f:
+            pstats_data = f.read()
+    finally:
+        os.remove(pstats_path)
+
+    files = {f"{name}.collapsed": collapsed.encode("utf-8"), f"{name}.pstats": pstats_data}
+
+    if destination.startswith("s3://"):
+        import boto3
+
+        bucket, _, prefix = destination[len("s3://"):].partition("/")
+        s3 = boto3.client("s3")
+        locations = []
+        for filename, data in files.items():
+            key = f"{prefix.rstrip('/')}/{filename}" if prefix else filename
+            s3.put_object(Bucket=bucket, Key=key, Body=data)
+            locations.append(f"s3://{bucket}/{key}")
+        return locations
+
+    os.makedirs(destination, exist_ok=True)
+    locations = []
+    for filename, data in files.items():
+        path = os.path.join(destination, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        locations.append(path)
+    return locations
+
+
+def should_profile(requested=False):
+    """Returns True for 1 in PROFILE_SAMPLE_RATE runs, or when the request asked for a profile and PROFILE_REQUEST_FLAG allows it"""
+
+    if requested and PROFILE_REQUEST_FLAG:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < 1 / PROFILE_SAMPLE_RATE
+
+
+def profile(function, name=None, destination=None, top_n=PROFILE_TOP_N):
+    """
+    Calls function under cProfile and the sampling profiler, writes both
+    profiles and logs the functions with the most own time
+
+    Parameters:
+    - function (Callable) Called without arguments
+    - name (str) The file name of the profiles, a timestamp by default
+
+    Returns:
+    - The return value of function
+    """
+
+    name = name or time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    profiler = cProfile.Profile()
+    sampler = SamplingProfiler()
+
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler is already active on this thread
+        print(f"Profiling skipped: {e}")
+        return function()
+
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        sampler.stop()
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            stats = pstats.Stats(profiler, stream=io.StringIO())
+            locations = write_profile(name, sampler.collapsed(), stats, destination)
+
+            print(f"Profile {name}: {duration_ms:.1f} ms, {sampler.samples} samples, written to {', '.join(locations)}")
+            print(f"{'own ms':>10} {'cumulative ms':>14} {'calls':>8}  function")
+            for row in top_functions(stats, top_n):
+                print(f"{row['own_ms']:10.2f} {row['cumulative_ms']:14.2f} {row['calls']:8}  {row['function']}")
+        except Exception as e:
+            print(f"Failed to write profile {name}: {e}")
@@ -101,4 +101,75 @@ in "Best Practices and Error Avoidance" memory for general learnings.
 If you have specific learnings not applicable to all situations,
 create a new memory.
 
-"""
\ No newline at end of file
+6. When looking for a specific fact, use search_memory before reading
+whole memories. It returns the matching sections with their memory_id.
+
+7. For large memories, use list_memory_sections and read_memory_section
+to read only the sections you need, and update_memory_section to change
+a single section.
+
+"""
+MEMORY_PREFETCH_PROMPT_TEMPLATE = """
+<prefetched_memory>
+Your memory index and pinned memories have already been read for you.
+Do not call get_memory_index or read these memories again unless you
+need to see changes made during this request.
+
+<memory_index>
+{memory_index}
+</memory_index>
+
+<pinned_memories>
+{pinned_memories}
+</pinned_memories>
+</prefetched_memory>
+"""
+
+MAIN_MEMORY_PREFETCH_PROMPT_TEMPLATE = """
+<prefetched_memory>
+Your main memory (memory id 1) and pinned memories have already been read
+for you. Do not call read_memory for these memory ids again unless you
+need to see changes made during this request.
+
+<main_memory>
+{main_memory}
+</main_memory>
+
+<pinned_memories>
+{pinned_memories}
+</pinned_memories>
+</prefetched_memory>
+"""
+
+DEFERRED_REFLECTION_PROMPT = """
+<deferred_reflection>
+Reflection is deferred for this request. Do not spend steps writing
+"Best Practices and Error Avoidance" or other learnings to memory while
+answering. A separate run will review this transcript and update your
+memory after your final response has been delivered. Focus on answering
+the request and provide your <final_response> as soon as you can.
+</deferred_reflection>
+"""
+
+REFLECTION_PROMPT_TEMPLATE = """
+The following is the transcript of a request that you have already
+answered. The answer has been delivered to the user, do not answer it again.
+
+Review the transcript and reflect on how to better execute similar requests
+next time and how to avoid the errors that occurred. Read your memory, then
+store these learnings in the "Best Practices and Error Avoidance" memory,
+and any specific learnings (for example a data dictionary of the tables that
+were used) in the appropriate memories. Do not run any queries other than
+those needed to verify a learning.
+
+When you are done, put a short summary of the memory updates in
+<final_response> tags.
+
+<transcript>
+{transcript}
+</transcript>
+
+<delivered_final_response>
+{final_response}
+</delivered_final_response>
+"""
@@ -0,0 +1,349 @@
+import os
+import re
+import json
+import time
+import math
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from memory_store import ConditionalWriteError, create_memory_store
+
+# A query shape is slow when its mean latency is at least this many milliseconds
+QUERY_LOG_SLOW_MS = float(os.environ.get('QUERY_LOG_SLOW_MS', '5000'))
+
+# A query shape is failing when it failed at least this many times and more often than it succeeded
+QUERY_LOG_FAILING_ERRORS = int(os.environ.get('QUERY_LOG_FAILING_ERRORS', '2'))
+
+# Statistics of a query shape that is not run again expire after this many days
+QUERY_LOG_TTL_DAYS = int(os.environ.get('QUERY_LOG_TTL_DAYS', '30'))
+
+# Executions kept per query shape, with their question
+QUERY_LOG_RECENT = int(os.environ.get('QUERY_LOG_RECENT', '5'))
+
+MAX_QUERY_CHARS = 2000
+MAX_ERROR_CHARS = 300
+
+
+def normalize_query(query):
+    """
+    Returns the shape of a query: comments removed, literals replaced by ?,
+    lists of literals collapsed, whitespace collapsed and lowercased, so
+    queries that differ only in their constants share a fingerprint
+    """
+
+    query = re.sub(r"--[^\n]*", " ", query or "")
+    query = re.sub(r"/\*.*?\*/", " ", query, flags=re.DOTALL)
+    query = re.sub(r"'(?:[^'\\]|\\.|'')*'", "?", query)
+    query = re.sub(r"\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", "?", query, flags=re.IGNORECASE)
+    query = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", query)
+    query = re.sub(r"\s*([,=<>])\s*", r"\1", query)
+    query = re.sub(r"\(\s+", "(", query)
+    query = re.sub(r"\s+\)", ")", query)
+    query = re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+    return query.lower()
+
+
+def fingerprint(normalized_query):
+    return hashlib.sha256(normalized_query.encode("utf-8")).hexdigest()[:16]
+
+
+def stats_id(database_name, query_fingerprint):
+    return f"querystats#{database_name or ''}#{query_fingerprint}"
+
+
+def error_class(error):
+    """Returns the class of the driver error behind a SQLAlchemy error, e.g. pymysql.ProgrammingError"""
+
+    cause = getattr(error, "orig", None) or error
+    module = type(cause).__module__.split(".")[0]
+    name = type(cause).__name__
+    return name if module == "builtins" else f"{module}.{name}"
+
+
+def error_message(error):
+    """Returns the first line of the driver's error message, without the statement SQLAlchemy appends"""
+
+    message = str(getattr(error, "orig", None) or error).strip()
+    return message.splitlines()[0][:MAX_ERROR_CHARS] if message else ""
+
+
+def new_stats(database_name, normalized_query, now):
+    return {
+        "database": database_name,
+        "fingerprint": fingerprint(normalized_query),
+        "query": normalized_query,
+        "calls": 0,
+        "errors": 0,
+        "total_ms": 0.0,
+        "sum_squares_ms": 0.0,
+        "min_ms": None,
+        "max_ms": None,
+        "rows": 0,
+        "bytes": 0,
+        "error_classes": {},
+        "last_error": None,
+        "first_seen": now,
+        "last_seen": now,
+        "recent": []
+    }
+
+
+def summarize_stats(stats):
+    """Adds the mean and standard deviation of the latency and the mean rows and bytes per successful call"""
+
+    calls = stats["calls"]
+    successes = calls - stats["errors"]
+    mean_ms = stats["total_ms"] / calls if calls else None
+    variance = stats["sum_squares_ms"] / calls - mean_ms ** 2 if calls else None
+
+    return {
+        **stats,
+        "mean_ms": round(mean_ms, 1) if mean_ms is not None else None,
+        "stddev_ms": round(math.sqrt(max(variance, 0)), 1) if variance is not None else None,
+        "mean_rows": round(stats["rows"] / successes, 1) if successes else None,
+        "mean_bytes": round(stats["bytes"] / successes) if successes else None
+    }
+
+
+class QueryLog():
+    """
+    Logs every statement run by invoke_sql_query and keeps statistics per
+    query shape (like pg_stat_statements): calls, errors by class, latency
+    min/max/mean/stddev, rows and bytes, and the last executions with the
+    question that led to them. Statistics are kept in one item per database
+    and fingerprint of a memory store, updated with optimistic concurrency
+    on the item version.
+
+    The statistics are used to warn the model before it repeats a query
+    shape that is known to be slow or to fail. Logging never fails a query.
+
+    A run passes a cache (a dict it keeps for its duration) so each query
+    shape is read once per run and then kept up to date with the run's own
+    executions, and records with record_in_background so the statistics are
+    written after the query result has been returned. Call flush before the
+    process may be frozen, e.g. at the end of a Lambda invocation.
+
+    Parameters:
+    - store (MemoryStore) Any memory store backend
+    - slow_ms (float) The mean latency from which a query shape is slow
+    - failing_errors (int) The errors from which a query shape is failing
+    - ttl_days (int) How long the statistics of a query shape are kept after its last call
+    - max_recent (int) Executions kept per query shape
+    - max_attempts (int) Attempts of a contended update before the execution is dropped
+    """
+
+    def __init__(self, store,
+                 slow_ms=QUERY_LOG_SLOW_MS,
+                 failing_errors=QUERY_LOG_FAILING_ERRORS,
+                 ttl_days=QUERY_LOG_TTL_DAYS,
+                 max_recent=QUERY_LOG_RECENT,
+                 max_attempts=5):
+
+        self.store = store
+        self.slow_ms = slow_ms
+        self.failing_errors = failing_errors
+        self.ttl_days = ttl_days
+        self.max_recent = max_recent
+        self.max_attempts = max_attempts
+
+        # Statistics are written by one thread, in the order the executions were recorded
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def get_stats(self, database_name, query, cache=None):
+        """
+        Parameters:
+        - cache (dict) The statistics already read by the run, see record_in_background
+
+        Returns:
+        - (dict) The statistics of the query's shape, or None if it was not run before
+        """
+
+        normalized = normalize_query(query)
+        key = stats_id(database_name, fingerprint(normalized))
+
+        if cache is not None and key in cache:
+            with self.lock:
+                return summarize_stats(cache[key]) if cache[key] else None
+
+        try:
+            item = self.store.get_item(key)
+        except Exception as e:
+            print(f"Failed to read the query log: {e}")
+            return None
+
+        stats = json.loads(item["stats"]) if item else None
+        if cache is not None:
+            with self.lock:
+                stats = cache.setdefault(key, stats)
+
+        return summarize_stats(stats) if stats else None
+
+    def new_execution(self, database_name, query, duration_ms, rows, output_bytes, error, question):
+        """Logs one execution and returns it"""
+
+        execution = {
+            "at": round(time.time(), 3),
+            "duration_ms": round(duration_ms, 1),
+            "rows": rows,
+            "bytes": output_bytes,
+            "error_class": error_class(error) if error is not None else None,
+            "question": question
+        }
+        print(f"Query log: {json.dumps({'database': database_name, 'fingerprint': fingerprint(normalize_query(query)), **execution})}")
+
+        return execution
+
+    def record(self, database_name, query, duration_ms, rows=None, output_bytes=None, error=None, question=None):
+        """
+        Logs one execution and adds it to the statistics of its query shape
+
+        Parameters:
+        - error (Exception) The error the query failed with, None if it succeeded
+        - question (str) The user's question that led to the query
+
+        Returns:
+        - (dict) The updated statistics, or None if they could not be updated
+        """
+
+        execution = self.new_execution(database_name, query, duration_ms, rows, output_bytes, error, question)
+        return self.write(database_name, query, execution, error)
+
+    def record_in_background(self, database_name, query, duration_ms, rows=None, output_bytes=None, error=None, question=None, cache=None):
+        """
+        Like record, but the statistics are updated on a background thread. The
+        execution is added to the run's cached statistics of its shape right away,
+        so later warnings of the run account for it without reading the store again.
+        """
+
+        execution = self.new_execution(database_name, query, duration_ms, rows, output_bytes, error, question)
+
+        if cache is not None:
+            normalized = normalize_query(query)
+            key = stats_id(database_name, fingerprint(normalized))
+            with self.lock:
+                if key in cache:
+                    if cache[key] is None:
+                        cache[key] = new_stats(database_name, normalized, execution["at"])
+                    self.add_execution(cache[key], execution, query, error)
+
+        future = self.writer.submit(self.write, database_name, query, execution, error)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.discard)
+
+    def discard(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def flush(self, timeout=None):
+        """Waits for the statistics recorded in the background to be written"""
+
+        with self.lock:
+            pending = list(self.pending)
+
+        if pending:
+            wait(pending, timeout=timeout)
+
+    def write(self, database_name, query, execution, error):
+        """Adds an execution to the stored statistics of its query shape"""
+
+        normalized = normalize_query(query)
+        query_fingerprint = fingerprint(normalized)
+        now = execution["at"]
+
+        key = stats_id(database_name, query_fingerprint)
+
+        for _ in range(self.max_attempts):
+            try:
+                item = self.store.get_item(key)
+                stats = json.loads(item["stats"]) if item else new_stats(database_name, normalized, now)
+                version = int(item["version"]) if item else None
+
+                self.add_execution(stats, execution, query, error)
+
+                self.store.put_item(
+                    {
+                        "id": key,
+                        "stats": json.dumps(stats),
+                        "version": (version or 0) + 1,
+                        "expires_at": int(now) + self.ttl_days * 86400
+                    },
+                    expected={"version": version}
+                )
+                return summarize_stats(stats)
+            except ConditionalWriteError:
+                # Another run updated the statistics, apply the execution again
+                continue
+            except Exception as e:
+                print(f"Failed to update the query log: {e}")
+                return None
+
+        print(f"Dropped a query log entry of {query_fingerprint}, the statistics are too contended")
+        return None
+
+    def add_execution(self, stats, execution, query, error):
+        duration_ms = execution["duration_ms"]
+
+        stats["calls"] += 1
+        stats["total_ms"] += duration_ms
+        stats["sum_squares_ms"] += duration_ms ** 2
+        stats["min_ms"] = duration_ms if stats["min_ms"] is None else min(stats["min_ms"], duration_ms)
+        stats["max_ms"] = duration_ms if stats["max_ms"] is None else max(stats["max_ms"], duration_ms)
+        stats["last_seen"] = execution["at"]
+        stats["example"] = query[:MAX_QUERY_CHARS]
+
+        if error is not None:
+            stats["errors"] += 1
+            stats["error_classes"][execution["error_class"]] = stats["error_classes"].get(execution["error_class"], 0) + 1
+            stats["last_error"] = {
+                "class": execution["error_class"],
+                "message": error_message(error),
+                "at": execution["at"]
+            }
+        else:
+            stats["rows"] += execution["rows"] or 0
+            stats["bytes"] += execution["bytes"] or 0
+
+        stats["recent"] = (stats["recent"] + [execution])[-self.max_recent:]
+
+    def is_failing(self, stats):
+        return stats["errors"] >= self.failing_errors and stats["errors"] > stats["calls"] - stats["errors"]
+
+    def is_slow(self, stats):
+        return stats["mean_ms"] is not None and stats["mean_ms"] >= self.slow_ms
+
+    def warning(self, stats):
+        """
+        Returns:
+        - (str) A warning for the model when the statistics show a known-failing or known-slow query shape, else None
+        """
+
+        if not stats:
+            return None
+
+        warnings = []
+
+        if self.is_failing(stats):
+            last_error = stats["last_error"] or {}
+            warnings.append(
+                f"This query shape failed {stats['errors']} of {stats['calls']} times before "
+                f"({last_error.get('class')}: {last_error.get('message')}). "
+                "Check the table and column names or change the query rather than running it again as is."
+            )
+
+        if self.is_slow(stats):
+            warnings.append(
+                f"This query shape took {stats['mean_ms']:.0f} ms on average (max {stats['max_ms']:.0f} ms) over {stats['calls']} runs. "
+                "Add filters, aggregate in the database or add a LIMIT if the question allows it."
+            )
+
+        return " ".join(warnings) or None
+
+
+def create_query_log(backend=None, table_name=None, **kwargs):
+    """Creates a query log on the configured store backend (dynamodb, memory or sqlite)"""
+
+    return QueryLog(create_memory_store(backend=backend, table_name=table_name), **kwargs)
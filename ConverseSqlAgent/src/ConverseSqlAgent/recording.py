@@ -0,0 +1,284 @@
+import json
+import gzip
+import time
+import copy
+from datetime import datetime
+
+from fake_bedrock import response_to_stream
+
+TRACE_VERSION = 1
+
+
+def strip_timestamps(content):
+    """Drops the timestamp blocks, which differ between a run and its replay"""
+
+    return [block for block in content if not ("text" in block and block["text"].startswith("Current Datetime:"))]
+
+
+def tool_result_texts(message):
+    return [
+        "\n".join(block["text"] for block in strip_timestamps(chunk["toolResult"]["content"]) if "text" in block)
+        for chunk in message["content"] if "toolResult" in chunk
+    ]
+
+
+class TraceRecorder():
+    """
+    Records the Converse requests and responses and the tool inputs and
+    outputs of agent runs. Pass it to BaseAgent as trace_recorder.
+
+    A trace is a gzipped JSON lines file with one record per line:
+    - {"type": "header", "version", "model_id", "input_text", "recorded_at"}
+    - {"type": "converse", "turn", "duration_ms", "request", "response"}
+      where the request only holds the messages added since the previous
+      call ("messages_from" is the index of the first one) and the system
+      prompt only when it changed
+    - {"type": "tool", "turn", "tool_use_id", "name", "input", "output", "error", "duration_ms"}
+    - {"type": "result", "final_response", "duration_ms"}
+    """
+
+    def __init__(self):
+        self.records = []
+        self.turn = 0
+        self.message_count = 0
+        self.system_prompt = None
+        self.start = None
+
+    def start_run(self, model_id, input_text):
+        self.records = [{
+            "type": "header",
+            "version": TRACE_VERSION,
+            "model_id": model_id,
+            "input_text": input_text,
+            "recorded_at": datetime.now().isoformat()
+        }]
+        self.turn = 0
+        self.message_count = 0
+        self.system_prompt = None
+        self.start = time.perf_counter()
+
+    def record_converse(self, request, response, duration_seconds):
+        self.turn += 1
+
+        messages = request["messages"]
+        compact_request = {
+            "messages_from": self.message_count,
+            "messages": copy.deepcopy(messages[self.message_count:]),
+            "inferenceConfig": request.get("inferenceConfig")
+        }
+
+        system_prompt = request["system"][0]["text"] if request.get("system") else None
+        if system_prompt != self.system_prompt:
+            compact_request["system"] = system_prompt
+            self.system_prompt = system_prompt
+
+        # The response message is part of the next request
+        self.message_count = len(messages) + 1
+
+        self.records.append({
+            "type": "converse",
+            "turn": self.turn,
+            "duration_ms": round(duration_seconds * 1000, 1),
+            "request": compact_request,
+            "response": {key: response[key] for key in ("output", "stopReason", "usage") if key in response}
+        })
+
+    def record_tool(self, tool_use_id, name, tool_input, output, error, duration_seconds):
+        self.records.append({
+            "type": "tool",
+            "turn": self.turn,
+            "tool_use_id": tool_use_id,
+            "name": name,
+            "input": tool_input,
+            "output": output,
+            "error": error,
+            "duration_ms": round(duration_seconds * 1000, 1)
+        })
+
+    def finish_run(self, final_response):
+        self.records.append({
+            "type": "result",
+            "final_response": final_response,
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 1) if self.start else None
+        })
+
+    def to_dict(self):
+        """Returns the state of an unfinished recording, e.g. to continue it after a suspended run is resumed"""
+
+        return {
+            "records": self.records,
+            "turn": self.turn,
+            "message_count": self.message_count,
+            "system_prompt": self.system_prompt,
+            "elapsed_seconds": time.perf_counter() - self.start if self.start else None
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        recorder = cls()
+        recorder.records = data["records"]
+        recorder.turn = data["turn"]
+        recorder.message_count = data["message_count"]
+        recorder.system_prompt = data["system_prompt"]
+        if data.get("elapsed_seconds") is not None:
+            recorder.start = time.perf_counter() - data["elapsed_seconds"]
+        return recorder
+
+    def dumps(self):
+        """Returns the trace as gzipped JSON lines"""
+
+        return gzip.compress("\n".join(json.dumps(record, default=str) for record in self.records).encode("utf-8"))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.dumps())
+        return path
+
+
+def load_trace(path_or_bytes):
+    """Returns the records of a trace file, or of its contents as bytes"""
+
+    if isinstance(path_or_bytes, bytes):
+        data = path_or_bytes
+    else:
+        with open(path_or_bytes, "rb") as f:
+            data = f.read()
+
+    return [json.loads(line) for line in gzip.decompress(data).decode("utf-8").splitlines() if line]
+
+
+class ReplayExhausted(Exception):
+    """Raised when the agent asks for more model responses than the trace has"""
+    pass
+
+
+class ReplayBedrockClient():
+    """
+    Plays back the recorded model responses of a trace in order. Requests are
+    compared with the recorded ones and differences in tool results are
+    collected in divergences, e.g. when tools run live against changed data.
+
+    Parameters:
+    - records (List[dict]) The trace records
+    - replay_latency (bool) Sleep for the recorded duration of each call
+    - strict (bool) Raise on the first divergence
+    """
+
+    def __init__(self, records, replay_latency=False, strict=False):
+        self.converse_records = [record for record in records if record["type"] == "converse"]
+        self.replay_latency = replay_latency
+        self.strict = strict
+        self.position = 0
+        self.divergences = []
+
+    def compare(self, record, messages):
+        recorded = record["request"]["messages"]
+        replayed = messages[record["request"]["messages_from"]:]
+
+        if len(recorded) != len(replayed):
+            self.diverge(record["turn"], "message_count", len(recorded), len(replayed))
+            return
+
+        for recorded_message, replayed_message in zip(recorded, replayed):
+            for recorded_text, replayed_text in zip(tool_result_texts(recorded_message), tool_result_texts(replayed_message)):
+                if recorded_text != replayed_text:
+                    self.diverge(record["turn"], "tool_result", recorded_text[:500], replayed_text[:500])
+
+    def diverge(self, turn, field, recorded, replayed):
+        divergence = {"turn": turn, "field": field, "recorded": recorded, "replayed": replayed}
+        self.divergences.append(divergence)
+
+        if self.strict:
+            raise AssertionError(f"Replay diverged at turn {turn}: {field}")
+
+    def converse(self, **request):
+        if self.position >= len(self.converse_records):
+            raise ReplayExhausted(f"The trace has only {len(self.converse_records)} model responses")
+
+        record = self.converse_records[self.position]
+        self.position += 1
+
+        self.compare(record, request["messages"])
+
+        if self.replay_latency:
+            time.sleep(record["duration_ms"] / 1000)
+
+        return copy.deepcopy(record["response"])
+
+    def converse_stream(self, **request):
+        return response_to_stream(self.converse(**request))
+
+
+class TraceReplayer():
+    """
+    Replays a recorded run against an agent with the recorded model responses,
+    and with either the recorded tool outputs or the agent's live tools
+
+    Parameters:
+    - path_or_records (str or List[dict]) A trace file or its records
+    """
+
+    def __init__(self, path_or_records):
+        self.records = load_trace(path_or_records) if isinstance(path_or_records, (str, bytes)) else path_or_records
+        self.header = self.records[0]
+        self.result = next((record for record in self.records if record["type"] == "result"), None)
+
+    def stub_tools(self, agent):
+        """Makes the agent's tools return the recorded outputs, matched by name and input in order"""
+
+        outputs = {}
+        for record in self.records:
+            if record["type"] == "tool":
+                key = (record["name"], json.dumps(record["input"], sort_keys=True))
+                outputs.setdefault(key, []).append(record["output"])
+
+        def make_stub(name):
+            def stub(**parameters):
+                recorded = outputs.get((name, json.dumps(parameters, sort_keys=True)))
+                if not recorded:
+                    raise ReplayExhausted(f"No recorded output for {name} with {parameters}")
+                return recorded.pop(0) if len(recorded) > 1 else recorded[0]
+            return stub
+
+        # Instance attributes take precedence over the tools patched onto the class
+        for tool_spec in agent.get_tools():
+            name = tool_spec["toolSpec"]["name"]
+            setattr(agent, name, make_stub(name))
+
+    def replay(self, agent, stub_tools=True, replay_latency=False, strict=False, **kwargs):
+        """
+        Runs the recorded question through the agent
+
+        Parameters:
+        - agent (BaseAgent) The agent, with the same tool groups as the recorded run
+        - stub_tools (bool) Use the recorded tool outputs instead of running the tools
+        - replay_latency (bool) Reproduce the recorded model latency
+        - strict (bool) Stop at the first divergence
+        - kwargs Passed to invoke_agent
+
+        Returns:
+        - (dict) The final responses, durations and divergences of the replay
+        """
+
+        client = ReplayBedrockClient(self.records, replay_latency=replay_latency, strict=strict)
+        agent.bedrock = client
+
+        if stub_tools:
+            self.stub_tools(agent)
+
+        start = time.perf_counter()
+        final_response = agent.invoke_agent(self.header["input_text"], **kwargs)
+        duration_ms = round((time.perf_counter() - start) * 1000, 1)
+
+        recorded_final_response = self.result["final_response"] if self.result else None
+
+        return {
+            "final_response": final_response,
+            "recorded_final_response": recorded_final_response,
+            "matches": final_response == recorded_final_response,
+            "turns": client.position,
+            "recorded_turns": len(client.converse_records),
+            "duration_ms": duration_ms,
+            "recorded_duration_ms": self.result["duration_ms"] if self.result else None,
+            "divergences": client.divergences
+        }
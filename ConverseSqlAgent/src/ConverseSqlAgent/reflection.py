@@ -0,0 +1,172 @@
+import json
+import threading
+
+from prompts import REFLECTION_PROMPT_TEMPLATE
+
+
+def build_run_transcript(messages, max_tool_result_chars=1000, max_chars=100000):
+    """
+    Compacts the messages of a run into a plain text transcript for reflection.
+    Tool results are truncated since the reflection only needs what happened,
+    not the full data that was returned.
+
+    Parameters:
+    - messages (List[dict]) The Converse API messages of the run
+    - max_tool_result_chars (int) The maximum characters kept per tool result
+    - max_chars (int) The maximum characters of the transcript, oldest turns are dropped first
+
+    Returns:
+    - (str) The transcript
+    """
+
+    lines = []
+
+    for message in messages:
+        role = "User" if message["role"] == "user" else "Assistant"
+
+        for chunk in message["content"]:
+            if "text" in chunk and not chunk["text"].startswith("Current Datetime:"):
+                lines.append(f"{role}: {chunk['text']}")
+
+            if "toolUse" in chunk:
+                tool = chunk["toolUse"]
+                lines.append(f"Tool call: {tool['name']}({json.dumps(tool['input'])})")
+
+            if "toolResult" in chunk:
+                for result in chunk["toolResult"]["content"]:
+                    if "text" in result and not result["text"].startswith("Current Datetime:"):
+                        text = result["text"]
+                        if len(text) > max_tool_result_chars:
+                            text = text[:max_tool_result_chars] + "...[truncated]"
+                        lines.append(f"Tool result: {text}")
+
+    transcript = "\n".join(lines)
+
+    if len(transcript) > max_chars:
+        transcript = "...[earlier turns truncated]\n" + transcript[-max_chars:]
+
+    return transcript
+
+
+def build_reflection_prompt(transcript, final_response=None):
+    """Returns the input text for a reflection run over a run transcript"""
+
+    return REFLECTION_PROMPT_TEMPLATE.format(
+        transcript=transcript,
+        final_response=final_response or ""
+    )
+
+
+class ReflectionDispatcher():
+    """
+    Runs the memory reflection of a finished run outside of the user's
+    critical path.
+    """
+
+    def dispatch(self, agent, messages, final_response=None):
+        raise NotImplementedError
+
+
+class InlineReflectionDispatcher(ReflectionDispatcher):
+    """
+    Runs the reflection synchronously. Used in Lambda after the answer has
+    already been posted to the client.
+    """
+
+    def dispatch(self, agent, messages, final_response=None):
+        return agent.reflect_on_run(messages=messages, final_response=final_response)
+
+
+class ThreadReflectionDispatcher(ReflectionDispatcher):
+    """
+    Runs the reflection on a background thread. Local stand-in for the
+    asynchronous Lambda invocation in long running processes. Pass an agent
+    that is not used to answer other requests at the same time.
+    """
+
+    def __init__(self):
+        self.threads = []
+
+    def dispatch(self, agent, messages, final_response=None):
+        thread = threading.Thread(
+            target=agent.reflect_on_run,
+            kwargs={"messages": messages, "final_response": final_response},
+            daemon=True
+        )
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+def fit_json_bytes(text, max_bytes, keep_end=False):
+    """
+    Shortens text until its JSON encoding (non-ASCII characters are escaped)
+    takes at most max_bytes, keeping its start or, with keep_end, its end
+    """
+
+    size = len(json.dumps(text))
+    while text and size > max_bytes:
+        # Escaped characters take up to 12 bytes, so cut in proportion to the size
+        keep = min(len(text) - 1, len(text) * max_bytes // size)
+        if keep <= 0:
+            return ""
+        text = text[-keep:] if keep_end else text[:keep]
+        size = len(json.dumps(text))
+
+    return text
+
+
+class LambdaReflectionDispatcher(ReflectionDispatcher):
+    """
+    Invokes a Lambda function asynchronously with a reflection event. The
+    handler recognizes the event by its "type" and runs the reflection.
+    """
+
+    # Asynchronous invocation payloads are limited to 256 KB, keep some room
+    MAX_PAYLOAD_BYTES = 250000
+
+    # The final response is cut first so most of the payload goes to the transcript
+    MAX_FINAL_RESPONSE_BYTES = 20000
+
+    TRUNCATED_NOTE = "...[truncated]"
+
+    def __init__(self, function_name, lambda_client=None):
+        import boto3
+
+        self.function_name = function_name
+        self.lambda_client = lambda_client or boto3.client("lambda")
+
+    def build_payload(self, messages, final_response=None):
+        """Returns the encoded reflection event, at most MAX_PAYLOAD_BYTES"""
+
+        if final_response is not None and len(json.dumps(final_response)) > self.MAX_FINAL_RESPONSE_BYTES:
+            max_bytes = self.MAX_FINAL_RESPONSE_BYTES - len(self.TRUNCATED_NOTE)
+            final_response = fit_json_bytes(final_response, max_bytes) + self.TRUNCATED_NOTE
+
+        payload = {
+            "type": "reflection",
+            "transcript": "",
+            "final_response": final_response
+        }
+
+        # build_run_transcript keeps the latest turns, so does the byte limit
+        budget = self.MAX_PAYLOAD_BYTES - len(json.dumps(payload).encode("utf-8"))
+        transcript = build_run_transcript(messages, max_chars=budget)
+        fitted = fit_json_bytes(transcript, budget, keep_end=True)
+        if fitted != transcript:
+            note = "...[earlier turns truncated]\n"
+            fitted = note + fit_json_bytes(transcript, budget - len(json.dumps(note)), keep_end=True)
+        payload["transcript"] = fitted
+
+        return json.dumps(payload).encode("utf-8")
+
+    def dispatch(self, agent, messages, final_response=None):
+        return self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=self.build_payload(messages, final_response)
+        )
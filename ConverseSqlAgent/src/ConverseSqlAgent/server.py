@@ -0,0 +1,496 @@
+"""
+Long-running alternative to the Lambda entry point. An asyncio server accepts
+WebSocket connections (GET /ws) and HTTP requests (POST /invoke) and runs the
+agent on a thread pool. All runs share the Bedrock client and the engine
+registry, schema cache and credential cache of tool_groups.sql.
+
+Messages follow the lambda_handler contract: {"prompt", "database",
+"session_id", "tenant_id"} runs the agent and replies {"result": ...}, and
+{"action": "cancel"} cancels the runs of the session. There is no
+authentication, so a session belongs to its WebSocket connection and
+POST /invoke requests keep no session history.
+
+Run it locally with a stubbed Bedrock and a local database:
+
+    DATABASE_URL="sqlite:////tmp/{database}.db" python server.py --fake-bedrock
+"""
+
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import tracing
+import metrics
+import profiling
+from agent import BaseAgent
+from tool_groups.sql import SQL_TOOL_GROUP
+from tool_groups.memory import MEMORY_TOOL_GROUP
+from tool_groups.query_log import QUERY_LOG_TOOL_GROUP
+from framing import frame_message
+from jobs import JobValidationError, create_job
+from sessions import create_session_store, scoped_session_key
+from idempotency import DuplicateRequestTimeout, create_idempotency_guard, idempotency_key
+from cancellation import RunCancelled, CancellationToken, create_cancellation_flags
+from admission import AdmissionRejected, create_admission_controller
+from query_log import create_query_log
+from events import ( ApiGatewayEventSink,
+                     RUN_STARTED,
+                     PLAN_EXTRACTED,
+                     TOOL_STARTED,
+                     TOOL_FINISHED,
+                     ANSWER_DELTA
+                    )
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Requests larger than this are rejected
+MAX_REQUEST_BYTES = 1024 * 1024
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization"
+}
+
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 409: "Conflict", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class GoneException(Exception):
+    pass
+
+
+class WebSocketConnection():
+    """Server side of a WebSocket connection (RFC 6455, text messages only)"""
+
+    def __init__(self, connection_id, reader, writer):
+        self.connection_id = connection_id
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+        self.closed = False
+
+    async def receive(self):
+        """Returns the next text message, or None once the connection is closed"""
+
+        fragments = []
+
+        while True:
+            header = await self.reader.readexactly(2)
+            opcode = header[0] & 0x0F
+            fin = header[0] & 0x80
+            length = header[1] & 0x7F
+
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), "big")
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), "big")
+
+            if length > MAX_REQUEST_BYTES:
+                await self.close(1009)
+                return None
+
+            mask = await self.reader.readexactly(4) if header[1] & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if mask:
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+            if opcode == 0x8:
+                await self.close()
+                return None
+            if opcode == 0x9:
+                await self.send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode("utf-8")
+
+    async def send_frame(self, opcode, payload):
+        if self.closed:
+            raise GoneException(self.connection_id)
+
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, length])
+        elif length < 1 << 16:
+            header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, "big")
+        else:
+            header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, "big")
+
+        async with self.write_lock:
+            self.writer.write(header + payload)
+            await self.writer.drain()
+
+    async def send_text(self, data):
+        await self.send_frame(0x1, data.encode("utf-8"))
+
+    async def close(self, code=1000):
+        if self.closed:
+            return
+        try:
+            await self.send_frame(0x8, code.to_bytes(2, "big"))
+        except Exception:
+            pass
+        self.closed = True
+
+
+class LocalConnectionClient():
+    """
+    Drop-in for the API Gateway management client, so the agent's event sink
+    and framing send to the server's own WebSocket connections from worker threads
+    """
+
+    class exceptions():
+        GoneException = GoneException
+
+    def __init__(self, loop, send_timeout=30):
+        self.loop = loop
+        self.send_timeout = send_timeout
+        self.connections = {}
+
+    def post_to_connection(self, ConnectionId, Data):
+        connection = self.connections.get(ConnectionId)
+
+        if connection is None or connection.closed:
+            raise GoneException(ConnectionId)
+
+        data = Data.decode("utf-8") if isinstance(Data, bytes) else Data
+        asyncio.run_coroutine_threadsafe(connection.send_text(data), self.loop).result(self.send_timeout)
+
+
+class AgentServer():
+    """
+    Runs agent requests on a shared worker pool
+
+    Parameters:
+    - workers (int) The number of agent runs at once
+    - bedrock_client The bedrock-runtime client shared by all runs
+    - create_agent (Callable) Creates an agent given an event sink, defaults to the SQL agent
+    - tenant_concurrency (int) The maximum number of runs per tenant
+    - max_queue_depth (int) Requests beyond this many waiting are rejected
+    - progress_events (bool) Stream progress events to WebSocket clients
+    - query_log (QueryLog) Logs the SQL statements of all runs, disabled when None
+    - metrics_flush_seconds (float) How often the metrics of all runs are written
+    """
+
+    def __init__(self, workers=8,
+                 bedrock_client=None,
+                 create_agent=None,
+                 tenant_concurrency=2,
+                 max_queue_depth=100,
+                 progress_events=False,
+                 query_log=None,
+                 metrics_flush_seconds=60):
+
+        self.workers = workers
+        # Requests waiting for admission hold a thread, admission decides the order they run in
+        self.executor = ThreadPoolExecutor(max_workers=workers + max_queue_depth)
+        self.bedrock_client = bedrock_client or boto3.client("bedrock-runtime")
+        self.create_agent = create_agent or self.create_sql_agent
+        self.progress_events = progress_events
+        self.query_log = query_log
+        self.metrics_flush_seconds = metrics_flush_seconds
+
+        # Shared by all runs of the process
+        self.session_store = create_session_store(backend="memory")
+        self.idempotency_guard = create_idempotency_guard(backend="memory")
+        self.cancellation_flags = create_cancellation_flags(backend="process")
+        self.admission = create_admission_controller(
+            backend="process",
+            max_concurrency=workers,
+            tenant_concurrency=tenant_concurrency,
+            max_queue_depth=max_queue_depth
+        )
+
+        self.connection_ids = itertools.count(1)
+        self.active_runs = 0
+        self.client = None
+
+    def create_sql_agent(self, event_sink=None):
+        agent = BaseAgent(
+            model_id=os.environ.get('BedrockModelId', 'us.anthropic.claude-sonnet-4-20250514-v1:0'),
+            memory_table_name=os.environ.get('DynamoDbMemoryTable', 'advtext2sql_memory_tb'),
+            guardrail_id=os.environ.get("BEDROCK_GUARDRAIL_ID", ""),
+            guardrail_version=os.environ.get("BEDROCK_GUARDRAIL_VERSION", "1"),
+            memory_backend=os.environ.get('MEMORY_BACKEND', 'sqlite'),
+            event_sink=event_sink,
+            bedrock_client=self.bedrock_client,
+            query_log=self.query_log
+        )
+        agent.add_tool_group(SQL_TOOL_GROUP)
+        agent.add_tool_group(MEMORY_TOOL_GROUP)
+        if self.query_log is not None:
+            agent.add_tool_group(QUERY_LOG_TOOL_GROUP)
+        return agent
+
+    @tracing.traced("server.handle_request")
+    def handle_request(self, body, connection_id=None, tenant_id=None):
+        """
+        Handles a request body like lambda_handler. Runs on a worker thread.
+
+        Returns:
+        - (int, dict) The status code and the response body
+        """
+
+        if isinstance(body, dict) and body.get("action") == "cancel":
+            # Only the sessions of this connection can be cancelled
+            cancel_key = scoped_session_key(body.get("session_id"), connection_id)
+            if cancel_key is None:
+                return 400, {"error": "Runs can only be cancelled from the WebSocket connection that started them."}
+            self.cancellation_flags.cancel(cancel_key)
+            return 202, {"status": "cancelling"}
+
+        try:
+            job = create_job(body, connection_id, None, None, tenant_id=tenant_id or (body.get("tenant_id") if isinstance(body, dict) else None))
+        except JobValidationError as e:
+            return 400, {"error": str(e)}
+
+        # Sessions are scoped to the connection, HTTP requests have none and keep no history
+        session_key = scoped_session_key(job["session_id"], connection_id)
+
+        event_sink = None
+        if self.progress_events and connection_id:
+            event_sink = ApiGatewayEventSink(
+                self.client,
+                connection_id,
+                event_types=[RUN_STARTED, PLAN_EXTRACTED, TOOL_STARTED, TOOL_FINISHED, ANSWER_DELTA]
+            )
+
+        agent = self.create_agent(event_sink=event_sink)
+        history = self.session_store.load(session_key) if session_key else []
+        cancellation_token = CancellationToken(self.cancellation_flags, session_key or job["job_id"], poll_seconds=0.2)
+
+        run = lambda: agent.invoke_agent(job["prompt"], history=history, stream=event_sink is not None, cancellation_token=cancellation_token)
+        if profiling.should_profile(requested=job["profile"]):
+            run_without_profile = run
+            run = lambda: profiling.profile(run_without_profile, name=f"run-{job['job_id']}")
+
+        # Untenanted HTTP requests are admitted as their own tenant, like separate connections,
+        # so they are only bounded by the worker count instead of sharing one tenant's slots
+        tenant = job["tenant_id"] or connection_id or f"http#{job['job_id']}"
+        invoke = lambda: self.admission.run(tenant, run, label=job["tenant_id"] or connection_id or "http")
+
+        try:
+            # Requests without a session or connection are never coalesced, like separate connections
+            key = idempotency_key(job["prompt"], database=job["database"], session_id=session_key or job["job_id"])
+            response, is_duplicate = self.idempotency_guard.run(key, invoke)
+        except AdmissionRejected as e:
+            return 429, {"status": "rejected", "error": str(e)}
+        except DuplicateRequestTimeout as e:
+            print(str(e))
+            return 409, {"status": "duplicate", "error": "The same question is still being answered for this session. Try again later."}
+        except RunCancelled:
+            return 200, {"status": "cancelled"}
+
+        if session_key and agent.last_run_messages and not is_duplicate:
+            self.session_store.save(session_key, agent.last_run_messages)
+
+        if is_duplicate:
+            return 200, {"result": response, "coalesced": True}
+
+        return 200, {"result": response}
+
+    async def run_request(self, body, connection_id=None, tenant_id=None):
+        loop = asyncio.get_running_loop()
+        self.active_runs += 1
+        try:
+            return await loop.run_in_executor(self.executor, self.handle_request, body, connection_id, tenant_id)
+        except Exception as e:
+            print(f"Request failed: {e}")
+            return 500, {"error": str(e)}
+        finally:
+            self.active_runs -= 1
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get("upgrade", "").lower() == "websocket" and path.startswith("/ws"):
+                    await self.handle_websocket(reader, writer, headers)
+                    break
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_REQUEST_BYTES:
+                    await self.write_response(writer, 413, {"error": "The request is too large."}, keep_alive=False)
+                    break
+                data = await reader.readexactly(length) if length else b""
+
+                status, response_json = await self.handle_http(method, path.split("?")[0], data)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.write_response(writer, status, response_json, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_http(self, method, path, data):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "active_runs": self.active_runs, "admission": self.admission.metrics.snapshot()}
+
+        if method == "OPTIONS":
+            return 200, {}
+
+        if method == "POST" and path == "/invoke":
+            try:
+                body = json.loads(data) if data else None
+            except json.JSONDecodeError:
+                body = data.decode("utf-8", "replace")
+            return await self.run_request(body)
+
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def write_response(self, writer, status, response_json, keep_alive=True):
+        body = json.dumps(response_json, default=str).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(body)),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **CORS_HEADERS
+        }
+        head = f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+    async def handle_websocket(self, reader, writer, headers):
+        # The key is 16 random bytes in base64 (RFC 6455), a handshake without one is not a WebSocket client
+        key = headers.get("sec-websocket-key", "")
+        try:
+            valid_key = len(base64.b64decode(key.encode("ascii"), validate=True)) == 16
+        except ValueError:
+            valid_key = False
+        if not valid_key:
+            await self.write_response(writer, 400, {"error": "Missing or invalid Sec-WebSocket-Key header."}, keep_alive=False)
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+        connection_id = f"local-{next(self.connection_ids)}"
+        connection = WebSocketConnection(connection_id, reader, writer)
+        self.client.connections[connection_id] = connection
+        tasks = set()
+
+        async def run(body):
+            status, response_json = await self.run_request(body, connection_id)
+            for frame in frame_message(response_json):
+                await connection.send_text(frame)
+
+        try:
+            while True:
+                message = await connection.receive()
+                if message is None:
+                    break
+
+                try:
+                    body = json.loads(message)
+                except json.JSONDecodeError:
+                    body = message
+
+                # Keep reading while the run is in progress so cancel messages are received
+                task = asyncio.ensure_future(run(body))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            connection.closed = True
+            self.client.connections.pop(connection_id, None)
+
+    async def serve(self, host="0.0.0.0", port=8080):
+        self.client = LocalConnectionClient(asyncio.get_running_loop())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} (POST /invoke, GET /ws, GET /health) with {self.workers} workers")
+
+        flush_task = asyncio.create_task(self.flush_metrics())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flush_task.cancel()
+            metrics.get_metrics().flush()
+
+    async def flush_metrics(self):
+        """
+        Writes the metrics on an interval. Runs overlap on the worker threads,
+        so flushing at the end of each request would split the values of the
+        runs still in flight over many small log lines.
+        """
+
+        while True:
+            await asyncio.sleep(self.metrics_flush_seconds)
+            metrics.get_metrics().flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SQL agent as a long-running server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVER_WORKERS", "8")))
+    parser.add_argument("--tenant-concurrency", type=int, default=2)
+    parser.add_argument("--progress-events", action="store_true")
+    parser.add_argument("--fake-bedrock", action="store_true", help="Use a scripted Bedrock client, e.g. for load tests")
+    parser.add_argument("--fake-bedrock-latency", type=float, default=0.5)
+    parser.add_argument("--fake-bedrock-throttle-rate", type=float, default=0.0, help="Fraction of scripted Converse calls that are throttled")
+    parser.add_argument("--trace-spans", help="Write tracing spans as JSON lines to this file")
+    parser.add_argument("--metrics-flush-seconds", type=float, default=60, help="How often metrics are written when METRICS_ENABLED is true")
+    parser.add_argument("--query-log", choices=["memory", "sqlite", "dynamodb"], default=os.environ.get("QUERY_LOG_BACKEND"),
+                        help="Log SQL statements with per-shape statistics in this store (QUERY_LOG_TABLE for dynamodb)")
+    args = parser.parse_args()
+
+    if args.trace_spans:
+        tracing.configure_tracing(tracing.JsonLinesExporter(args.trace_spans))
+
+    bedrock_client = None
+    if args.fake_bedrock:
+        from fake_bedrock import FakeBedrockClient
+        bedrock_client = FakeBedrockClient(latency_seconds=args.fake_bedrock_latency, throttle_rate=args.fake_bedrock_throttle_rate)
+
+    query_log = None
+    if args.query_log:
+        query_log = create_query_log(backend=args.query_log, table_name=os.environ.get("QUERY_LOG_TABLE"))
+
+    server = AgentServer(
+        workers=args.workers,
+        bedrock_client=bedrock_client,
+        tenant_concurrency=args.tenant_concurrency,
+        progress_events=args.progress_events,
+        query_log=query_log,
+        metrics_flush_seconds=args.metrics_flush_seconds
+    )
+
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
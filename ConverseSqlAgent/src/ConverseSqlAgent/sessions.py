@@ -0,0 +1,156 @@
+import copy
+import gzip
+import json
+import time
+import base64
+
+from prompts import END_TURN_PROMPT
+from memory_store import create_memory_store
+
+
+def is_exchange_start(message):
+    """A user message with text (not tool results or the end turn prompt) starts a new question"""
+
+    return message["role"] == "user" and any(
+        "text" in chunk and chunk["text"] != END_TURN_PROMPT for chunk in message["content"]
+    )
+
+
+def compact_messages(messages, keep_recent_exchanges=1, max_tool_result_chars=500):
+    """
+    Returns a compact copy of the messages for storage. Timestamp blocks are
+    dropped, and tool results of all but the most recent exchanges are elided
+    to a short preview since the model only needs to know what was found.
+
+    Parameters:
+    - messages (List[dict]) The Converse API messages
+    - keep_recent_exchanges (int) The number of recent questions whose tool results are kept in full
+    - max_tool_result_chars (int) The preview length of elided tool results
+
+    Returns:
+    - (List[dict]) The compacted messages
+    """
+
+    exchange_starts = [i for i, message in enumerate(messages) if is_exchange_start(message)]
+    keep_from = exchange_starts[-keep_recent_exchanges] if len(exchange_starts) >= keep_recent_exchanges > 0 else len(messages)
+
+    compacted = []
+
+    for i, message in enumerate(messages):
+        content = []
+
+        for chunk in message["content"]:
+            if "text" in chunk and chunk["text"].startswith("Current Datetime:"):
+                continue
+
+            if "toolResult" in chunk:
+                chunk = copy.deepcopy(chunk)
+                result_content = []
+
+                for result in chunk["toolResult"]["content"]:
+                    if "text" in result and result["text"].startswith("Current Datetime:"):
+                        continue
+
+                    if i < keep_from and "text" in result and len(result["text"]) > max_tool_result_chars:
+                        elided = len(result["text"]) - max_tool_result_chars
+                        result = {"text": f"{result['text'][:max_tool_result_chars]}...[{elided} characters elided]"}
+
+                    result_content.append(result)
+
+                chunk["toolResult"]["content"] = result_content or [{"text": "[no output]"}]
+                content.append(chunk)
+            else:
+                content.append(copy.deepcopy(chunk))
+
+        if content:
+            compacted.append({"role": message["role"], "content": content})
+
+    return compacted
+
+
+def encode_messages(messages):
+    return base64.b64encode(gzip.compress(json.dumps(messages, default=str).encode("utf-8"))).decode("ascii")
+
+
+def decode_messages(data):
+    return json.loads(gzip.decompress(base64.b64decode(data)).decode("utf-8"))
+
+
+def scoped_session_key(session_id, principal):
+    """
+    Returns the key of a session, scoped to its caller. The session_id comes
+    from the client, so it is namespaced with the authenticated principal (or
+    the connection when there is no authorizer) and a client cannot load or
+    append to the session of another caller by sending its session_id.
+
+    Returns:
+    - (str) The key, or None without a principal (the session is not kept)
+    """
+
+    if not principal:
+        return None
+
+    return f"{principal}#{session_id}" if session_id else principal
+
+
+class SessionStore():
+    """
+    Stores the compacted message history of a session in a single item so it
+    is loaded with one read.
+
+    Parameters:
+    - store (MemoryStore) Any memory store backend
+    - ttl_seconds (int) How long a session is kept after its last question
+    - max_bytes (int) The maximum encoded size of a session. The oldest
+      questions are dropped to stay under it
+    """
+
+    def __init__(self, store, ttl_seconds=3600, max_bytes=200 * 1024):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+    def load(self, session_id):
+        """Returns the message history of the session, empty if missing or expired"""
+
+        item = self.store.get_item(f"session#{session_id}")
+
+        # DynamoDB TTL deletion is lazy, so expiry is also checked on read
+        if not item or int(item.get("expires_at", 0)) < time.time():
+            return []
+
+        return decode_messages(item["messages"])
+
+    def save(self, session_id, messages):
+        """Compacts and stores the message history of the session"""
+
+        messages = compact_messages(messages)
+        data = encode_messages(messages)
+
+        # Drop the oldest questions until the session fits the budget
+        while len(data) > self.max_bytes:
+            exchange_starts = [i for i, message in enumerate(messages) if is_exchange_start(message)]
+            if len(exchange_starts) < 2:
+                messages = []
+            else:
+                messages = messages[exchange_starts[1]:]
+            data = encode_messages(messages)
+
+        self.store.put_item(
+            {
+                "id": f"session#{session_id}",
+                "messages": data,
+                "expires_at": int(time.time()) + self.ttl_seconds
+            }
+        )
+
+        return messages
+
+    def clear(self, session_id):
+        self.store.delete_item(f"session#{session_id}")
+
+
+def create_session_store(backend=None, table_name=None, **kwargs):
+    """Creates a session store on the configured store backend (dynamodb, memory or sqlite)"""
+
+    return SessionStore(create_memory_store(backend=backend, table_name=table_name), **kwargs)
@@ -0,0 +1,505 @@
+import re
+
+# Error categories
+UNKNOWN_COLUMN = "unknown_column"
+UNKNOWN_TABLE = "unknown_table"
+UNKNOWN_SCHEMA = "unknown_schema"
+UNKNOWN_FUNCTION = "unknown_function"
+AMBIGUOUS_COLUMN = "ambiguous_column"
+SYNTAX = "syntax"
+GROUPING = "grouping"
+TYPE_MISMATCH = "type_mismatch"
+CARDINALITY = "cardinality"
+TIMEOUT = "timeout"
+PERMISSION = "permission"
+OTHER = "other"
+
+# Categories whose hints are built from the schema catalog
+CATALOG_CATEGORIES = {UNKNOWN_COLUMN, UNKNOWN_TABLE, UNKNOWN_SCHEMA, AMBIGUOUS_COLUMN, TYPE_MISMATCH}
+
+# pymysql error codes (args[0] of the driver error)
+MYSQL_ERROR_CODES = {
+    1054: UNKNOWN_COLUMN,
+    1146: UNKNOWN_TABLE,
+    1049: UNKNOWN_SCHEMA,
+    1305: UNKNOWN_FUNCTION,
+    1052: AMBIGUOUS_COLUMN,
+    1064: SYNTAX,
+    1149: SYNTAX,
+    1055: GROUPING,
+    1111: GROUPING,
+    1140: GROUPING,
+    1292: TYPE_MISMATCH,
+    1366: TYPE_MISMATCH,
+    1267: TYPE_MISMATCH,
+    1242: CARDINALITY,
+    1317: TIMEOUT,
+    3024: TIMEOUT,
+    1044: PERMISSION,
+    1142: PERMISSION,
+    1143: PERMISSION
+}
+
+# psycopg2 SQLSTATE codes (pgcode of the driver error)
+POSTGRES_ERROR_CODES = {
+    "42703": UNKNOWN_COLUMN,
+    "42P01": UNKNOWN_TABLE,
+    "3F000": UNKNOWN_SCHEMA,
+    "42883": UNKNOWN_FUNCTION,
+    "42702": AMBIGUOUS_COLUMN,
+    "42601": SYNTAX,
+    "42803": GROUPING,
+    "42804": TYPE_MISMATCH,
+    "22P02": TYPE_MISMATCH,
+    "22007": TYPE_MISMATCH,
+    "22008": TYPE_MISMATCH,
+    "21000": CARDINALITY,
+    "57014": TIMEOUT,
+    "42501": PERMISSION
+}
+
+# SQLite has no error codes for these, its messages are matched instead
+SQLITE_ERROR_MESSAGES = [
+    (r"no such column", UNKNOWN_COLUMN),
+    (r"no such table", UNKNOWN_TABLE),
+    (r"unknown database", UNKNOWN_SCHEMA),
+    (r"no such function", UNKNOWN_FUNCTION),
+    (r"ambiguous column name", AMBIGUOUS_COLUMN),
+    (r"syntax error|incomplete input", SYNTAX),
+    (r"misuse of aggregate|aggregate functions are not allowed", GROUPING),
+    (r"sub-select returns \d+ columns", CARDINALITY),
+    (r"interrupted", TIMEOUT)
+]
+
+# The identifier an error is about, in the messages of MySQL, PostgreSQL and SQLite
+IDENTIFIER_PATTERNS = {
+    UNKNOWN_COLUMN: [r"Unknown column '([^']+)'", r'column "?([\w.]+)"? does not exist', r"no such column: ([\w.\"`]+)"],
+    UNKNOWN_TABLE: [r"Table '([^']+)' doesn't exist", r'relation "([^"]+)" does not exist', r"no such table: ([\w.]+)"],
+    UNKNOWN_SCHEMA: [r"Unknown database '([^']+)'", r'schema "([^"]+)" does not exist', r"unknown database (\w+)"],
+    UNKNOWN_FUNCTION: [r"FUNCTION ([\w.]+) does not exist", r"function ([\w.]+)\(", r"no such function: (\w+)"],
+    AMBIGUOUS_COLUMN: [r"Column '([^']+)' in .* is ambiguous", r'column reference "([^"]+)" is ambiguous', r"ambiguous column name: ([\w.]+)"],
+    GROUPING: [r"nonaggregated column '([^']+)'", r'column "([^"]+)" must appear in the GROUP BY'],
+    SYNTAX: [r"near '([^']{0,40})", r'at or near "([^"]+)"', r'near "([^"]+)": syntax error']
+}
+
+# Functions of other dialects and what to use instead
+FUNCTION_EQUIVALENTS = {
+    "mysql": {
+        "date_trunc": "DATE_FORMAT(date, '%Y-%m-01') or YEAR(date) and MONTH(date)",
+        "to_char": "DATE_FORMAT(date, format)",
+        "strftime": "DATE_FORMAT(date, format)",
+        "string_agg": "GROUP_CONCAT(expression SEPARATOR ', ')",
+        "nvl": "IFNULL or COALESCE",
+        "len": "CHAR_LENGTH",
+        "getdate": "NOW()",
+        "datepart": "EXTRACT(part FROM date)"
+    },
+    "postgresql": {
+        "date_format": "TO_CHAR(date, format)",
+        "ifnull": "COALESCE",
+        "nvl": "COALESCE",
+        "group_concat": "STRING_AGG(expression, ', ')",
+        "datediff": "date - date, or AGE(date, date)",
+        "year": "EXTRACT(YEAR FROM date)",
+        "month": "EXTRACT(MONTH FROM date)",
+        "curdate": "CURRENT_DATE",
+        "len": "LENGTH",
+        "getdate": "NOW()"
+    },
+    "sqlite": {
+        "date_format": "strftime(format, date)",
+        "to_char": "strftime(format, date)",
+        "year": "strftime('%Y', date)",
+        "month": "strftime('%m', date)",
+        "date_trunc": "strftime('%Y-%m-01', date)",
+        "now": "datetime('now')",
+        "curdate": "date('now')",
+        "datediff": "julianday(date) - julianday(date)",
+        "concat": "the || operator",
+        "string_agg": "group_concat(expression, ', ')",
+        "if": "CASE WHEN ... THEN ... ELSE ... END",
+        "len": "length"
+    }
+}
+
+# Syntax of other dialects and what to use instead, checked on syntax errors
+SYNTAX_IDIOMS = {
+    "mysql": [
+        (r"\bILIKE\b", "MySQL has no ILIKE, use LIKE (case insensitive with the default collation)"),
+        (r"::\s*\w+", "MySQL has no :: casts, use CAST(expression AS type)"),
+        (r"\bSELECT\s+TOP\s+\d+", "MySQL has no SELECT TOP, use LIMIT"),
+        (r"\bFETCH\s+FIRST\b", "Use LIMIT instead of FETCH FIRST"),
+        (r"\bFULL\s+(OUTER\s+)?JOIN\b", "MySQL has no FULL JOIN, use a LEFT JOIN UNION a RIGHT JOIN"),
+        (r'"\w+"\s*\.|\.\s*"\w+"', "MySQL quotes identifiers with backticks, double quotes are strings")
+    ],
+    "postgresql": [
+        (r"`", "PostgreSQL quotes identifiers with double quotes, not backticks"),
+        (r"\bSELECT\s+TOP\s+\d+", "PostgreSQL has no SELECT TOP, use LIMIT"),
+        (r"\bLIMIT\s+\d+\s*,\s*\d+", "PostgreSQL has no LIMIT offset, count, use LIMIT count OFFSET offset")
+    ],
+    "sqlite": [
+        (r"`\w+`\s*\.\s*`", "Quote identifiers with double quotes"),
+        (r"\bILIKE\b", "SQLite has no ILIKE, use LIKE (case insensitive for ASCII)"),
+        (r"::\s*\w+", "SQLite has no :: casts, use CAST(expression AS type)"),
+        (r"\bSELECT\s+TOP\s+\d+", "SQLite has no SELECT TOP, use LIMIT"),
+        (r"\bINTERVAL\b", "SQLite has no INTERVAL, use date(date, '+1 month') modifiers")
+    ]
+}
+
+CATEGORY_HINTS = {
+    GROUPING: "Every selected column that is not inside an aggregate function must be listed in GROUP BY, "
+              "and aggregates cannot be used in WHERE (use HAVING).",
+    CARDINALITY: "A subquery used as a single value returned more than one row. Use IN or EXISTS, "
+                 "or aggregate the subquery.",
+    TIMEOUT: "The query was stopped because it ran too long. Add filters on indexed columns, "
+             "aggregate in the database or add a LIMIT.",
+    PERMISSION: "The database user is not allowed to run this query. Do not retry it, "
+                "use other tables or tell the user."
+}
+
+TABLE_REFERENCE = re.compile(
+    r"\b(?:FROM|JOIN)\s+((?:[`\"\[]?\w+[`\"\]]?\s*\.\s*)?[`\"\[]?\w+[`\"\]]?)(?:\s+(?:AS\s+)?([`\"]?\w+[`\"]?))?",
+    re.IGNORECASE
+)
+
+COMPARISON = re.compile(
+    r"([`\"]?\w+[`\"]?(?:\s*\.\s*[`\"]?\w+[`\"]?)?)\s*(?:=|<>|!=|<=|>=|<|>)\s*('(?:[^']|'')*'|-?\d+(?:\.\d+)?)",
+    re.IGNORECASE
+)
+
+NOT_ALIASES = {
+    "where", "on", "using", "join", "inner", "left", "right", "full", "outer", "cross", "natural",
+    "group", "order", "having", "limit", "union", "except", "intersect", "window", "offset", "fetch", "for"
+}
+
+NUMERIC_TYPES = re.compile(r"INT|DECIMAL|NUMERIC|FLOAT|DOUBLE|REAL|NUMBER|SERIAL|MONEY", re.IGNORECASE)
+DATE_TYPES = re.compile(r"DATE|TIME", re.IGNORECASE)
+
+
+def unquote(identifier):
+    return re.sub(r"[`\"\[\]\s]", "", identifier or "")
+
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a_char != b_char)))
+        previous = current
+
+    return previous[-1]
+
+
+def closest(name, candidates, limit=3):
+    """
+    Returns the candidates closest to name by edit distance, ignoring case. A candidate
+    that contains name, or is contained in it, is close regardless of the distance.
+    """
+
+    name = name.lower()
+    max_distance = max(2, len(name) // 3)
+
+    scored = []
+    for candidate in set(candidates):
+        lowered = candidate.lower()
+        distance = edit_distance(name, lowered)
+        if distance <= max_distance or (len(name) >= 3 and (name in lowered or lowered in name)):
+            scored.append((distance, candidate))
+
+    return [candidate for _, candidate in sorted(scored)[:limit]]
+
+
+def driver_error_code(error):
+    """Returns the pymysql error number or the psycopg2 SQLSTATE of a SQLAlchemy error, else None"""
+
+    cause = getattr(error, "orig", None) or error
+
+    pgcode = getattr(cause, "pgcode", None)
+    if pgcode:
+        return pgcode
+
+    args = getattr(cause, "args", ())
+    if args and isinstance(args[0], int):
+        return args[0]
+
+    return None
+
+
+def classify_error(error, dialect):
+    """
+    Classifies a failed query from the driver's error code, or its message on SQLite
+
+    Parameters:
+    - error (Exception) The error raised by SQLAlchemy
+    - dialect (str) The SQLAlchemy dialect name, e.g. mysql, postgresql or sqlite
+
+    Returns:
+    - (dict) The category, the driver's error code and the identifier the error is about
+    """
+
+    message = str(getattr(error, "orig", None) or error)
+    code = driver_error_code(error)
+    category = None
+
+    if dialect == "mysql":
+        category = MYSQL_ERROR_CODES.get(code)
+    elif dialect == "postgresql":
+        category = POSTGRES_ERROR_CODES.get(code)
+        if category == UNKNOWN_FUNCTION and message.startswith("operator does not exist"):
+            category = TYPE_MISMATCH
+
+    if category is None:
+        for pattern, message_category in SQLITE_ERROR_MESSAGES:
+            if re.search(pattern, message, re.IGNORECASE):
+                category = message_category
+                break
+
+    identifier = None
+    for pattern in IDENTIFIER_PATTERNS.get(category, []):
+        match = re.search(pattern, message, re.IGNORECASE)
+        if match:
+            identifier = unquote(match.group(1)) if category != SYNTAX else match.group(1).strip()
+            break
+
+    return {"category": category or OTHER, "code": code, "identifier": identifier, "message": message.splitlines()[0] if message else ""}
+
+
+def referenced_tables(query):
+    """
+    Returns the tables in the FROM and JOIN clauses of a query
+
+    Returns:
+    - (List[dict]) The schema (or None), table and alias (or None) of each table
+    """
+
+    tables = []
+    for match in TABLE_REFERENCE.finditer(query or ""):
+        name = unquote(match.group(1))
+        alias = unquote(match.group(2)) if match.group(2) else None
+        if alias and alias.lower() in NOT_ALIASES:
+            alias = None
+        schema, _, table = name.rpartition(".")
+        tables.append({"schema": schema or None, "table": table, "alias": alias})
+    return tables
+
+
+def find_table(catalog, table, schema=None):
+    """Returns the (schema, table) of a table name in the catalog, ignoring case, preferring the default schema"""
+
+    schemas = [schema] if schema else [catalog["default_schema"]] + list(catalog["schemas"])
+    for schema_name in schemas:
+        for table_name in catalog["schemas"].get(schema_name, {}):
+            if table_name.lower() == table.lower():
+                return schema_name, table_name
+    return None
+
+
+def qualified(catalog, schema, table):
+    return table if schema == catalog["default_schema"] else f"{schema}.{table}"
+
+
+def all_tables(catalog):
+    return [(schema, table) for schema, tables in catalog["schemas"].items() for table in tables]
+
+
+def query_tables(catalog, query):
+    """Returns the catalog tables referenced in a query as {alias or table name (lowercase): (schema, table)}"""
+
+    found = {}
+    for reference in referenced_tables(query):
+        location = find_table(catalog, reference["table"], reference["schema"])
+        if location:
+            # A table with an alias can only be referred to by the alias
+            found[(reference["alias"] or reference["table"]).lower()] = location
+    return found
+
+
+def unknown_column_hints(catalog, query, identifier):
+    qualifier, _, column = identifier.rpartition(".")
+    in_query = query_tables(catalog, query)
+    hints = []
+
+    if qualifier and qualifier.lower() in in_query:
+        schema, table = in_query[qualifier.lower()]
+        columns = catalog["schemas"][schema][table]
+        suggestions = closest(column, columns)
+        hint = f"Table {qualified(catalog, schema, table)} (as {qualifier}) has no column {column}."
+        if suggestions:
+            hint += f" Closest columns: {', '.join(suggestions)}."
+        hints.append(hint)
+    elif qualifier:
+        hints.append(f"{qualifier} is not a table or alias in the FROM clause. Tables and aliases in the query: "
+                     f"{', '.join(sorted(in_query)) or 'none'}.")
+
+    # The column in another table of the query
+    holders = [alias for alias, (schema, table) in in_query.items()
+               if any(name.lower() == column.lower() for name in catalog["schemas"][schema][table])]
+    if holders:
+        hints.append(f"Column {column} is in {', '.join(sorted(set(holders)))}; qualify it with that table or alias.")
+        return hints
+
+    # Close names in the tables of the query
+    if not qualifier:
+        candidates = [(alias, name) for alias, (schema, table) in in_query.items() for name in catalog["schemas"][schema][table]]
+        suggestions = closest(column, [name for _, name in candidates])
+        if suggestions:
+            hints.append(f"No table in the query has a column {column}. Closest columns: " + ", ".join(
+                f"{name} ({', '.join(sorted({alias for alias, candidate in candidates if candidate == name}))})" for name in suggestions
+            ) + ".")
+
+    # The column in tables that are not part of the query, of those whose columns are in the catalog
+    others = [qualified(catalog, schema, table) for schema, table in all_tables(catalog)
+              if (schema, table) not in in_query.values()
+              and any(name.lower() == column.lower() for name in catalog["schemas"][schema][table])]
+    if others:
+        hints.append(f"Column {column} exists in {', '.join(others[:5])}, which the query does not join.")
+
+    if not hints:
+        hints.append(f"No table has a column like {column}. List the columns with get_table_columns.")
+
+    return hints
+
+
+def unknown_table_hints(catalog, identifier, dialect):
+    schema, _, table = identifier.rpartition(".")
+    hints = []
+
+    # MySQL names the table with the current database even when the query did not
+    if dialect == "mysql" and schema and schema not in catalog["schemas"]:
+        hints.append(f"Schema {schema} is not in this database.")
+
+    elsewhere = [(schema_name, table_name) for schema_name, table_name in all_tables(catalog)
+                 if table_name.lower() == table.lower() and schema_name != schema]
+    if elsewhere:
+        hints.append(f"Table {table} is in schema {', '.join(sorted({s for s, _ in elsewhere}))}; qualify it as "
+                     f"{' or '.join(f'{s}.{t}' for s, t in elsewhere[:3])}.")
+        return hints
+
+    suggestions = closest(table, [table_name for _, table_name in all_tables(catalog)])
+    if suggestions:
+        names = [qualified(catalog, s, t) for s, t in all_tables(catalog) if t in suggestions]
+        hints.append(f"There is no table {table}. Closest tables: {', '.join(names[:3])}.")
+    else:
+        hints.append(f"There is no table like {table}. List the tables with get_schema_tables.")
+
+    return hints
+
+
+def unknown_schema_hints(catalog, identifier):
+    suggestions = closest(identifier, catalog["schemas"])
+    if suggestions:
+        return [f"There is no schema {identifier}. Closest schemas: {', '.join(suggestions)}."]
+    return [f"There is no schema {identifier}. Schemas: {', '.join(list(catalog['schemas'])[:10])}."]
+
+
+def ambiguous_column_hints(catalog, query, identifier):
+    column = identifier.rpartition(".")[2]
+    in_query = query_tables(catalog, query)
+    aliases = {}
+    for alias, (schema, table) in in_query.items():
+        if any(name.lower() == column.lower() for name in catalog["schemas"][schema][table]):
+            aliases.setdefault((schema, table), alias)
+
+    if len(aliases) > 1:
+        return [f"Column {column} is in several tables of the query; qualify it as "
+                f"{' or '.join(f'{alias}.{column}' for alias in aliases.values())}."]
+    return [f"Qualify column {column} with its table or alias."]
+
+
+def type_mismatch_hints(catalog, query):
+    """Finds comparisons of columns with literals of another type"""
+
+    in_query = query_tables(catalog, query)
+    hints = []
+
+    for match in COMPARISON.finditer(query or ""):
+        qualifier, _, column = unquote(match.group(1)).rpartition(".")
+        literal = match.group(2)
+        tables = [in_query[qualifier.lower()]] if qualifier and qualifier.lower() in in_query else list(set(in_query.values()))
+
+        for schema, table in tables:
+            column_type = next((column_type for name, column_type in catalog["schemas"][schema][table].items()
+                                if name.lower() == column.lower()), None)
+            if column_type is None:
+                continue
+
+            is_string = literal.startswith("'")
+            value = literal.strip("'")
+            if NUMERIC_TYPES.search(column_type) and is_string and not re.fullmatch(r"-?\d+(\.\d+)?", value):
+                hints.append(f"Column {column} is {column_type} but is compared with the string {literal}.")
+            elif DATE_TYPES.search(column_type) and is_string and not re.match(r"\d{4}-\d{2}-\d{2}", value):
+                hints.append(f"Column {column} is {column_type}; write dates as 'YYYY-MM-DD', not {literal}.")
+            elif DATE_TYPES.search(column_type) and not is_string:
+                hints.append(f"Column {column} is {column_type} but is compared with the number {literal}; quote dates as 'YYYY-MM-DD'.")
+            break
+
+    return hints or ["Compare columns with values of their type, or convert them with CAST(expression AS type)."]
+
+
+def syntax_hints(query, dialect, identifier):
+    hints = [hint for pattern, hint in SYNTAX_IDIOMS.get(dialect, []) if re.search(pattern, query or "", re.IGNORECASE)]
+    if identifier:
+        hints.append(f"The error is near: {identifier}")
+    return hints
+
+
+def unknown_function_hints(dialect, identifier):
+    name = (identifier or "").rpartition(".")[2].lower()
+    equivalent = FUNCTION_EQUIVALENTS.get(dialect, {}).get(name)
+    if equivalent:
+        return [f"{dialect} has no {name.upper()} function, use {equivalent}."]
+    return [f"{identifier} is not a {dialect} function."] if identifier else []
+
+
+def repair_hints(classification, query, dialect, catalog=None):
+    """
+    Returns hints for fixing a failed query
+
+    Parameters:
+    - classification (dict) Returned by classify_error
+    - query (str) The failed query
+    - dialect (str) The SQLAlchemy dialect name
+    - catalog (dict) {"default_schema": str, "schemas": {schema: {table: {column: type}}}}, needed
+      for the categories in CATALOG_CATEGORIES
+
+    Returns:
+    - (List[str]) The hints, most specific first
+    """
+
+    category = classification["category"]
+    identifier = classification["identifier"]
+
+    if category in CATALOG_CATEGORIES and catalog is None:
+        return []
+    if category == UNKNOWN_COLUMN and identifier:
+        return unknown_column_hints(catalog, query, identifier)
+    if category == UNKNOWN_TABLE and identifier:
+        return unknown_table_hints(catalog, identifier, dialect)
+    if category == UNKNOWN_SCHEMA and identifier:
+        return unknown_schema_hints(catalog, identifier)
+    if category == AMBIGUOUS_COLUMN and identifier:
+        return ambiguous_column_hints(catalog, query, identifier)
+    if category == TYPE_MISMATCH:
+        return type_mismatch_hints(catalog, query)
+    if category == SYNTAX:
+        return syntax_hints(query, dialect, identifier)
+    if category == UNKNOWN_FUNCTION:
+        return unknown_function_hints(dialect, identifier)
+    if category in CATEGORY_HINTS:
+        return [CATEGORY_HINTS[category]]
+    return []
+
+
+def format_repair_hints(classification, hints, dialect):
+    code = f" {classification['code']}" if classification["code"] is not None else ""
+    lines = [f"Error class: {classification['category']} ({dialect}{code})"]
+    if hints:
+        lines.append("Repair hints:")
+        lines.extend(f"- {hint}" for hint in hints)
+    return "\n".join(lines)
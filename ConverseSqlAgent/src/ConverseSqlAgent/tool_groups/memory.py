@@ -4,7 +4,7 @@ def read_memory(self, memory_id):
     Retrieves the memory from the specified memory_id
     
     Parameters:
-    - memory_id (int) The memory_id to retrieve from DynamoDB
+    - memory_id (int) The memory_id to retrieve from the memory store
     
     Returns:
     - (string) The content of the record 
@@ -12,9 +12,9 @@ def read_memory(self, memory_id):
     """
         
     try:
-        response = self.table.get_item(Key={'id': memory_id})
-        if 'Item' in response:
-            memory = response['Item'].get('memory', '')
+        item = self.memory_store.get_item(memory_id)
+        if item:
+            memory = item.get('memory', '')
         else:
             memory = ''
         
@@ -50,7 +50,7 @@ def write_memory(self, memory_id, contents):
     Overrides the contents of the record in memory_id
     
     Parameters:
-    - memory_id (int) The memory_id to write to in DynamoDB
+    - memory_id (int) The memory_id to write to in the memory store
     - memory (string) The content to set
     
     Returns:
@@ -59,8 +59,8 @@ def write_memory(self, memory_id, contents):
     """
         
     try:
-        self.table.put_item(
-            Item={
+        self.memory_store.put_item(
+            {
                 'id': memory_id,
                 'memory': contents
             }
@@ -100,7 +100,7 @@ def append_memory(self, memory_id, contents):
     Appends to the memory in the database
     
     Parameters:
-    - memory_id (int) The memory_id to append to in DynamoDB
+    - memory_id (int) The memory_id to append to in the memory store
     - contents (string) The content to append
     
     Returns:
@@ -109,16 +109,16 @@ def append_memory(self, memory_id, contents):
     """
     
     try:
-        response = self.table.get_item(Key={'id': memory_id})
-        if 'Item' in response:
-            memory = response['Item'].get('memory', '')
+        item = self.memory_store.get_item(memory_id)
+        if item:
+            memory = item.get('memory', '')
         else:
             memory = ''
             
         memory = memory + "\n" + contents
 
-        self.table.put_item(
-            Item={
+        self.memory_store.put_item(
+            {
                 'id': memory_id,
                 'memory': memory
             }
@@ -159,18 +159,14 @@ def delete_memory(self, memory_id):
     Deletes a memory
     
     Parameters:
-    - memory_id (int) The memory_id to delete in DynamoDB
+    - memory_id (int) The memory_id to delete in the memory store
     
     Returns:
     - final_output (string) Confirmation
     """
     
     try:
-        self.table.delete_item(
-            Key={
-                "id": memory_id
-            }
-        )
+        self.memory_store.delete_item(memory_id)
         final_output = f"Successfully deleted memory_id {memory_id}"
     except Exception as e:
         final_output = f"Encountered error: {e}"
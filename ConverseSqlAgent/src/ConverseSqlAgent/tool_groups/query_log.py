@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+
+
+def format_time(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def get_query_stats(self, database_name, query):
+    """
+    Returns the logged statistics of a query's shape, so a query that is known
+    to be slow or to fail can be changed before it is run
+
+    Parameters:
+    - database_name (string) The database the query runs against
+    - query (string) The SQL query, constants do not matter
+
+    Returns:
+    - (string) The statistics and a warning if the shape is slow or failing
+
+    """
+
+    try:
+        stats = self.query_log.get_stats(database_name, query, cache=getattr(self, "query_stats", None))
+        if not stats:
+            return "This query shape was not run before."
+
+        lines = [
+            f"Query shape: {stats['query']}",
+            f"Calls: {stats['calls']}, errors: {stats['errors']}",
+            f"Latency ms: mean {stats['mean_ms']}, min {stats['min_ms']}, max {stats['max_ms']}, stddev {stats['stddev_ms']}",
+            f"Rows per successful call: {stats['mean_rows']}, bytes: {stats['mean_bytes']}",
+            f"Last run: {format_time(stats['last_seen'])}"
+        ]
+
+        if stats["error_classes"]:
+            lines.append("Errors by class: " + ", ".join(f"{name} {count}" for name, count in stats["error_classes"].items()))
+        if stats["last_error"]:
+            lines.append(f"Last error: {stats['last_error']['class']}: {stats['last_error']['message']}")
+
+        questions = [execution["question"] for execution in stats["recent"] if execution.get("question")]
+        if questions:
+            lines.append("Recent questions: " + " | ".join(dict.fromkeys(questions)))
+
+        warning = self.query_log.warning(stats)
+        if warning:
+            lines.append(f"Warning: {warning}")
+
+        final_output = "\n".join(lines)
+    except Exception as e:
+        final_output = f"Getting query stats encountered an error: {e}"
+
+    return final_output
+
+## GetQueryStats ToolSpec
+GET_QUERY_STATS_TOOLSPEC = {
+    "toolSpec": {
+        "name": "get_query_stats",
+        "description": "Use this tool to get the latency, row counts and errors of earlier runs of a SQL query of the same shape",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "database_name": {
+                        "type": "string",
+                        "description": "The name of the database the query runs against"
+                    },
+                    "query": {
+                        "type": "string",
+                        "description": "The SQL query. Queries that differ only in their constants have the same shape"
+                    }
+                },
+                "required": ["database_name", "query"]
+            }
+        }
+    }
+}
+
+
+QUERY_LOG_TOOL_GROUP = {
+    "tool_group_name": "QUERY_LOG_TOOL_GROUP",
+    "usage_instructions": """Every query run with invoke_sql_query is logged by its shape. Before running
+    a query that scans large tables or joins many tables, you can check its shape with get_query_stats.
+    When a query result ends with a note that the shape is known to be slow or to fail, change the
+    query instead of running the same shape again.
+    """,
+    "tools": [
+        {
+            "tool_spec": GET_QUERY_STATS_TOOLSPEC,
+            "function": get_query_stats
+        }
+    ]
+}
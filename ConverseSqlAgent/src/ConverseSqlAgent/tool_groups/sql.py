@@ -2,13 +2,39 @@ import io
 import os
 import csv
 import json
+import time
 import boto3
+import threading
+from contextlib import nullcontext
 from sqlalchemy import create_engine, text, inspect
 
 import boto3
 import json
 from botocore.exceptions import ClientError
 
+import tracing
+from metrics import put_metric, BYTES, COUNT
+from sql_errors import CATALOG_CATEGORIES, OTHER, classify_error, repair_hints, format_repair_hints, find_table, qualified, closest, referenced_tables
+from join_paths import build_graph, steiner_tree, order_joins, parallel_edges, join_condition
+
+# Credentials from Secrets Manager are reused for this long before they are fetched again
+CREDENTIAL_CACHE_SECONDS = int(os.environ.get('CREDENTIAL_CACHE_SECONDS', '300'))
+
+# Schema metadata (schemas, tables, columns, foreign keys) is reused for this long
+SCHEMA_CACHE_SECONDS = int(os.environ.get('SCHEMA_CACHE_SECONDS', '600'))
+
+# Schemas of the database server itself, left out of the catalog
+SYSTEM_SCHEMAS = {"information_schema", "performance_schema", "mysql", "sys", "pg_catalog", "pg_toast"}
+
+# Tables whose columns are loaded into the catalog, the default schema first
+MAX_CATALOG_TABLES = int(os.environ.get('MAX_CATALOG_TABLES', '300'))
+
+# Process wide caches shared by all agent runs of a warm Lambda or the server
+_database_urls = {}  # database name -> (url, fetched at)
+_engines = {}  # url -> engine
+_schema_cache = {}  # (database name, kind, *names) -> (value, cached at)
+_cache_lock = threading.Lock()
+
 def retrieve_database_url(database_name=None):
     """
     Returns a URL for SQLAlchemy based on AWS Secrets Manager credentials.
@@ -82,6 +108,260 @@ def retrieve_database_url(database_name=None):
     except boto3.exceptions.Boto3Error as e:
         raise ValueError(f"Error with AWS SDK: {str(e)}") from e
 
+def get_server_connection_id(connection):
+    """
+    Returns the server-side id of a connection, used to cancel its query from another connection.
+
+    Args:
+        connection: A SQLAlchemy connection.
+
+    Returns:
+        int: The MySQL connection id or PostgreSQL backend pid, or None for other databases.
+    """
+    dialect = connection.dialect.name
+    if dialect == "mysql":
+        return connection.execute(text("SELECT CONNECTION_ID()")).scalar()
+    if dialect == "postgresql":
+        return connection.execute(text("SELECT pg_backend_pid()")).scalar()
+    return None
+
+def cancel_server_query(engine, server_connection_id):
+    """
+    Cancels the running query of a connection on the database server. The connection stays open.
+
+    Args:
+        engine: The SQLAlchemy engine of the connection.
+        server_connection_id (int): The id returned by get_server_connection_id.
+    """
+    print(f"Cancelling query on server connection {server_connection_id}")
+    with engine.connect() as connection:
+        if engine.dialect.name == "mysql":
+            connection.execute(text(f"KILL QUERY {int(server_connection_id)}"))
+        elif engine.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": server_connection_id})
+
+def get_database_url(database_name=None):
+    """
+    Returns the SQLAlchemy URL of a database, cached for CREDENTIAL_CACHE_SECONDS.
+
+    The DATABASE_URL environment variable replaces Secrets Manager for local runs,
+    e.g. "sqlite:////tmp/{database}.db". "{database}" is replaced by the database name.
+
+    Args:
+        database_name (str, optional): The name of the database to connect to.
+
+    Returns:
+        str: A SQLAlchemy URL.
+    """
+    local_url = os.environ.get('DATABASE_URL')
+    if local_url:
+        return local_url.replace("{database}", database_name or "")
+
+    with _cache_lock:
+        cached = _database_urls.get(database_name)
+    if cached and time.time() - cached[1] < CREDENTIAL_CACHE_SECONDS:
+        put_metric("CredentialCacheHit", 1)
+        return cached[0]
+
+    put_metric("CredentialCacheHit", 0)
+
+    with tracing.span("secretsmanager.get_secret_value", database=database_name):
+        url = retrieve_database_url(database_name)
+    with _cache_lock:
+        _database_urls[database_name] = (url, time.time())
+    return url
+
+def get_engine(database_name=None):
+    """
+    Returns a pooled engine for a database from the engine registry, so runs reuse connections.
+
+    Args:
+        database_name (str, optional): The name of the database to connect to.
+
+    Returns:
+        Engine: A SQLAlchemy engine.
+    """
+    url = get_database_url(database_name)
+    with _cache_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = create_engine(url, pool_pre_ping=True)
+            _engines[url] = engine
+    return engine
+
+def get_cached_schema(database_name, kind, loader, *names):
+    """
+    Returns schema metadata from the schema cache, calling loader on a miss.
+
+    Args:
+        database_name (str): The name of the database.
+        kind (str): The kind of metadata, e.g. "tables".
+        loader (Callable): Loads the metadata.
+        names: The schema and table names the metadata is for.
+
+    Returns:
+        The metadata returned by loader.
+    """
+    key = (database_name, kind) + names
+    with _cache_lock:
+        cached = _schema_cache.get(key)
+    if cached and time.time() - cached[1] < SCHEMA_CACHE_SECONDS:
+        put_metric("SchemaCacheHit", 1)
+        tracing.span("sql.schema", database=database_name, kind=kind, cache_hit=True).end()
+        return cached[0]
+
+    put_metric("SchemaCacheHit", 0)
+    with tracing.span("sql.schema", database=database_name, kind=kind, cache_hit=False):
+        value = loader()
+    with _cache_lock:
+        _schema_cache[key] = (value, time.time())
+    return value
+
+def peek_cached_schema(database_name, kind, *names):
+    """
+    Returns schema metadata if it is in the schema cache, without loading it.
+
+    Returns:
+        The cached metadata, or None.
+    """
+    with _cache_lock:
+        cached = _schema_cache.get((database_name, kind) + names)
+    if cached and time.time() - cached[1] < SCHEMA_CACHE_SECONDS:
+        return cached[0]
+    return None
+
+def get_catalog(database_name, column_tables=None):
+    """
+    Returns the tables of a database with their column types, from the schema cache.
+
+    Args:
+        database_name (str): The name of the database.
+        column_tables (list, optional): The {"schema", "table"} references to load columns for, e.g. from
+            sql_errors.referenced_tables. Other tables then only have the columns already in the schema cache.
+
+    Returns:
+        dict: {"default_schema": str, "schemas": {schema: {table: {column: type}}}}. Tables beyond
+            MAX_CATALOG_TABLES are listed without their columns.
+    """
+    engine = get_engine(database_name)
+    inspector = inspect(engine)
+
+    default_schema = get_cached_schema(database_name, "default_schema", lambda: inspector.default_schema_name)
+    schemas = [
+        schema for schema in get_cached_schema(database_name, "schemas", inspector.get_schema_names)
+        if schema.lower() not in SYSTEM_SCHEMAS
+    ]
+    schemas.sort(key=lambda schema: schema != default_schema)
+
+    # Tables are matched ignoring case, a reference without a schema matches the table in any schema
+    wanted = None
+    if column_tables is not None:
+        wanted = {((reference["schema"] or "").lower(), reference["table"].lower()) for reference in column_tables}
+
+    catalog = {"default_schema": default_schema, "schemas": {}}
+    loaded = 0
+    for schema in schemas:
+        tables = get_cached_schema(database_name, "tables", lambda: inspector.get_table_names(schema=schema), schema)
+        catalog["schemas"][schema] = {}
+        for table in tables:
+            columns = []
+            if wanted is not None:
+                if (schema.lower(), table.lower()) in wanted or ("", table.lower()) in wanted:
+                    columns = get_cached_schema(database_name, "columns", lambda: inspector.get_columns(table_name=table, schema=schema), schema, table)
+                else:
+                    columns = peek_cached_schema(database_name, "columns", schema, table) or []
+            elif loaded < MAX_CATALOG_TABLES:
+                columns = get_cached_schema(database_name, "columns", lambda: inspector.get_columns(table_name=table, schema=schema), schema, table)
+                loaded += 1
+            catalog["schemas"][schema][table] = {column['name']: str(column['type']) for column in columns}
+    return catalog
+
+def get_schema_foreign_keys(database_name, schema):
+    """
+    Returns the foreign keys of all tables of a schema, reflected at once and kept in the schema cache.
+
+    Args:
+        database_name (str): The name of the database.
+        schema (str): The name of the schema.
+
+    Returns:
+        dict: {table: [foreign key]} as returned by SQLAlchemy's get_foreign_keys.
+    """
+    inspector = inspect(get_engine(database_name))
+    return get_cached_schema(
+        database_name, "schema_foreign_keys",
+        lambda: {key[1]: fks for key, fks in inspector.get_multi_foreign_keys(schema=schema).items()},
+        schema
+    )
+
+def get_foreign_key_edges(database_name, catalog):
+    """
+    Returns the foreign keys of all of the catalog's tables, from the schema cache.
+
+    Args:
+        database_name (str): The name of the database.
+        catalog (dict): Returned by get_catalog.
+
+    Returns:
+        list: One dict per foreign key with the from and to (schema, table), their names as used
+            in queries and the from_columns and to_columns.
+    """
+    edges = []
+    for schema, tables in catalog["schemas"].items():
+        schema_foreign_keys = get_schema_foreign_keys(database_name, schema)
+        for table in tables:
+            for fk in schema_foreign_keys.get(table, []):
+                referred_schema = fk.get('referred_schema') or schema
+                edges.append({
+                    "from": (schema, table),
+                    "from_name": qualified(catalog, schema, table),
+                    "from_columns": fk['constrained_columns'],
+                    "to": (referred_schema, fk['referred_table']),
+                    "to_name": qualified(catalog, referred_schema, fk['referred_table']),
+                    "to_columns": fk['referred_columns']
+                })
+    return edges
+
+def describe_sql_error(database_name, query, error):
+    """
+    Classifies a failed query by its driver error and returns repair hints built from the cached schema,
+    e.g. the closest column names, so the model can fix the query without rediscovering the schema.
+
+    Args:
+        database_name (str): The name of the database.
+        query (str): The failed SQL statement.
+        error (Exception): The error raised by SQLAlchemy.
+
+    Returns:
+        str: The error class and the hints, or an empty string when the error is not classified.
+    """
+    try:
+        dialect = get_engine(database_name).dialect.name
+        classification = classify_error(error, dialect)
+        if classification["category"] == OTHER:
+            return ""
+
+        # Columns are only loaded for the tables of the query, the other tables are listed by name for the closest-table hints
+        catalog = None
+        if classification["category"] in CATALOG_CATEGORIES:
+            catalog = get_catalog(database_name, column_tables=referenced_tables(query))
+        hints = repair_hints(classification, query, dialect, catalog)
+        put_metric("SqlRepairHints", len(hints), COUNT)
+        return format_repair_hints(classification, hints, dialect)
+    except Exception as e:
+        print(f"Building repair hints failed: {e}")
+        return ""
+
+def clear_caches():
+    """Clears the credential, engine and schema caches and closes pooled connections."""
+    with _cache_lock:
+        engines = list(_engines.values())
+        _database_urls.clear()
+        _engines.clear()
+        _schema_cache.clear()
+    for engine in engines:
+        engine.dispose()
+
 def invoke_sql_query(self, database_name, query):
     """
     Invokes a SQL query against a database.
@@ -93,20 +373,64 @@ def invoke_sql_query(self, database_name, query):
     Returns:
         str: A CSV string of the SQL execution output.
     """
+    cancellation_token = getattr(self, "cancellation_token", None)
+    query_log = getattr(self, "query_log", None)
+    query_stats = getattr(self, "query_stats", None)
+    known_stats = query_log.get_stats(database_name, query, cache=query_stats) if query_log is not None else None
+    rows = None
+    error = None
+    start = time.perf_counter()
+    sql_span = tracing.span("sql.execute", database=database_name)
     try:
-        secrets_manager_key = os.environ.get('SECRET_MANAGER_ID')
-        url = retrieve_database_url(database_name)
-        engine = create_engine(url)
+        engine = get_engine(database_name)
         with engine.connect() as connection:
-            result = connection.execute(text(query))
+            # Cancel the query on the server if the run is cancelled while it executes
+            watch = nullcontext()
+            if cancellation_token is not None:
+                server_connection_id = get_server_connection_id(connection)
+                if server_connection_id is not None:
+                    watch = cancellation_token.watch(lambda: cancel_server_query(engine, server_connection_id))
+            with watch:
+                result = connection.execute(text(query))
         
         output = io.StringIO()
         writer = csv.writer(output)
         writer.writerow(result.keys())
-        writer.writerows(result)
+        rows = result.fetchall()
+        writer.writerows(rows)
         final_output = output.getvalue()
+        if sql_span.recording:
+            sql_span.set_attributes(dialect=engine.dialect.name, rows=len(rows), bytes=len(final_output))
+        sql_span.end()
+        put_metric("SqlRows", len(rows), COUNT)
+        put_metric("SqlBytes", len(final_output), BYTES)
     except Exception as e:
-        final_output = f"Invoking SQL query encountered an error: {e}"
+        sql_span.end(e)
+        put_metric("SqlErrors", 1, COUNT)
+        if cancellation_token is not None and cancellation_token.is_cancelled():
+            final_output = "The query was cancelled."
+            query_log = None
+        else:
+            final_output = f"Invoking SQL query encountered an error: {e}"
+            error = e
+            repair = describe_sql_error(database_name, query, e)
+            if repair:
+                final_output += f"\n{repair}"
+
+    if query_log is not None:
+        duration_ms = (time.perf_counter() - start) * 1000
+        # Written after the result is returned, the run's cached statistics are updated right away
+        query_log.record_in_background(database_name, query, duration_ms,
+                                       rows=len(rows) if error is None else None,
+                                       output_bytes=len(final_output) if error is None else None,
+                                       error=error,
+                                       question=getattr(self, "current_question", None),
+                                       cache=query_stats)
+
+        # Warn about the shape from its earlier runs, so the model does not repeat it
+        warning = query_log.warning(known_stats)
+        if warning:
+            final_output += f"\nNote: {warning}"
     return final_output
 
 def get_database_schemas(self, database_name):
@@ -120,11 +444,8 @@ def get_database_schemas(self, database_name):
         str: A CSV string of the database schemas.
     """
     try:
-        secrets_manager_key = os.environ.get('SECRET_MANAGER_ID')
-        url = retrieve_database_url(database_name)
-        engine = create_engine(url)
-        inspector = inspect(engine)
-        schemas = inspector.get_schema_names()
+        engine = get_engine(database_name)
+        schemas = get_cached_schema(database_name, "schemas", lambda: inspect(engine).get_schema_names())
         
         output = io.StringIO()
         writer = csv.writer(output)
@@ -148,11 +469,8 @@ def get_schema_tables(self, database_name, schema):
         str: A CSV string of the tables in the specified schema.
     """
     try:
-        secrets_manager_key = os.environ.get('SECRET_MANAGER_ID')
-        url = retrieve_database_url(database_name)
-        engine = create_engine(url)
-        inspector = inspect(engine)
-        tables = inspector.get_table_names(schema=schema)
+        engine = get_engine(database_name)
+        tables = get_cached_schema(database_name, "tables", lambda: inspect(engine).get_table_names(schema=schema), schema)
         
         output = io.StringIO()
         writer = csv.writer(output)
@@ -177,11 +495,8 @@ def get_table_columns(self, database_name, schema, table):
         str: A CSV string of the columns in the specified table.
     """
     try:
-        secrets_manager_key = os.environ.get('SECRET_MANAGER_ID')
-        url = retrieve_database_url(database_name)
-        engine = create_engine(url)
-        inspector = inspect(engine)
-        columns = inspector.get_columns(table_name=table, schema=schema)
+        engine = get_engine(database_name)
+        columns = get_cached_schema(database_name, "columns", lambda: inspect(engine).get_columns(table_name=table, schema=schema), schema, table)
         
         output = io.StringIO()
         writer = csv.writer(output)
@@ -211,9 +526,7 @@ def get_foreign_keys(self, database_name, schema=None):
         str: A CSV string of the foreign key relationships.
     """
     try:
-        secrets_manager_key = os.environ.get('SECRET_MANAGER_ID')
-        url = retrieve_database_url(database_name)
-        engine = create_engine(url)
+        engine = get_engine(database_name)
         inspector = inspect(engine)
 
         output = io.StringIO()
@@ -223,11 +536,12 @@ def get_foreign_keys(self, database_name, schema=None):
         if schema:
             schemas = [schema]
         else:
-            schemas = inspector.get_schema_names()
+            schemas = get_cached_schema(database_name, "schemas", inspector.get_schema_names)
 
         for schema_name in schemas:
-            for table_name in inspector.get_table_names(schema=schema_name):
-                fks = inspector.get_foreign_keys(table_name, schema=schema_name)
+            table_names = get_cached_schema(database_name, "tables", lambda: inspector.get_table_names(schema=schema_name), schema_name)
+            for table_name in table_names:
+                fks = get_cached_schema(database_name, "foreign_keys", lambda: inspector.get_foreign_keys(table_name, schema=schema_name), schema_name, table_name)
                 for fk in fks:
                     writer.writerow([
                         schema_name,
@@ -244,6 +558,68 @@ def get_foreign_keys(self, database_name, schema=None):
 
     return final_output
 
+def find_join_paths(self, database_name, tables):
+    """
+    Finds how to join a set of tables through foreign keys, with the tables in between.
+
+    Args:
+        database_name (str): The name of the database to connect to.
+        tables (list): The tables to join, optionally qualified with their schema.
+
+    Returns:
+        str: FROM and JOIN clauses with the join conditions of a smallest tree of foreign keys
+            that connects the tables, and the other foreign keys between the joined tables.
+    """
+    try:
+        if isinstance(tables, str):
+            tables = [table.strip() for table in tables.split(",") if table.strip()]
+
+        # Only the table names are needed, from the cached table lists
+        catalog = get_catalog(database_name, column_tables=[])
+
+        terminals = []
+        for name in dict.fromkeys(tables):
+            schema, _, table = name.rpartition(".")
+            location = find_table(catalog, table, schema or None)
+            if location is None:
+                suggestions = closest(table, [t for tables_of_schema in catalog["schemas"].values() for t in tables_of_schema])
+                return f"There is no table {name}." + (f" Closest tables: {', '.join(suggestions)}." if suggestions else "")
+            terminals.append(location)
+
+        if not terminals:
+            return "Give at least one table."
+
+        edges = get_foreign_key_edges(database_name, catalog)
+        graph = build_graph(edges)
+        tree = steiner_tree(graph, terminals)
+        joins = order_joins(tree)
+        through = [qualified(catalog, *node) for node, _ in joins if node not in terminals]
+
+        lines = [f"Joins for {', '.join(qualified(catalog, *node) for node in terminals)}: {len(joins)} joins"
+                 + (f" through {', '.join(through)}" if through else "")]
+        lines.append(f"FROM {qualified(catalog, *tree['root'])}")
+        for node, edge in joins:
+            lines.append(f"JOIN {qualified(catalog, *node)} ON {join_condition(edge)}")
+
+        for _, edge in joins:
+            others = parallel_edges(graph, edge)
+            if others:
+                lines.append(f"Other foreign keys between {edge['from_name']} and {edge['to_name']}: "
+                             + "; ".join(join_condition(other) for other in others))
+
+        for edge in edges:
+            if edge["from"] == edge["to"] and edge["from"] in tree["nodes"]:
+                lines.append(f"{edge['from_name']} references itself ({join_condition(edge)}), join it again with an alias to follow it.")
+
+        if tree["unreachable"]:
+            lines.append("Not connected by foreign keys: " + ", ".join(qualified(catalog, *node) for node in sorted(tree["unreachable"])))
+
+        final_output = "\n".join(lines)
+    except Exception as e:
+        final_output = f"Finding join paths encountered an error: {e}"
+
+    return final_output
+
 # New ToolSpec for get_foreign_keys
 GET_FOREIGN_KEYS_TOOLSPEC = {
     "toolSpec": {
@@ -269,6 +645,31 @@ GET_FOREIGN_KEYS_TOOLSPEC = {
 }
 
 
+FIND_JOIN_PATHS_TOOLSPEC = {
+    "toolSpec": {
+        "name": "find_join_paths",
+        "description": "Use this tool to get the joins and join conditions that connect a set of tables through foreign keys, including the tables in between",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "database_name": {
+                        "type": "string",
+                        "description": "The name of the database to connect to in the server"
+                    },
+                    "tables": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The tables the query needs, qualified as schema.table when they are not in the default schema"
+                    }
+                },
+                "required": ["database_name", "tables"]
+            }
+        }
+    }
+}
+
+
 # ToolSpecs
 
 INVOKE_SQL_TOOLSPEC = {
@@ -368,7 +769,9 @@ SQL_TOOL_GROUP = {
     "tool_group_name": "SQL_TOOL_GROUP",
     "usage_instructions": """Always try to use more specific SQL tools first before using invoke_sql_query.
     Check your memory first for any data dictionary that you may have built already. If you don't find it
-    in your memory, then query the database. Unless the user has specifically asked for the SQL query,
+    in your memory, then query the database. When a question needs several tables, call find_join_paths
+    with all of them to get the join conditions at once instead of reading foreign keys table by table.
+    Unless the user has specifically asked for the SQL query,
     ensure that you provide the final answer in natural language after executing the query. 
     """,
     "tools": [
@@ -391,6 +794,10 @@ SQL_TOOL_GROUP = {
         {
             "tool_spec": GET_FOREIGN_KEYS_TOOLSPEC,
             "function": get_foreign_keys
+        },
+        {
+            "tool_spec": FIND_JOIN_PATHS_TOOLSPEC,
+            "function": find_join_paths
         }
     ]
 }
\ No newline at end of file
@@ -1,6 +1,218 @@
 import json
 
 from prompts import STRUCTURED_MEMORY_TOOL_GROUP_INSTRUCTIONS_PROMPT
+from memory_search import (
+    MemorySearchIndex, SEARCH_INDEX_MEMORY_ID, SEARCH_INDEX_SHARDS,
+    search_index_shard, search_index_shard_id, chunk_memory, make_snippet
+)
+from memory_store import ConditionalWriteError
+
+
+def is_reserved_memory_id(memory_id):
+    """
+    The main memory index, the search index shards and the section items are
+    stored next to the memories, so their ids cannot be used as memory ids
+    """
+
+    memory_id = str(memory_id)
+    return memory_id in ("1", SEARCH_INDEX_MEMORY_ID) or "#" in memory_id
+
+
+def load_memory_search_index_shard(self, shard, memory_index=None):
+    """
+    Loads one shard of the persisted search index, rebuilding and saving it
+    from the memories of that shard if missing
+    """
+
+    item = self.memory_store.get_item(search_index_shard_id(shard))
+
+    if item and item.get("contents"):
+        index = MemorySearchIndex.from_dict(json.loads(item["contents"]))
+        index.version = item.get("version")
+        return index
+
+    index = MemorySearchIndex()
+
+    memory_index = memory_index or get_memory_index(self)
+    if memory_index:
+        for entry in memory_index["memories"]:
+            if is_reserved_memory_id(entry["memory_id"]) or search_index_shard(entry["memory_id"]) != shard:
+                continue
+
+            memory = read_memory(self, entry["memory_id"])
+            if memory["statusCode"] == 200:
+                body = memory["body"]
+                index.add_memory(entry["memory_id"], body.get("title", ""),
+                                 body.get("description", ""), body.get("contents", ""))
+
+    # Persist the rebuilt shard so later loads do not read its memories again
+    try:
+        save_memory_search_index_shard(self, shard, index)
+    except ConditionalWriteError:
+        print(f"Search index shard {shard} was rebuilt concurrently")
+
+    return index
+
+
+def load_memory_search_index(self):
+    """
+    Loads all shards of the search index and merges them for searching
+    """
+
+    shards = [self.memory_store.get_item(search_index_shard_id(shard)) for shard in range(SEARCH_INDEX_SHARDS)]
+
+    # The memory index is only needed to rebuild missing shards
+    memory_index = get_memory_index(self) if not all(shards) else None
+
+    indexes = []
+    for shard, item in enumerate(shards):
+        if item and item.get("contents"):
+            indexes.append(MemorySearchIndex.from_dict(json.loads(item["contents"])))
+        else:
+            indexes.append(load_memory_search_index_shard(self, shard, memory_index))
+
+    return MemorySearchIndex.merge(indexes)
+
+
+def save_memory_search_index_shard(self, shard, index):
+    """
+    Persists a shard of the search index next to the memories. The write is
+    conditional on the version that was loaded so concurrent updates are not lost.
+    """
+
+    version = index.version
+
+    self.memory_store.put_item(
+        {
+            "id": search_index_shard_id(shard),
+            "version": str(int(version or 0) + 1),
+            "contents": json.dumps(index.to_dict())
+        },
+        expected={"version": version}
+    )
+
+    index.version = str(int(version or 0) + 1)
+
+
+def update_memory_search_index(self, memory_id, update, max_attempts=5):
+    """
+    Applies update(index) to the shard of the search index that holds
+    memory_id, retrying on conflicts
+    """
+
+    shard = search_index_shard(memory_id)
+
+    for attempt in range(max_attempts):
+        index = load_memory_search_index_shard(self, shard)
+        update(index)
+
+        try:
+            save_memory_search_index_shard(self, shard, index)
+            return index
+        except ConditionalWriteError:
+            print(f"Search index was updated concurrently. Retrying ({attempt + 1}/{max_attempts})")
+
+    raise ConditionalWriteError("Could not update the memory search index")
+
+
+def put_memory_item(self, memory_id, memory_contents, version):
+    """
+    Writes the item of a memory if it is still at version, the version that
+    was read, so a concurrent edit of the memory is not overwritten
+    """
+
+    self.memory_store.put_item(
+        {
+            "id": memory_id,
+            "version": str(int(version or 0) + 1),
+            "contents": json.dumps(memory_contents)
+        },
+        expected={"version": version}
+    )
+
+
+def sections_item_id(memory_id):
+    return f"{memory_id}#sections"
+
+
+def section_item_id(memory_id, section_id):
+    return f"{memory_id}#section#{section_id}"
+
+
+def save_memory_sections(self, memory_id, contents):
+    """
+    Stores each markdown section of a memory as its own item, plus an outline
+    item listing them, so single sections can be read without the whole memory
+    """
+
+    previous = self.memory_store.get_item(sections_item_id(memory_id))
+    previous_outline = json.loads(previous["contents"]) if previous else []
+
+    outline = []
+    for n, chunk in enumerate(chunk_memory(contents)):
+        section_contents = contents[chunk["start"]:chunk["end"]]
+
+        self.memory_store.put_item(
+            {
+                "id": section_item_id(memory_id, n),
+                "heading": chunk["heading"],
+                "contents": section_contents
+            }
+        )
+
+        outline.append({
+            "section_id": str(n),
+            "heading": chunk["heading"],
+            "level": chunk["level"],
+            "characters": len(section_contents)
+        })
+
+    self.memory_store.put_item(
+        {
+            "id": sections_item_id(memory_id),
+            "contents": json.dumps(outline)
+        }
+    )
+
+    # Remove sections that no longer exist
+    for entry in previous_outline[len(outline):]:
+        self.memory_store.delete_item(section_item_id(memory_id, entry["section_id"]))
+
+    return outline
+
+
+def delete_memory_sections(self, memory_id):
+    """
+    Deletes the outline and section items of a memory
+    """
+
+    item = self.memory_store.get_item(sections_item_id(memory_id))
+
+    if item:
+        for entry in json.loads(item["contents"]):
+            self.memory_store.delete_item(section_item_id(memory_id, entry["section_id"]))
+
+        self.memory_store.delete_item(sections_item_id(memory_id))
+
+
+def find_memory_section(outline, section):
+    """
+    Finds a section in an outline by section_id or by heading (case insensitive)
+    """
+
+    section = str(section).strip()
+
+    for entry in outline:
+        if entry["section_id"] == section:
+            return entry
+
+    heading = section.lstrip("#").strip().lower()
+    for entry in outline:
+        if entry["heading"].lower() == heading:
+            return entry
+
+    return None
+
 
 def create_memory_index(self):
     """
@@ -26,8 +238,8 @@ def create_memory_index(self):
         ]   
     }
     
-    self.table.put_item(
-        Item={
+    self.memory_store.put_item(
+        {
             "id": "1",
             "contents": json.dumps(memory_index)
         }
@@ -41,14 +253,10 @@ def get_memory_index(self):
     Retrieves the memory index
     """
     
-    response = self.table.get_item(
-        Key={
-            "id": "1"
-        }
-    )
+    item = self.memory_store.get_item("1")
     
-    if "Item" in response:
-        contents = response["Item"].get("contents", None)
+    if item:
+        contents = item.get("contents", None)
         
         if contents:
             memory = json.loads(contents)
@@ -90,8 +298,8 @@ def update_memory_index_entry(self, memory_id, title, description,
         if not existing_memory_found:
             memory["memories"].append(index_entry)
         
-        self.table.put_item(
-            Item={
+        self.memory_store.put_item(
+            {
                 "id": "1",
                 "contents": json.dumps(memory)
             }
@@ -111,6 +319,12 @@ def update_memory_index_entry(self, memory_id, title, description,
 
 def delete_memory_index_entry(self, memory_id):
     
+    if is_reserved_memory_id(memory_id):
+        return {
+            "statusCode": 401,
+            "body": f"Memory id {memory_id} is reserved and cannot be deleted."
+        }
+    
     memory = self.get_memory_index()
     
     for i in range(len(memory["memories"])):
@@ -122,19 +336,19 @@ def delete_memory_index_entry(self, memory_id):
                     "body": f"Memory id {memory_id} cannot be deleted as it is marked as delete protected."
                 }
                 
-            # Delete from dynamo db    
-            self.table.delete_item(
-                Key={
-                    "id": memory_id
-                }
-            )
+            # Delete from the memory store
+            self.memory_store.delete_item(memory_id)
+            delete_memory_sections(self, memory_id)
+            
+            # Delete from search index
+            update_memory_search_index(self, memory_id, lambda index: index.remove_memory(memory_id))
             
             # Delete from index
             memory["memories"].pop(i)
             break
     
-    self.table.put_item(
-        Item={
+    self.memory_store.put_item(
+        {
             "id": "1",
             "contents": json.dumps(memory)
         }
@@ -155,6 +369,13 @@ def write_memory(self, memory_id, title, description, contents, is_delete_protec
             "body": "You cannot use write_memory to update the main memory index."
         }
     
+    # Block writes over the search index and section items
+    if is_reserved_memory_id(memory_id):
+        return {
+            "statusCode": 401,
+            "body": f"Memory id {memory_id} is reserved. Use integers for memory_ids."
+        }
+    
     # Check if memory exists
     memory_index = self.get_memory_index()
     
@@ -183,13 +404,24 @@ def write_memory(self, memory_id, title, description, contents, is_delete_protec
             "contents": contents
         }
 
-        # Write the memory
-        self.table.put_item(
-            Item={
-                "id": memory_id,
-                "contents": json.dumps(memory_contents)
-            }
-        )
+        # Write the memory. It replaces the whole memory but still moves its
+        # version, so section edits that read the previous contents are retried
+        for attempt in range(5):
+            item = self.memory_store.get_item(memory_id)
+            
+            try:
+                put_memory_item(self, memory_id, memory_contents, item.get("version") if item else None)
+                break
+            except ConditionalWriteError:
+                print(f"Memory {memory_id} was updated concurrently. Retrying ({attempt + 1}/5)")
+        else:
+            raise ConditionalWriteError(f"Could not write memory {memory_id}")
+        
+        # Store the sections for partial reads
+        save_memory_sections(self, memory_id, contents)
+        
+        # Keep the search index up to date
+        update_memory_search_index(self, memory_id, lambda index: index.add_memory(memory_id, title, description, contents))
 
         return {
             "statusCode": 200,
@@ -205,14 +437,10 @@ def write_memory(self, memory_id, title, description, contents, is_delete_protec
 def read_memory(self, memory_id):
     """Returns the contents of a memory"""
     
-    response = self.table.get_item(
-        Key={
-            "id": memory_id
-        }
-    )
+    item = self.memory_store.get_item(memory_id)
     
-    if "Item" in response:
-        contents = json.loads(response["Item"].get("contents"))
+    if item:
+        contents = json.loads(item.get("contents"))
         
         return {
             "statusCode": 200,
@@ -224,6 +452,37 @@ def read_memory(self, memory_id):
             "statusCode": 404,
             "body": "Memory not found or is empty"
         }
+
+def search_memory(self, query, top_k=5):
+    """Returns the memory sections that best match the query, with snippets"""
+    
+    search_index = load_memory_search_index(self)
+    results = search_index.search(query, top_k=int(top_k))
+    
+    if not results:
+        return {
+            "statusCode": 404,
+            "body": f"No memories matched the query: {query}"
+        }
+    
+    # Cut the snippets from the matching sections only
+    for result in results:
+        start = result.pop("start")
+        end = result.pop("end")
+        
+        section = self.memory_store.get_item(section_item_id(result["memory_id"], result["section_id"]))
+        
+        if section:
+            result["snippet"] = make_snippet(section.get("contents", ""), 0, end - start, query)
+        else:
+            memory = read_memory(self, result["memory_id"])
+            contents = memory["body"].get("contents", "") if memory["statusCode"] == 200 else ""
+            result["snippet"] = make_snippet(contents, start, end, query)
+    
+    return {
+        "statusCode": 200,
+        "body": results
+    }
     
 
 ## ReadMemory ToolSpec
@@ -371,7 +630,275 @@ READ_MEMORY_TOOLSPEC = {
 }
 
 
+def list_memory_sections(self, memory_id):
+    """Returns the section outline of a memory without its contents"""
+    
+    item = self.memory_store.get_item(sections_item_id(memory_id))
+    
+    if item:
+        outline = json.loads(item["contents"])
+    else:
+        # Memories written before sections were stored
+        memory = read_memory(self, memory_id)
+        if memory["statusCode"] != 200:
+            return memory
+        outline = save_memory_sections(self, memory_id, memory["body"].get("contents", ""))
+    
+    return {
+        "statusCode": 200,
+        "body": outline
+    }
+
+
+def read_memory_section(self, memory_id, section):
+    """Returns the contents of a single section of a memory"""
+    
+    outline = list_memory_sections(self, memory_id)
+    if outline["statusCode"] != 200:
+        return outline
+    
+    entry = find_memory_section(outline["body"], section)
+    if entry is None:
+        return {
+            "statusCode": 404,
+            "body": f"Section {section} not found in memory_id {memory_id}. Use list_memory_sections to see the sections."
+        }
+    
+    item = self.memory_store.get_item(section_item_id(memory_id, entry["section_id"]))
+    
+    return {
+        "statusCode": 200,
+        "body": {
+            "section_id": entry["section_id"],
+            "heading": entry["heading"],
+            "contents": item.get("contents", "") if item else ""
+        }
+    }
+
+
+def update_memory_section(self, memory_id, section, contents, max_attempts=5):
+    """
+    Replaces a single section of a memory and keeps the rest of it unchanged.
+    The edit is made from the outline and the section item, and only the
+    memory item, the edited section item, the outline and the search index
+    entries of that section are written. If the new contents add or remove
+    headers, the sections move and all section items are rewritten.
+    
+    The memory item is written only if its version did not change since it
+    was read, otherwise the edit is made again on the new contents.
+    """
+    
+    for attempt in range(max_attempts):
+        outline = list_memory_sections(self, memory_id)
+        if outline["statusCode"] != 200:
+            return outline
+        
+        outline = outline["body"]
+        
+        entry = find_memory_section(outline, section)
+        if entry is None:
+            return {
+                "statusCode": 404,
+                "body": f"Section {section} not found in memory_id {memory_id}. Use list_memory_sections to see the sections."
+            }
+        
+        item = self.memory_store.get_item(memory_id)
+        if not item:
+            return read_memory(self, memory_id)
+        
+        body = json.loads(item["contents"])
+        version = item.get("version")
+        
+        if str(body.get("is_write_protected")) == "True":
+            return {
+                "statusCode": 401,
+                "body": f"Memory id {memory_id} is write protected. You cannot update this memory."
+            }
+        
+        n = int(entry["section_id"])
+        section_item = self.memory_store.get_item(section_item_id(memory_id, n))
+        current_section = section_item.get("contents", "") if section_item else ""
+        
+        # The section starts after the sections before it in the outline
+        current_contents = body.get("contents", "")
+        start = sum(other["characters"] for other in outline[:n])
+        end = start + len(current_section)
+        
+        if current_contents[start:end] != current_section:
+            # The section items lag behind a concurrent write of the memory, store them again
+            print(f"Sections of memory {memory_id} are out of date. Retrying ({attempt + 1}/{max_attempts})")
+            save_memory_sections(self, memory_id, current_contents)
+            continue
+        
+        section_contents = contents
+        
+        # Keep the existing header line if the new contents do not include one
+        if entry.get("level") and not section_contents.lstrip().startswith("#"):
+            header_line = current_section.split("\n", 1)[0]
+            section_contents = f"{header_line}\n{section_contents}"
+        
+        if not section_contents.endswith("\n") and end < len(current_contents):
+            section_contents += "\n"
+        
+        new_contents = current_contents[:start] + section_contents + current_contents[end:]
+        new_chunks = chunk_memory(new_contents)
+        
+        try:
+            put_memory_item(self, memory_id, {**body, "contents": new_contents}, version)
+        except ConditionalWriteError:
+            print(f"Memory {memory_id} was updated concurrently. Retrying ({attempt + 1}/{max_attempts})")
+            continue
+        
+        if len(new_chunks) == len(outline) and new_chunks[n]["start"] == start and new_chunks[n]["end"] == start + len(section_contents):
+            write_memory_section(self, memory_id, body, new_contents, outline, n, new_chunks[n])
+        else:
+            # Headers were added or removed, the sections move
+            save_memory_sections(self, memory_id, new_contents)
+            update_memory_search_index(self, memory_id, lambda index: index.add_memory(
+                memory_id, body.get("title", ""), body.get("description", ""), new_contents))
+        
+        return {
+            "statusCode": 200,
+            "body": f"Successfully updated section {entry['heading'] or entry['section_id']} of memory_id {memory_id}."
+        }
+    
+    raise ConditionalWriteError(f"Could not update memory {memory_id}")
+
+
+def write_memory_section(self, memory_id, body, new_contents, outline, n, chunk):
+    """
+    Stores the section item, the outline entry and the search index entries
+    of an edited section whose boundaries did not change
+    """
+    
+    section_contents = new_contents[chunk["start"]:chunk["end"]]
+    
+    self.memory_store.put_item(
+        {
+            "id": section_item_id(memory_id, n),
+            "heading": chunk["heading"],
+            "contents": section_contents
+        }
+    )
+    
+    outline = list(outline)
+    outline[n] = {
+        "section_id": str(n),
+        "heading": chunk["heading"],
+        "level": chunk["level"],
+        "characters": len(section_contents)
+    }
+    
+    self.memory_store.put_item(
+        {
+            "id": sections_item_id(memory_id),
+            "contents": json.dumps(outline)
+        }
+    )
+    
+    title = body.get("title", "")
+    description = body.get("description", "")
+    
+    def update(index):
+        if not index.update_section(memory_id, n, title, description, chunk, section_contents):
+            index.add_memory(memory_id, title, description, new_contents)
+    
+    update_memory_search_index(self, memory_id, update)
+
+
+SEARCH_MEMORY_TOOLSPEC = {
+    "toolSpec": {
+        "name": "search_memory",
+        "description": """Searches the titles, descriptions and contents of all memories by keyword.
+        Returns the best matching memory sections ranked by relevance, each with a memory_id,
+        section heading and snippet. Use this instead of reading whole memories to find a fact.""",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The keywords to search for, e.g. table or column names"
+                    },
+                    "top_k": {
+                        "type": "integer",
+                        "description": "Optional. The maximum number of sections to return. Defaults to 5."
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    }
+}
+
+LIST_MEMORY_SECTIONS_TOOLSPEC = {
+    "toolSpec": {
+        "name": "list_memory_sections",
+        "description": "Lists the markdown sections of a memory (section_id, heading, level and size) without their contents.",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "memory_id": {
+                        "type": "string",
+                        "description": "The memory_id of the memory to list the sections of"
+                    }
+                },
+                "required": ["memory_id"]
+            }
+        }
+    }
+}
+
+READ_MEMORY_SECTION_TOOLSPEC = {
+    "toolSpec": {
+        "name": "read_memory_section",
+        "description": "Reads a single section of a memory. Use this instead of read_memory when you only need part of a large memory.",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "memory_id": {
+                        "type": "string",
+                        "description": "The memory_id of the memory"
+                    },
+                    "section": {
+                        "type": "string",
+                        "description": "The section_id or the heading text of the section to read"
+                    }
+                },
+                "required": ["memory_id", "section"]
+            }
+        }
+    }
+}
 
+UPDATE_MEMORY_SECTION_TOOLSPEC = {
+    "toolSpec": {
+        "name": "update_memory_section",
+        "description": "Replaces the contents of a single section of a memory. The rest of the memory is kept unchanged.",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "memory_id": {
+                        "type": "string",
+                        "description": "The memory_id of the memory"
+                    },
+                    "section": {
+                        "type": "string",
+                        "description": "The section_id or the heading text of the section to replace"
+                    },
+                    "contents": {
+                        "type": "string",
+                        "description": "The new contents of the section. If the header line is omitted, the existing header is kept."
+                    }
+                },
+                "required": ["memory_id", "section", "contents"]
+            }
+        }
+    }
+}
 
     
 STRUCTURED_MEMORY_TOOL_GROUP={
@@ -401,6 +928,22 @@ STRUCTURED_MEMORY_TOOL_GROUP={
         {
             "tool_spec": READ_MEMORY_TOOLSPEC,
             "function": read_memory
+        },
+        {
+            "tool_spec": SEARCH_MEMORY_TOOLSPEC,
+            "function": search_memory
+        },
+        {
+            "tool_spec": LIST_MEMORY_SECTIONS_TOOLSPEC,
+            "function": list_memory_sections
+        },
+        {
+            "tool_spec": READ_MEMORY_SECTION_TOOLSPEC,
+            "function": read_memory_section
+        },
+        {
+            "tool_spec": UPDATE_MEMORY_SECTION_TOOLSPEC,
+            "function": update_memory_section
         }
     ]
 }
\ No newline at end of file
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import functools
+
+# The exporter is selected by TRACING_EXPORTER: none (default), jsonl or otel
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'none').lower()
+
+# Where the jsonl exporter writes spans, standard output (the function's log) by default
+TRACING_FILE = os.environ.get('TRACING_FILE')
+
+
+class Span():
+    """
+    A timed operation with attributes. Spans started while another span is
+    active on the same thread become its children.
+
+    Use as a context manager, or call end() explicitly. Ending a span also
+    ends its children that are still open.
+    """
+
+    recording = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+        self.thread_name = threading.current_thread().name
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        if self.duration_ms is not None:
+            return
+
+        self.duration_ms = (time.perf_counter() - self.start_counter) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+        self.tracer.finish(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end(exc_value)
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": f"{self.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_id": f"{self.parent_id:016x}" if self.parent_id else None,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms, 3),
+            "thread": self.thread_name,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+class NoopSpan():
+    """Returned when tracing is disabled. Every method does nothing"""
+
+    recording = False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer():
+    """Creates spans and keeps the stack of active spans of each thread"""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.local = threading.local()
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def start_span(self, name, parent=None, **attributes):
+        stack = self.stack()
+        parent = parent or (stack[-1] if stack else None)
+
+        if parent is not None:
+            span = Span(self, name, parent.trace_id, parent.span_id, attributes)
+        else:
+            span = Span(self, name, random.getrandbits(128), None, attributes)
+
+        stack.append(span)
+        return span
+
+    def current_span(self):
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def finish(self, span):
+        stack = self.stack()
+
+        # End the children that were left open, e.g. the last turn of a run that returned
+        if span in stack:
+            while stack[-1] is not span:
+                stack[-1].end()
+            stack.pop()
+
+        try:
+            self.exporter.export(span)
+            if span.parent_id is None:
+                self.exporter.flush()
+        except Exception as e:
+            print(f"Failed to export span {span.name}: {e}")
+
+
+class SpanExporter():
+
+    def export(self, span):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    """Writes each span as a JSON line to a file, or to standard output"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.file = open(path, "a") if path else None
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            (self.file or sys.stdout).write(line + "\n")
+
+    def flush(self):
+        with self.lock:
+            (self.file or sys.stdout).flush()
+
+
+class InMemoryExporter(SpanExporter):
+    """Keeps spans in a list. Used in tests and local runs"""
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def of_name(self, name):
+        return [span for span in self.spans if span.name == name]
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """
+    Hands spans to an OpenTelemetry SDK span exporter, keeping their ids, so they
+    can be sent to any OpenTelemetry backend (e.g. OTLP to a collector or X-Ray).
+    Requires the opentelemetry-sdk package.
+
+    Parameters:
+    - span_exporter (opentelemetry.sdk.trace.export.SpanExporter) Defaults to the OTLP/HTTP exporter
+    - service_name (str) The service.name resource attribute
+    """
+
+    def __init__(self, span_exporter=None, service_name="converse-sql-agent"):
+        try:
+            from opentelemetry.sdk.resources import Resource
+        except ImportError as e:
+            raise ValueError("The otel exporter requires the opentelemetry-sdk package") from e
+
+        if span_exporter is None:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            span_exporter = OTLPSpanExporter()
+
+        self.span_exporter = span_exporter
+        self.resource = Resource.create({"service.name": service_name})
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def to_otel(self, span):
+        from opentelemetry.sdk.trace import ReadableSpan
+        from opentelemetry.trace import SpanContext, TraceFlags, Status, StatusCode
+
+        def context(span_id):
+            return SpanContext(span.trace_id, span_id, is_remote=False, trace_flags=TraceFlags(TraceFlags.SAMPLED))
+
+        start_ns = int(span.start_time * 1e9)
+
+        return ReadableSpan(
+            name=span.name,
+            context=context(span.span_id),
+            parent=context(span.parent_id) if span.parent_id else None,
+            resource=self.resource,
+            attributes={key: value for key, value in span.attributes.items() if isinstance(value, (str, bool, int, float))},
+            start_time=start_ns,
+            end_time=start_ns + int(span.duration_ms * 1e6),
+            status=Status(StatusCode.ERROR, span.error) if span.error else Status(StatusCode.OK)
+        )
+
+    def export(self, span):
+        with self.lock:
+            self.pending.append(span)
+
+    def flush(self):
+        with self.lock:
+            spans, self.pending = self.pending, []
+        if spans:
+            self.span_exporter.export([self.to_otel(span) for span in spans])
+
+
+def create_exporter(kind=None, path=None):
+    """
+    Creates a span exporter
+
+    Parameters:
+    - kind (str) none, jsonl or otel, TRACING_EXPORTER by default
+    - path (str) The file for the jsonl exporter, TRACING_FILE by default
+
+    Returns:
+    - (SpanExporter) The exporter, or None when tracing is disabled
+    """
+
+    kind = (kind or TRACING_EXPORTER).lower()
+
+    if kind == "none":
+        return None
+    if kind == "jsonl":
+        return JsonLinesExporter(path or TRACING_FILE)
+    if kind == "otel":
+        return OpenTelemetryExporter()
+
+    raise ValueError(f"Unknown tracing exporter: {kind}")
+
+
+# The process wide tracer, None while tracing is disabled
+_tracer = None
+
+
+def configure_tracing(exporter):
+    """Enables tracing with exporter, or disables it when exporter is None"""
+
+    global _tracer
+    _tracer = Tracer(exporter) if exporter is not None else None
+
+
+def span(name, parent=None, **attributes):
+    """
+    Starts a span that is a child of the current span of this thread, or of parent
+
+    Returns:
+    - (Span) The span, or NOOP_SPAN when tracing is disabled
+    """
+
+    if _tracer is None:
+        return NOOP_SPAN
+    return _tracer.start_span(name, parent=parent, **attributes)
+
+
+def current_span():
+    """Returns the active span of this thread, e.g. to pass it as the parent of spans in a worker thread"""
+
+    if _tracer is None:
+        return None
+    return _tracer.current_span()
+
+
+def traced(name):
+    """Decorator that runs a function in a span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.start_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+configure_tracing(create_exporter())
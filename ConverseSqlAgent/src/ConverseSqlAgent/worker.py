@@ -0,0 +1,53 @@
+import json
+import time
+from datetime import datetime
+
+import tracing
+import metrics
+from lambda_function import run_agent_request, handle_reflection, handle_continuation
+
+def job_started_at(job):
+    """Returns when the job was enqueued in epoch milliseconds, so a cancel sent while it waited applies"""
+    
+    if not job.get("enqueued_at"):
+        return None
+    
+    return int(datetime.fromisoformat(job["enqueued_at"]).timestamp() * 1000)
+
+@metrics.flushed
+@tracing.traced("worker.handler")
+def handler(event, context):
+    """
+    Runs agent jobs delivered by the SQS event source. The number of jobs that
+    run at once is bounded by the event source maximum concurrency.
+    """
+    
+    if event.get("type") == "reflection":
+        return handle_reflection(event)
+    
+    if event.get("type") == "continuation":
+        return handle_continuation(event, context)
+    
+    batch_item_failures = []
+    
+    for record in event.get("Records", []):
+        try:
+            job = json.loads(record["body"])
+            print(f"Running job {job['job_id']}")
+            
+            started_at = job_started_at(job)
+            if started_at:
+                metrics.put_metric("JobQueueWait", time.time() * 1000 - started_at, metrics.MILLISECONDS)
+            
+            run_agent_request(job["prompt"], job["connection_id"], job["domain_name"], job["stage"], context,
+                              database=job.get("database"), session_id=job.get("session_id"),
+                              run_id=job["job_id"], started_at=started_at, tenant_id=job.get("tenant_id"),
+                              profile=job.get("profile", False), principal=job.get("principal"))
+        except Exception as e:
+            print(f"Job failed: {e}")
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+    
+    # Only the failed jobs are returned to the queue
+    return {
+        "batchItemFailures": batch_item_failures
+    }